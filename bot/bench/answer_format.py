@@ -0,0 +1,98 @@
+"""Постобработка ответов Perplexity: прежние четыре прохода регулярками против однопроходного AnswerFormatter.
+
+Ответы — записанные в формате Perplexity (размышления, сноски, markdown-ссылки). Для каждого замеряется
+разовое форматирование и потоковое (кусками по --chunk символов), и проверяется, что результаты совпадают.
+Прежний конвейер не экранировал текст и оставлял содержимое <think>, так что в разовом режиме он делает
+меньше работы; в стриме он заново чистил весь накопленный текст на каждый фрагмент.
+
+Запуск: python bench/answer_format.py [--repeat 200] [--chunk 16]
+"""
+import argparse
+import html
+import re
+import time
+
+import stubs  # noqa: F401 — добавляет src в sys.path
+from text_utils import AnswerFormatter, format_answer
+
+THINK = ("<think>Пользователь спрашивает о пользе продукта. Нужно упомянуть состав, дозировку и "
+         "противопоказания, а также дать ссылку на магазин [1].</think>")
+PARAGRAPH = ("Коллаген — основной структурный белок соединительной ткани [1]. Он поддерживает упругость "
+             "кожи, здоровье суставов и связок [2]. Гидролизованный коллаген усваивается лучше [3], "
+             "а витамин C нужен для его синтеза [4]. Курс обычно 2–3 месяца; при заболеваниях почек "
+             "нужна консультация врача & контроль доз < 10 г/сут.")
+FOOTNOTES = "\n".join(f"[{i}]: https://example.com/source/{i}?ref=perplexity&lang=ru" for i in range(1, 5))
+LINK = "Купить можно у [NL INTERNATIONAL](https://nlstar.com/ref/aU37in)."
+
+ANSWERS = {
+    "короткий": f"{THINK}{PARAGRAPH}\n\n{LINK}\n\n{FOOTNOTES}",
+    "средний": f"{THINK}" + "\n\n".join([PARAGRAPH] * 6) + f"\n\n{LINK}\n\n{FOOTNOTES}",
+    "длинный": f"{THINK * 3}" + "\n\n".join([PARAGRAPH] * 30) + f"\n\n{LINK}\n\n{FOOTNOTES}",
+}
+
+
+def legacy_format(text: str) -> str:
+    """Прежний конвейер: clean_telegram_html + convert_markdown_links_to_html"""
+    text = re.sub(r"</?think>", "", text)
+    footnote_refs = {}
+
+    def collect_footnotes(match):
+        footnote_refs[match.group(1)] = match.group(2)
+        return ""
+    text = re.sub(r'^\[(\d+)\]:\s*(\S+)$', collect_footnotes, text, flags=re.MULTILINE)
+    if footnote_refs:
+        def replace_footnote(match):
+            url = footnote_refs.get(match.group(1))
+            return f'<a href="{html.escape(url, quote=True)}">[{match.group(1)}]</a>' if url else match.group(0)
+        text = re.sub(r'\[(\d+)\]', replace_footnote, text)
+
+    def replace_link(match):
+        return f'<a href="{html.escape(match.group(2), quote=True)}">{html.escape(match.group(1))}</a>'
+    return re.sub(r'\[([^\]]+)\]\(([^)]+)\)', replace_link, text)
+
+
+def legacy_streamed(text: str, chunk: int) -> str:
+    """Прежний стрим в боте: на каждый фрагмент чистка всего накопленного текста, в конце — полный конвейер"""
+    raw = ""
+    for i in range(0, len(text), chunk):
+        raw += text[i:i + chunk]
+        re.sub(r"</?think>", "", raw)
+    return legacy_format(raw)
+
+
+def streamed(text: str, chunk: int) -> str:
+    formatter = AnswerFormatter()
+    for i in range(0, len(text), chunk):
+        formatter.feed(text[i:i + chunk])
+    return formatter.finish()
+
+
+def measure(fn, repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--chunk", type=int, default=16, help="размер фрагмента стрима, символов")
+    args = parser.parse_args()
+
+    print(f"{'ответ':>10} {'символов':>9} {'прежний разовый':>16} {'разовый':>8} {'прежний стрим':>14} {'стрим':>7}"
+          "  (мкс на ответ)")
+    for name, text in ANSWERS.items():
+        expected = format_answer(text)
+        assert streamed(text, args.chunk) == expected, f"{name}: стрим и разовое форматирование расходятся"
+        assert "<think>" not in expected and "Пользователь спрашивает" not in expected
+        assert "&amp; контроль доз &lt; 10" in expected, "текст не экранирован"
+        legacy = measure(lambda: legacy_format(text), args.repeat)
+        single = measure(lambda: format_answer(text), args.repeat)
+        legacy_stream = measure(lambda: legacy_streamed(text, args.chunk), args.repeat)
+        stream = measure(lambda: streamed(text, args.chunk), args.repeat)
+        print(f"{name:>10} {len(text):>9} {legacy:>16.0f} {single:>8.0f} {legacy_stream:>14.0f} {stream:>7.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Модель каталога в памяти: словари против записей Product со __slots__ и столбцов CityPrices.
+
+Для каждого размера каталога меряется:
+- память пачки нормализованных товаров (словари против Product с общими строками id и категорий);
+- память индекса цен (словарь (город, id) -> (цена, уведомлённая цена) против CityPrices);
+- время сравнения каталога с индексом, когда изменилось --changed цен (прежний цикл
+  по словарям против PriceTracker.process со сравнением столбцов array('d')).
+
+Запуск: python bench/catalog_model.py [--sizes 10000 100000] [--changed 0.05]
+"""
+import argparse
+import asyncio
+import gc
+import random
+import statistics
+import time
+import tracemalloc
+
+import stubs  # noqa: F401  (путь к модулям бота)
+from catalog import CityPrices, intern_id
+from price_tracker import PriceChanges, PriceTracker
+from scraper import normalize_product
+
+CITY = "2214"
+
+
+def raw_catalog(size: int, changed: float, seed: int):
+    """Товары в виде ответа nlstar (id — число, цена — словарь); с seed > 0 часть цен изменена"""
+    rng = random.Random(seed)
+    return [{
+        "id": 100000 + i,
+        "name": f"Товар {i} с достаточно длинным названием",
+        "short_name": f"Товар {i}",
+        "price": {"current": 1000.0 + i % 5000 + (rng.choice((-100.0, 100.0)) if seed and rng.random() < changed else 0.0)},
+        "category": f"Категория {i % 40}",
+    } for i in range(size)]
+
+
+def legacy_normalize(p, city_id: str) -> dict:
+    """Прежняя нормализация: словарь с новыми строками на каждый товар"""
+    return {
+        'city_id': city_id, 'id': str(p.get('id', '')), 'name': str(p.get('name') or "Без названия"),
+        'short_name': str(p.get('short_name', '')), 'price': float(p['price']['current']),
+        'category': str(p.get('category', '')),
+    }
+
+
+def legacy_process(index, city_id: str, products, changes: PriceChanges):
+    """Прежний PriceTracker.process: по товару за раз, ключи (город, id), значения-кортежи"""
+    for product in products:
+        key = (city_id, str(product.get('id', '')))
+        new_price = float(product.get('price', 0))
+        current = index.get(key)
+        if current is None:
+            changes.new_products += 1
+            changes.rows[key] = (new_price, new_price)
+            continue
+        old_price, last_notified = current
+        if new_price < old_price and new_price != last_notified:
+            changes.events.append((city_id, product['name'], old_price, new_price))
+            last_notified = new_price
+        elif new_price > old_price:
+            changes.increase_detected = True
+            last_notified = new_price
+        if (new_price, last_notified) != current:
+            changes.rows[key] = (new_price, last_notified)
+    return changes
+
+
+def allocated(build):
+    """Сколько байт остаётся занято объектом, который строит build()"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    obj = build()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return obj, size
+
+
+def timed(fn, repeat: int = 5) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--changed", type=float, default=0.05)
+    args = parser.parse_args()
+    loop = asyncio.new_event_loop()
+
+    for size in args.sizes:
+        base, fresh = raw_catalog(size, 0, 0), raw_catalog(size, args.changed, 1)
+        print(f"--- {size} товаров, изменилось {args.changed * 100:.0f}% цен")
+
+        dicts, dicts_bytes = allocated(lambda: [legacy_normalize(p, CITY) for p in base])
+        records, records_bytes = allocated(lambda: [normalize_product(p, CITY) for p in base])
+        print(f"пачка товаров:  словари {dicts_bytes / size:6.0f} Б/товар, Product {records_bytes / size:6.0f} Б/товар")
+
+        index, index_bytes = allocated(lambda: {
+            (CITY, p['id']): (p['price'], p['price']) for p in [legacy_normalize(p, CITY) for p in base]
+        })
+        prices, prices_bytes = allocated(lambda: CityPrices(
+            (intern_id(p.id), p.price, p.price) for p in records
+        ))
+        print(f"индекс цен:     словарь {index_bytes / size:6.0f} Б/товар, CityPrices {prices_bytes / size:6.0f} Б/товар")
+
+        new_dicts = [legacy_normalize(p, CITY) for p in fresh]
+        new_records = [normalize_product(p, CITY) for p in fresh]
+        legacy = legacy_process(index, CITY, new_dicts, PriceChanges())
+
+        tracker = PriceTracker()
+        tracker._cities, tracker._loaded = {CITY: prices}, True
+        current = loop.run_until_complete(tracker.process(CITY, new_records, PriceChanges()))
+        assert len(current.rows) == len(legacy.rows), (len(current.rows), len(legacy.rows))
+        assert len(current.drops) == len(legacy.events)
+
+        old_ms = timed(lambda: legacy_process(index, CITY, new_dicts, PriceChanges()))
+        new_ms = timed(lambda: loop.run_until_complete(tracker.process(CITY, new_records, PriceChanges())))
+        print(f"сравнение цен:  по словарям {old_ms:7.1f} мс, столбцами {new_ms:7.1f} мс "
+              f"({len(current.rows)} изменений, снижений {len(current.drops)})")
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
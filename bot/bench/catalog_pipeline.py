@@ -0,0 +1,84 @@
+"""Память и время разбора каталога: json.loads + список против потокового ijson-конвейера.
+
+Каждый вариант запускается в отдельном процессе, чтобы пиковый RSS не смешивался.
+Запуск: python bench/catalog_pipeline.py [--products 100000]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import stubs  # noqa: F401  (путь к модулям бота)
+from scraper import _batched, iter_normalized, normalize_product
+
+
+def write_fixture(path: str, products: int):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('{"products": [')
+        for i in range(products):
+            if i:
+                f.write(",")
+            json.dump({
+                "id": i,
+                "name": f"Товар {i} с достаточно длинным названием для реалистичного размера",
+                "short_name": f"Товар {i}",
+                "price": {"current": f"{1000 + i % 5000} ,00", "old": 1500 + i % 5000},
+                "category": f"Категория {i % 40}",
+                "description": "Описание товара " * 10,
+            }, f, ensure_ascii=False)
+        f.write("]}")
+
+
+def run_materialized(path: str) -> int:
+    """Прежний путь: весь ответ в память, затем полный список нормализованных товаров"""
+    with open(path, "rb") as f:
+        data = json.loads(f.read())
+    normalized = [normalize_product(p, "bench") for p in data.get("products", [])]
+    return len(normalized)
+
+
+def run_streaming(path: str) -> int:
+    count = 0
+    with open(path, "rb") as f:
+        for batch in _batched(iter_normalized(f, "bench"), 1000):
+            count += len(batch)
+    return count
+
+
+def child(variant: str, path: str):
+    started = time.perf_counter()
+    count = {"materialized": run_materialized, "streaming": run_streaming}[variant](path)
+    elapsed = time.perf_counter() - started
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({"count": count, "seconds": elapsed, "peak_rss_mb": peak_mb}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--products", type=int, default=100000)
+    parser.add_argument("--variant")
+    parser.add_argument("--fixture")
+    args = parser.parse_args()
+    if args.variant:
+        child(args.variant, args.fixture)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "catalog.json")
+        write_fixture(path, args.products)
+        print(f"фикстура: {args.products} товаров, {os.path.getsize(path) / 1024 / 1024:.1f} МБ")
+        for variant in ("materialized", "streaming"):
+            out = subprocess.run(
+                [sys.executable, __file__, "--variant", variant, "--fixture", path],
+                check=True, capture_output=True, text=True
+            ).stdout
+            result = json.loads(out.strip().splitlines()[-1])
+            print(f"{variant:<13} {result['seconds']:>6.2f} с  пиковый RSS {result['peak_rss_mb']:>7.1f} МБ")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Разрезание HTML-ответов на сообщения: свойства на случайном HTML и пропускная способность.
+
+Проверяемые свойства (для каждого limit и случайного документа):
+  * видимый текст каждой части (после разбора тегов и сущностей) не длиннее limit в UTF-16;
+  * теги в каждой части сбалансированы;
+  * склейка частей даёт исходный видимый текст (с точностью до пробелов на местах разреза).
+
+Запуск: python bench/html_splitter.py [--cases 2000] [--seed 0] [--size 1000000]
+"""
+import argparse
+import html
+import random
+import re
+import time
+
+import stubs  # noqa: F401 — добавляет src в sys.path
+from telegram_utils import split_html, split_text, utf16_len
+
+TAG_RE = re.compile(r"<\s*(/?)\s*([a-zA-Z][\w-]*)[^>]*>")
+WORDS = ["коллаген", "витамин", "Омега-3", "польза", "суставы", "кожа", "NL", "😀", "👍🏻", "&amp;", "&lt;",
+         "&gt;", "&quot;", "x" * 50, "очень" * 30]
+TAGS = ["b", "i", "u", "s", "code", "tg-spoiler"]
+
+
+def random_html(rnd: random.Random, size: int) -> str:
+    out, stack = [], []
+    for _ in range(size):
+        roll = rnd.random()
+        if roll < 0.08 and len(stack) < 4:
+            if rnd.random() < 0.3:
+                out.append(f'<a href="https://example.com/?q={rnd.randint(0, 99)}&amp;r=1">')
+                stack.append("a")
+            else:
+                tag = rnd.choice(TAGS)
+                out.append(f"<{tag}>")
+                stack.append(tag)
+        elif roll < 0.15 and stack:
+            out.append(f"</{stack.pop()}>")
+        elif roll < 0.2:
+            out.append(rnd.choice(["\n", "\n\n", ". ", "! ", "  "]))
+        else:
+            out.append(rnd.choice(WORDS) + " ")
+    out.extend(f"</{tag}>" for tag in reversed(stack))
+    return "".join(out)
+
+
+def visible(text: str) -> str:
+    return html.unescape(TAG_RE.sub("", text))
+
+
+def balanced(text: str) -> bool:
+    stack = []
+    for match in TAG_RE.finditer(text):
+        closing, name = match.groups()
+        if not closing:
+            stack.append(name)
+        elif not stack or stack.pop() != name:
+            return False
+    return not stack
+
+
+def check_properties(cases: int, seed: int):
+    rnd = random.Random(seed)
+    for case in range(cases):
+        text = random_html(rnd, rnd.randint(1, 400))
+        limit = rnd.choice([8, 16, 50, 100, 500, 4096])
+        chunks = split_html(text, limit)
+        context = f"случай {case}, limit={limit}: {text[:200]!r}"
+        for chunk in chunks:
+            assert utf16_len(visible(chunk)) <= limit, f"часть длиннее лимита, {context}"
+            assert balanced(chunk), f"несбалансированные теги {chunk!r}, {context}"
+            assert visible(chunk).strip(), f"пустая часть, {context}"
+        assert re.sub(r"\s+", "", visible("".join(chunks))) == re.sub(r"\s+", "", visible(text)), \
+            f"потерян или искажён текст, {context}"
+    print(f"свойства выполняются на {cases} случайных документах")
+
+
+def throughput(size: int):
+    rnd = random.Random(1)
+    text = random_html(rnd, size // 8)
+    for name, split in (("split_html", split_html), ("split_text (прежний)", split_text)):
+        started = time.perf_counter()
+        chunks = split(text)
+        elapsed = time.perf_counter() - started
+        print(f"{name:>22}: {len(text) / 1e6:.1f} млн символов за {elapsed:.3f} с "
+              f"({len(text) / elapsed / 1e6:.1f} млн/с), частей: {len(chunks)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--size", type=int, default=1_000_000, help="размер документа для замера, символов")
+    args = parser.parse_args()
+    check_properties(args.cases, args.seed)
+    throughput(args.size)
+
+
+if __name__ == "__main__":
+    main()
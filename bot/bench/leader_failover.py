@@ -0,0 +1,72 @@
+"""Выбор ведущей реплики: ровно один лидер из N, время переключения после падения лидера и ограждение.
+
+Нужна доступная PostgreSQL (DB_HOST/DB_PORT/...). Падение реплики имитируется завершением её сессии на сервере.
+
+Запуск: python bench/leader_failover.py [--replicas 3] [--retry 0.5]
+"""
+import argparse
+import asyncio
+import time
+
+import stubs  # noqa: F401 — добавляет src в sys.path
+from database import Database
+from leader import LeaderElection, NotLeader
+
+
+def leaders(replicas):
+    return [r for r in replicas if r.is_leader]
+
+
+async def wait_single_leader(replicas, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while len(leaders(replicas)) != 1:
+        assert time.monotonic() < deadline, "лидер не выбран"
+        await asyncio.sleep(0.01)
+    return leaders(replicas)[0]
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--replicas", type=int, default=3)
+    parser.add_argument("--retry", type=float, default=0.5, help="интервал попыток резервных реплик, с")
+    args = parser.parse_args()
+
+    name = f"bench_failover_{time.time_ns()}"
+    replicas = [LeaderElection(name, retry_interval=args.retry, check_interval=args.retry)
+                for _ in range(args.replicas)]
+    tasks = {r: asyncio.create_task(r.run()) for r in replicas}
+    db = await Database.get_instance()
+    try:
+        leader = await wait_single_leader(replicas)
+        await asyncio.sleep(args.retry * 3)
+        assert len(leaders(replicas)) == 1, "несколько лидеров одновременно"
+        await leader.ensure_fence()
+        old_token = leader.token
+
+        # Лидер «умирает»: его сессию закрывает сервер, сама реплика об этом не знает
+        tasks.pop(leader).cancel()
+        started = time.monotonic()
+        await db.execute_with_retry("SELECT pg_terminate_backend($1)", leader._conn.get_server_pid())
+        survivors = [r for r in replicas if r is not leader]
+        new_leader = await wait_single_leader(survivors)
+        failover = time.monotonic() - started
+
+        try:
+            await leader.ensure_fence()
+            raise AssertionError("устаревший лидер прошёл ограждение")
+        except NotLeader:
+            pass
+        await new_leader.ensure_fence()
+        print(f"{args.replicas} реплик: лидер один, переключение за {failover:.2f} с "
+              f"(токен {old_token} → {new_leader.token}), устаревший лидер огорожен")
+    finally:
+        for task in tasks.values():
+            task.cancel()
+        for replica in replicas:
+            await replica.close()
+        await db.execute_with_retry("DELETE FROM leader_lease WHERE name = $1", name)
+        await Database.close_instance()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,385 @@
+"""Нагрузочный прогон бота против локальных заглушек Bot API, Perplexity и каталога nlstar.
+
+Бот (роутер и main() из bot.py) запускается в отдельном процессе, чтобы его задержки, память
+и CPU не смешивались с заглушками и генератором нагрузки. Генератор подаёт поток апдейтов
+с постами в канале с заданной частотой: синтетический или записанный ранее (JSONL, по апдейту
+Telegram в строке). Апдейты уходят через getUpdates (polling) или POST на webhook.
+
+Каждый вопрос получает метку #N, заглушка Perplexity заканчивает ответ словами «Ответ #N.»:
+время от подачи апдейта до первого запроса к Bot API с этими словами — сквозная задержка.
+Повторяющиеся вопросы (--distinct меньше --updates) проверяют кэш ответов и объединение запросов.
+
+Отчёт: процентили сквозной задержки, пропускная способность, доля ответов, запросы к заглушкам
+и 429, пиковый RSS и CPU процесса бота. --max-p95 и --min-answered делают прогон проверкой
+(код выхода 1), --report сохраняет отчёт в JSON для сравнения между версиями.
+БД не нужна: бот работает без PostgreSQL (кэш ответов только в памяти).
+
+Запуск: python bench/load_test.py [--updates 200] [--rate 5] [--mode polling|webhook]
+        [--chats 1] [--distinct N] [--replay updates.jsonl] [--record updates.jsonl]
+        [--perplexity-latency 1] [--perplexity-error-rate 0.02] [--perplexity-429-rate 0.02]
+        [--telegram-latency 0.02] [--telegram-flood-rate 0.01] [--catalog-cities 2]
+        [--max-p95 10] [--min-answered 0.95] [--report out.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict, deque
+
+import aiohttp
+
+from stubs import (
+    QUESTION_MARK_RE, catalog_app, channel_post, perplexity_app, push_updates, start_server, telegram_app
+)
+
+TOPICS = (
+    "Какая польза у коллагена?", "Чем полезен омега-3?", "Как принимать витамин D?",
+    "Что выбрать для суставов?", "Подойдёт ли протеин для завтрака?", "Зачем нужен магний?",
+)
+ANSWER_MARKER_RE = re.compile(r"Ответ #(\d+)\.")
+# Тексты, которыми бот отвечает вместо ответа модели (см. bot.py и perplexity.py)
+REJECTED_TEXT = "Сейчас слишком много вопросов"
+ERROR_TEXTS = ("Произошла ошибка", "Сервер перегружен")
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def synthetic_updates(count: int, distinct: int, chats: int) -> list:
+    """Вопросы с метками #0..#distinct-1 по кругу, чаты тоже по кругу"""
+    return [
+        channel_post(i + 1, f"{TOPICS[i % distinct % len(TOPICS)]} #{i % distinct}", chat_id=-1001000000000 - i % chats)
+        for i in range(count)
+    ]
+
+
+def load_replay(path: str) -> list:
+    """Записанный поток: апдейты получают новые update_id, вопросы без метки — метку по тексту"""
+    marks = {}
+    updates = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            update = json.loads(line)
+            message = update.get("channel_post") or update.get("message")
+            if not message or not message.get("text"):
+                continue
+            if not QUESTION_MARK_RE.search(message["text"]):
+                message["text"] = f"{message['text']} #{marks.setdefault(message['text'], len(marks))}"
+            update["update_id"] = len(updates) + 1
+            updates.append(update)
+    return updates
+
+
+def schedule(updates: list, rate: float, speed: float) -> list:
+    """Смещения подачи от старта: равномерно с частотой rate или по полю date записи, ускоренному в speed раз"""
+    if speed:
+        dates = [(u.get("channel_post") or u.get("message"))["date"] for u in updates]
+        return [(d - dates[0]) / speed for d in dates]
+    return [i / rate for i in range(len(updates))]
+
+
+class Tracker:
+    """Сопоставляет ответы в Bot API с поданными апдейтами.
+
+    Ждущие апдейты хранятся по (чат, метка) в порядке подачи; ответ с меткой закрывает самый ранний.
+    Одно сообщение (чат, message_id) закрывает не больше одного апдейта: последующие правки уже
+    показанного ответа не считаются ответами на повторный вопрос.
+    """
+
+    def __init__(self):
+        self.pending = defaultdict(deque)  # (чат, метка) -> deque[(update_id, время подачи)]
+        self.latencies = []
+        self.answered_at = []
+        self.rejected = 0  # отказы из-за переполненной очереди вопросов
+        self.failed = 0  # сообщения об ошибке вместо ответа
+        self._answered_messages = set()
+        self._scanned = 0
+
+    def submitted(self, update: dict, at: float):
+        message = update.get("channel_post") or update.get("message")
+        mark = QUESTION_MARK_RE.search(message["text"])[1]
+        self.pending[(str(message["chat"]["id"]), mark)].append((update["update_id"], at))
+
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self.pending.values())
+
+    def scan(self, calls: list):
+        for at, name, params in calls[self._scanned:]:
+            if name not in ("sendMessage", "editMessageText"):
+                continue
+            text = params.get("text", "")
+            message = (params["chat_id"], params.get("message_id") or f"new-{at}")
+            found = ANSWER_MARKER_RE.search(text)
+            if not found:
+                if message not in self._answered_messages:
+                    if REJECTED_TEXT in text:
+                        self.rejected += 1
+                        self._answered_messages.add(message)
+                    elif any(error in text for error in ERROR_TEXTS):
+                        self.failed += 1
+                        self._answered_messages.add(message)
+                continue
+            queue = self.pending.get((params["chat_id"], found[1]))
+            if message in self._answered_messages or not queue:
+                continue
+            self._answered_messages.add(message)
+            _, submitted_at = queue.popleft()
+            self.latencies.append(at - submitted_at)
+            self.answered_at.append(at)
+        self._scanned = len(calls)
+
+
+class ProcessSampler:
+    """RSS и CPU процесса бота по /proc (Linux)"""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.rss = []
+
+    def rss_mb(self) -> float:
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+        return 0.0
+
+    def cpu_seconds(self) -> float:
+        with open(f"/proc/{self.pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+    async def run(self, interval: float = 0.2):
+        while True:
+            try:
+                self.rss.append(self.rss_mb())
+            except OSError:
+                return
+            await asyncio.sleep(interval)
+
+
+def percentile(ordered: list, q: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))] if ordered else float("nan")
+
+
+def child_main():
+    """Процесс бота: адреса заглушек приходят через окружение"""
+    import bot
+    import perplexity
+    from stubs import offline_db
+
+    offline_db()
+    perplexity.PerplexityAPI.BASE_URL = f"{os.environ['LOAD_PERPLEXITY_URL']}/chat/completions"
+
+    async def scrape_catalogs(interval: float):
+        """Фоновая загрузка и разбор каталогов, как в цикле цен, но без записи в БД"""
+        import scraper
+        scraper.CATALOG_URL = os.environ["LOAD_CATALOG_URL"] + "/ru/api/store/city/{city_id}/all-products/"
+        catalog_scraper = scraper.CatalogScraper(os.environ["LOAD_CATALOG_CITIES"].split(","))
+        while True:
+            for catalog in await catalog_scraper.fetch_all():
+                if catalog.changed:
+                    for _ in scraper._batched(scraper.iter_normalized(catalog.body, catalog.city_id), 1000):
+                        await asyncio.sleep(0)  # в боте между пачками идёт запись в БД
+                    catalog.body.close()
+                    catalog_scraper.remember(catalog)
+            await asyncio.sleep(interval)
+
+    async def run():
+        if os.environ.get("LOAD_CATALOG_URL"):
+            asyncio.create_task(scrape_catalogs(float(os.environ["LOAD_CATALOG_INTERVAL"])))
+        await bot.main()
+
+    asyncio.run(run())
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=5.0, help="апдейтов в секунду")
+    parser.add_argument("--mode", choices=("polling", "webhook"), default="polling")
+    parser.add_argument("--chats", type=int, default=1)
+    parser.add_argument("--distinct", type=int, help="разных вопросов (по умолчанию все разные)")
+    parser.add_argument("--replay", help="JSONL с записанными апдейтами")
+    parser.add_argument("--speed", type=float, default=0.0, help="подавать запись по её времени, ускоренному в N раз")
+    parser.add_argument("--record", help="сохранить поданный поток апдейтов в JSONL")
+    parser.add_argument("--stream", type=int, choices=(0, 1), default=1, help="PERPLEXITY_STREAM бота")
+    parser.add_argument("--perplexity-latency", type=float, default=1.0)
+    parser.add_argument("--perplexity-chunk-delay", type=float, default=0.01)
+    parser.add_argument("--perplexity-error-rate", type=float, default=0.0)
+    parser.add_argument("--perplexity-429-rate", type=float, default=0.0)
+    parser.add_argument("--telegram-latency", type=float, default=0.0)
+    parser.add_argument("--telegram-flood-rate", type=float, default=0.0)
+    parser.add_argument("--catalog-cities", type=int, default=0, help="города для фоновой загрузки каталога")
+    parser.add_argument("--catalog-products", type=int, default=5000)
+    parser.add_argument("--catalog-interval", type=float, default=5.0)
+    parser.add_argument("--grace", type=float, default=60.0, help="сколько ждать ответы после подачи, с")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE для окружения бота")
+    parser.add_argument("--log", help="файл для вывода процесса бота")
+    parser.add_argument("--max-p95", type=float)
+    parser.add_argument("--min-answered", type=float)
+    parser.add_argument("--report")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    updates = load_replay(args.replay) if args.replay else synthetic_updates(
+        args.updates, args.distinct or args.updates, args.chats
+    )
+    offsets = schedule(updates, args.rate, args.speed)
+    if args.record:
+        with open(args.record, "w", encoding="utf-8") as f:
+            for update in updates:
+                f.write(json.dumps(update, ensure_ascii=False) + "\n")
+
+    perplexity = perplexity_app(args.perplexity_latency, args.perplexity_chunk_delay, args.perplexity_error_rate,
+                                args.perplexity_429_rate, args.seed)
+    telegram = telegram_app(latency=args.telegram_latency, flood_rate=args.telegram_flood_rate, seed=args.seed)
+    catalog = catalog_app(args.catalog_products, change_rate=0.01, seed=args.seed)
+    runners = []
+    urls = {}
+    for name, app in (("perplexity", perplexity), ("telegram", telegram), ("catalog", catalog)):
+        runner, urls[name] = await start_server(app)
+        runners.append(runner)
+
+    webhook_port = free_port()
+    env = {
+        **os.environ, "BOT_TOKEN": "123456:bench", "TELEGRAM_API_URL": urls["telegram"],
+        "PERPLEXITY_API_KEY": "bench-key", "PERPLEXITY_STREAM": str(args.stream), "STREAM_EDIT_INTERVAL": "1",
+        "LOAD_PERPLEXITY_URL": urls["perplexity"], "METRICS_PORT": "0", "DB_PORT": "1", "CHANNEL_ID": "-1",
+    }
+    if args.mode == "webhook":
+        env.update({"WEBHOOK_URL": "https://bot.example.com", "WEBHOOK_HOST": "127.0.0.1",
+                    "WEBHOOK_PORT": str(webhook_port)})
+    if args.catalog_cities:
+        env.update({"LOAD_CATALOG_URL": urls["catalog"], "LOAD_CATALOG_INTERVAL": str(args.catalog_interval),
+                    "LOAD_CATALOG_CITIES": ",".join(str(1000 + i) for i in range(args.catalog_cities))})
+    env.update(item.split("=", 1) for item in args.env)
+    log = open(args.log, "w") if args.log else tempfile.NamedTemporaryFile("w", prefix="load_test_", suffix=".log",
+                                                                           delete=False)
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child"], env=env,
+                             stdout=log, stderr=subprocess.STDOUT)
+    sampler = ProcessSampler(child.pid)
+    tracker = Tracker()
+    acks = []
+    try:
+        ready_call = "setWebhook" if args.mode == "webhook" else "getUpdates"
+        deadline = time.monotonic() + 60
+        while not any(name == ready_call for _, name, _ in telegram["calls"]):
+            assert child.poll() is None and time.monotonic() < deadline, f"бот не запустился, лог: {log.name}"
+            await asyncio.sleep(0.05)
+        sampling = asyncio.create_task(sampler.run())
+        rss_before, cpu_before = sampler.rss_mb(), sampler.cpu_seconds()
+
+        async with aiohttp.ClientSession() as session:
+            async def post(update: dict):
+                started = time.monotonic()
+                async with session.post(f"http://127.0.0.1:{webhook_port}/webhook", json=update) as response:
+                    await response.read()
+                acks.append(time.monotonic() - started)
+
+            posts = set()
+            started = time.monotonic()
+            for update, offset in zip(updates, offsets):
+                await asyncio.sleep(max(0.0, started + offset - time.monotonic()))
+                tracker.submitted(update, time.monotonic())
+                if args.mode == "webhook":
+                    task = asyncio.create_task(post(update))
+                    posts.add(task)
+                    task.add_done_callback(posts.discard)
+                else:
+                    push_updates(telegram, [update])
+                tracker.scan(telegram["calls"])
+            submitted_in = time.monotonic() - started
+            await asyncio.gather(*posts)
+
+            deadline = time.monotonic() + args.grace
+            while tracker.waiting() and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+                tracker.scan(telegram["calls"])
+        cpu = sampler.cpu_seconds() - cpu_before
+        sampling.cancel()
+    finally:
+        if child.poll() is None:
+            child.send_signal(signal.SIGTERM)
+            try:
+                child.wait(30)
+            except subprocess.TimeoutExpired:
+                child.kill()
+        log.close()
+        for runner in runners:
+            await runner.cleanup()
+
+    ordered = sorted(tracker.latencies)
+    answered = len(ordered)
+    methods = Counter(name for _, name, _ in telegram["calls"])
+    report = {
+        "updates": len(updates),
+        "submitted_in": submitted_in,
+        "answered": answered,
+        "answered_share": answered / len(updates) if updates else 0.0,
+        "rejected": tracker.rejected,
+        "failed": tracker.failed,
+        "latency": {
+            "p50": percentile(ordered, 0.5), "p90": percentile(ordered, 0.9), "p95": percentile(ordered, 0.95),
+            "p99": percentile(ordered, 0.99), "max": ordered[-1] if ordered else float("nan"),
+            "mean": statistics.fmean(ordered) if ordered else float("nan"),
+        },
+        "throughput": answered / (max(tracker.answered_at) - started) if answered else 0.0,
+        "webhook_ack_p95": percentile(sorted(acks), 0.95) if acks else None,
+        "telegram_calls": dict(methods),
+        "telegram_429": telegram["flood"],
+        "perplexity": {"calls": perplexity["calls"], "errors": perplexity["errors"],
+                       "rate_limited": perplexity["rate_limited"]},
+        "catalog_requests": catalog["requests"],
+        "rss_mb": {"before": rss_before, "peak": max(sampler.rss or [rss_before]),
+                   "after": sampler.rss[-1] if sampler.rss else rss_before},
+        "cpu_seconds": cpu,
+        "log": log.name,
+    }
+
+    latency = report["latency"]
+    print(f"Апдейтов: {report['updates']} за {submitted_in:.1f} с ({args.mode}), "
+          f"отвечено: {answered} ({report['answered_share'] * 100:.1f}%), отказов из-за очереди: {tracker.rejected}, "
+          f"ошибок: {tracker.failed}")
+    print(f"Сквозная задержка: p50 {latency['p50']:.2f} с, p90 {latency['p90']:.2f} с, p95 {latency['p95']:.2f} с, "
+          f"p99 {latency['p99']:.2f} с, макс. {latency['max']:.2f} с")
+    print(f"Пропускная способность: {report['throughput']:.2f} ответов/с")
+    if report["webhook_ack_p95"] is not None:
+        print(f"Подтверждение webhook: p95 {report['webhook_ack_p95'] * 1000:.1f} мс")
+    print(f"Bot API: {', '.join(f'{k} {v}' for k, v in methods.most_common())}; 429: {telegram['flood']}")
+    print(f"Perplexity: {perplexity['calls']} запросов, 500: {perplexity['errors']}, 429: {perplexity['rate_limited']}; "
+          f"каталог: {catalog['requests']} запросов")
+    print(f"Процесс бота: RSS {report['rss_mb']['before']:.0f} → пик {report['rss_mb']['peak']:.0f} МБ, "
+          f"CPU {cpu:.2f} с; лог: {log.name}")
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    failures = []
+    if args.max_p95 is not None and not latency["p95"] <= args.max_p95:
+        failures.append(f"p95 {latency['p95']:.2f} с больше {args.max_p95} с")
+    if args.min_answered is not None and report["answered_share"] < args.min_answered:
+        failures.append(f"отвечено {report['answered_share'] * 100:.1f}% меньше {args.min_answered * 100:.0f}%")
+    if failures:
+        print("ПРОВАЛ: " + "; ".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--child"]:
+        child_main()
+    else:
+        asyncio.run(main())
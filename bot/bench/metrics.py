@@ -0,0 +1,111 @@
+"""Метрики Prometheus: накладные расходы на горячем пути и содержимое /metrics.
+
+Сначала меряется стоимость одного измерения (декоратор обработчика, время запроса к БД,
+задержка event loop), затем бот запускается с заглушками Telegram и Perplexity, отвечает
+на вопрос из канала, и скрипт проверяет, что нужные серии появились в /metrics.
+
+Запуск: python bench/metrics.py [--calls 200000] [--max-overhead-us 20]
+"""
+import argparse
+import asyncio
+import os
+import socket
+import time
+
+import aiohttp
+
+from stubs import channel_post, offline_db, perplexity_app, start_server, telegram_app
+
+ANSWER_TAIL = "NL INTERNATIONAL"
+EXPECTED = (
+    'bot_perplexity_seconds_count{stage="first_token"} 1.0',
+    'bot_perplexity_requests_total{result="ok"} 1.0',
+    'bot_handler_seconds_count{handler="channel_post"} 1.0',
+    'bot_handler_seconds_count{handler="answer_question"} 1.0',
+    "bot_event_loop_lag_seconds_count",
+    "bot_questions_active",
+)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def overhead(calls: int) -> float:
+    import metrics
+
+    async def handler(value):
+        return value
+
+    timed = metrics.timed_handler("bench")(handler)
+    query = "BENCH 1"  # отдельная серия, не смешивается с запросами бота
+    results = {}
+    for label, fn in (("обработчик без декоратора", lambda: handler(1)), ("обработчик с timed_handler", lambda: timed(1))):
+        started = time.perf_counter()
+        for _ in range(calls):
+            await fn()
+        results[label] = (time.perf_counter() - started) / calls * 1e6
+    started = time.perf_counter()
+    for _ in range(calls):
+        metrics.observe_db_query(query, 0.001)
+    results["observe_db_query"] = (time.perf_counter() - started) / calls * 1e6
+    started = time.perf_counter()
+    for _ in range(calls):
+        metrics.EVENT_LOOP_LAG.observe(0.0001)
+    results["задержка event loop"] = (time.perf_counter() - started) / calls * 1e6
+    for label, us in results.items():
+        print(f"{label:<28} {us:6.2f} мкс на вызов")
+    return max(results["обработчик с timed_handler"] - results["обработчик без декоратора"],
+               results["observe_db_query"], results["задержка event loop"])
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=200000)
+    parser.add_argument("--max-overhead-us", type=float, default=20.0)
+    args = parser.parse_args()
+
+    worst = await overhead(args.calls)
+    assert worst < args.max_overhead_us, f"измерение стоит {worst:.1f} мкс"
+
+    perplexity_runner, perplexity_url = await start_server(perplexity_app(latency=0.1))
+    telegram = telegram_app([channel_post(1, "Какая польза у коллагена?")])
+    telegram_runner, telegram_url = await start_server(telegram)
+    port = free_port()
+    os.environ.update({
+        "BOT_TOKEN": "123456:bench", "TELEGRAM_API_URL": telegram_url, "PERPLEXITY_API_KEY": "bench-key",
+        "STREAM_EDIT_INTERVAL": "0.1", "METRICS_PORT": str(port), "DB_PORT": "1",
+    })
+
+    import bot
+    import perplexity
+    offline_db()
+    perplexity.PerplexityAPI.BASE_URL = f"{perplexity_url}/chat/completions"
+
+    main_task = asyncio.create_task(bot.main())
+    try:
+        while not any(name == "editMessageText" and ANSWER_TAIL in params.get("text", "")
+                      for _, name, params in telegram["calls"]):
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(0.2)  # дожидаемся выхода из обработчиков
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{port}/metrics") as response:
+                assert response.status == 200, f"/metrics ответил {response.status}"
+                text = await response.text()
+    finally:
+        main_task.cancel()
+        await asyncio.gather(main_task, return_exceptions=True)
+        await telegram_runner.cleanup()
+        await perplexity_runner.cleanup()
+
+    for line in text.splitlines():
+        if line.startswith("bot_") and ("_count" in line or "_total" in line or "questions" in line):
+            print(line)
+    missing = [series for series in EXPECTED if series not in text]
+    assert not missing, f"в /metrics нет серий: {missing}"
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,72 @@
+"""Пропускная способность Perplexity-клиента: run_in_executor(ask) против ask_async.
+
+Ограничитель частоты запросов к API (PERPLEXITY_RATE_PER_MIN) по умолчанию снят, иначе
+замер показывает его лимит, а не клиент; --rate-per-min N включает ограничение N запросов в минуту.
+
+Запуск: python bench/perplexity_client.py [--latency 0.05] [--questions 200] [--rate-per-min 0]
+"""
+import argparse
+import asyncio
+import time
+
+from stubs import offline_db, perplexity_app, start_server
+from concurrency import TokenBucket
+from config import PERPLEXITY_BURST
+from perplexity import PerplexityAPI
+
+UNLIMITED = 1e9  # столько токенов не набрать ни одним замером
+
+
+async def run_executor(api: PerplexityAPI, questions: int, concurrency: int) -> float:
+    loop = asyncio.get_running_loop()
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with sem:
+            await loop.run_in_executor(None, api.ask, f"вопрос {concurrency} {i}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(questions)))
+    return questions / (time.perf_counter() - started)
+
+
+async def run_async(api: PerplexityAPI, questions: int, concurrency: int) -> float:
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with sem:
+            await api.ask_async(f"вопрос {concurrency} {i}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(questions)))
+    return questions / (time.perf_counter() - started)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--rate-per-min", type=float, default=0, help="0 — без ограничения частоты")
+    args = parser.parse_args()
+
+    offline_db()
+    runner, base_url = await start_server(perplexity_app(args.latency))
+    api = PerplexityAPI("bench-key")
+    api.BASE_URL = f"{base_url}/chat/completions"
+    if args.rate_per_min:
+        api.rate_limiter = TokenBucket(args.rate_per_min / 60, PERPLEXITY_BURST)
+    else:
+        api.rate_limiter = TokenBucket(UNLIMITED, UNLIMITED)
+    try:
+        print(f"{'concurrency':>11} | {'executor q/s':>12} | {'async q/s':>10}")
+        for concurrency in (1, 10, 100):
+            executor_qps = await run_executor(api, args.questions, concurrency)
+            async_qps = await run_async(api, args.questions, concurrency)
+            print(f"{concurrency:>11} | {executor_qps:>12.1f} | {async_qps:>10.1f}")
+    finally:
+        await api.close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
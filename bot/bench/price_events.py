@@ -0,0 +1,186 @@
+"""Конвейер событий цен: поиск подписчиков изменившихся товаров и доставка по приёмникам.
+
+В отдельной схеме events_bench создаются подписки, затем для прохода с --changes снижениями
+меряется поиск подписчиков по индексу price_watch_product_idx при разном числе подписок
+(против чтения всех подписок), после чего проход публикуется в конвейер с заглушкой Bot API:
+в канал уходит один пост с закреплением, каждому подписчику — одно личное сообщение,
+изменения записываются в price_events. Затем проверяется, что снижение не теряется, если
+пост в канал не закрепился: состояние цены не продвигается, и следующий проход отправляет его снова.
+Схема удаляется после прогона.
+
+Нужна локальная БД (переменные DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD).
+Запуск: python bench/price_events.py [--products 20000] [--subscriptions 10000,100000,1000000] [--changes 200]
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+
+from stubs import start_server, telegram_app
+
+SCHEMA = "events_bench"
+CHANNEL_ID = -1001234567890
+
+
+async def subscribe(db, products: int, subscriptions: int, per_user: int):
+    """Дописывает подписки до subscriptions: у пользователя per_user случайных товаров"""
+    have = await db.pool.fetchval("SELECT count(*) FROM price_watch")
+    await db.pool.execute("""
+        INSERT INTO price_watch (user_id, product_id, threshold)
+        SELECT n / $3, 'p' || (hashtextextended(n::text, 0) % $1 + $1) % $1, (n % 4) * 5
+        FROM generate_series($2::bigint, $4 - 1) n
+        ON CONFLICT DO NOTHING
+    """, products, have, per_user, subscriptions, timeout=3600)
+    await db.pool.execute("ANALYZE price_watch", timeout=600)
+
+
+def make_events(products: int, changes: int, seed: int = 1):
+    from price_events import PriceChange
+    rng = random.Random(seed)
+    events = []
+    for product in rng.sample(range(products), changes):
+        old = 1000.0
+        events.append(PriceChange("2214", f"p{product}", f"Товар {product}", old, old * rng.uniform(0.7, 0.99), True))
+    return events
+
+
+async def timed(fn, calls: int) -> float:
+    timings = []
+    for _ in range(calls):
+        started = time.perf_counter()
+        await fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--products", type=int, default=20000)
+    parser.add_argument("--subscriptions", default="10000,100000,1000000")
+    parser.add_argument("--per-user", type=int, default=10)
+    parser.add_argument("--changes", type=int, default=200)
+    parser.add_argument("--calls", type=int, default=20)
+    args = parser.parse_args()
+
+    telegram = telegram_app()
+    telegram_runner, telegram_url = await start_server(telegram)
+    os.environ.update({
+        "BOT_TOKEN": "123456:bench", "TELEGRAM_API_URL": telegram_url,
+        "TELEGRAM_GLOBAL_RATE": "100000", "TELEGRAM_COALESCE_WINDOW": "0.1",
+    })
+    import database
+    params = database.connection_params()
+    database.connection_params = lambda: {**params, "server_settings": {"search_path": SCHEMA}}
+    setup = database.Database()
+    await setup.connect()
+    await setup.execute_with_retry(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    await setup.execute_with_retry(f"CREATE SCHEMA {SCHEMA}")
+    await setup.close()
+
+    import bot
+    from price_events import ChannelSink, PriceEventPipeline, WatchlistSink, store_price_events
+    db = await database.Database.get_instance()
+    try:
+        events = make_events(args.products, args.changes)
+        drops = {event.product_id for event in events}
+        for subscriptions in (int(n) for n in args.subscriptions.split(",")):
+            await subscribe(db, args.products, subscriptions, args.per_user)
+
+            async def by_index():
+                await db.load_watchers(drops)
+
+            async def full_scan():
+                # Прежний подход «все подписки × все изменения»: чтение всей таблицы и фильтр в Python
+                rows = await db.pool.fetch("SELECT product_id, user_id, threshold FROM price_watch")
+                [row for row in rows if row[0] in drops]
+
+            print(f"{subscriptions:>8} подписок, {args.changes} изменений: "
+                  f"по индексу {await timed(by_index, args.calls):7.2f} мс, "
+                  f"перебор всех подписок {await timed(full_scan, 3):8.2f} мс")
+
+        watchers = await db.load_watchers(drops)
+        expected_users = {
+            user_id for event in events for user_id, threshold in watchers.get(event.product_id, ())
+            if event.drop_percent >= threshold
+        }
+
+        telegram_bot = bot.create_bot()
+        pipeline = PriceEventPipeline()
+
+        async def fence():
+            pass
+
+        pipeline.add_sink("channel", ChannelSink(telegram_bot, CHANNEL_ID, fence))
+        pipeline.add_sink("watchlist", WatchlistSink(telegram_bot))
+        pipeline.add_sink("db", store_price_events)
+        pipeline.start()
+        started = time.perf_counter()
+        await pipeline.publish(events)
+        published = time.perf_counter() - started
+        await pipeline.close(600)
+        delivered = time.perf_counter() - started
+        await telegram_bot.session.close()
+
+        sent = [params for _, name, params in telegram["calls"] if name == "sendMessage"]
+        channel = [params for params in sent if params["chat_id"] == str(CHANNEL_ID)]
+        direct = {params["chat_id"] for params in sent if params["chat_id"] != str(CHANNEL_ID)}
+        pinned = sum(1 for _, name, _ in telegram["calls"] if name == "pinChatMessage")
+        stored = await db.pool.fetchval("SELECT count(*) FROM price_events")
+        print(f"Публикация прохода {published * 1000:.1f} мс, доставка всем приёмникам {delivered:.1f} с: "
+              f"в канал {len(channel)} сообщ. (закреплено {pinned}), личных сообщений {len(direct)} "
+              f"(ожидалось {len(expected_users)}), в price_events {stored} строк")
+        assert len(channel) >= 1 and pinned == 1, "нет поста в канале"
+        assert direct == {str(user) for user in expected_users}, "уведомления получили не те подписчики"
+        assert stored == len(events), "в price_events записаны не все изменения"
+
+        # --- Пост о снижении не закрепился: снижение обнаруживается и отправляется повторно ---
+        from catalog import Product
+        from price_tracker import PriceChanges, PriceTracker
+        tracker = PriceTracker()
+        telegram_bot = bot.create_bot()
+
+        def catalog(price: float):
+            return [Product("2214", f"p{i}", f"Товар {i}", f"T{i}", price if i == 0 else 1000.0, "cat") for i in range(10)]
+
+        async def scrape_pass(price: float, before_delivery=None):
+            pipeline = PriceEventPipeline()
+            pipeline.add_sink("channel", ChannelSink(
+                telegram_bot, CHANNEL_ID, fence,
+                on_delivered=tracker.confirm_notified, on_failed=tracker.release_notified
+            ))
+            pipeline.start()
+            changes = await tracker.process("2214", catalog(price), PriceChanges())
+            await pipeline.publish(changes.events)
+            await tracker.commit(changes)
+            overlapping = await before_delivery() if before_delivery else None
+            await pipeline.close(60)
+            state = await db.pool.fetchval("SELECT last_notified_price FROM price_state WHERE product_id = 'p0'")
+            return len(changes.drops), state, overlapping
+
+        async def next_pass():
+            # Следующий проход, пока пост ещё не подтверждён: то же снижение не отправляется второй раз
+            return len((await tracker.process("2214", catalog(900.0), PriceChanges())).drops)
+
+        await scrape_pass(1000.0)
+        pins = sum(1 for _, name, _ in telegram["calls"] if name == "pinChatMessage")
+        telegram["failing"].add("pinChatMessage")
+        failed = await scrape_pass(900.0)
+        telegram["failing"].clear()
+        retried = await scrape_pass(900.0, next_pass)
+        settled = await scrape_pass(900.0)
+        await telegram_bot.session.close()
+        pins = sum(1 for _, name, _ in telegram["calls"] if name == "pinChatMessage") - pins
+        print(f"Сбой закрепления: снижений/last_notified p0 — при сбое {failed[:2]}, "
+              f"в следующем проходе {retried[:2]} (параллельный проход до подтверждения: {retried[2]}), "
+              f"затем {settled[:2]}; попыток закрепления {pins}")
+        assert failed[:2] == (1, 1000) and retried == (1, 900, 0) and settled[:2] == (0, 900) and pins == 2
+    finally:
+        await db.execute_with_retry(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        await database.Database.close_instance()
+        await telegram_runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,111 @@
+"""История цен товара за 90 дней на 10 млн точек: прежняя таблица против секционированной.
+
+Скрипт создаёт price_history прежнего формата (SERIAL id, FLOAT, без индекса) в отдельной
+схеме price_bench, меряет запрос истории товара, переносит данные через Database.create_tables()
+и повторяет замер на секционированной таблице, затем меряет обслуживание (свёртка и удаление секций).
+Схема удаляется после прогона.
+
+Нужна локальная БД (переменные DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD).
+Запуск: python bench/price_history.py [--rows 10000000] [--products 20000] [--queries 200]
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+import stubs  # noqa: F401  (путь к модулям бота)
+import database
+from database import Database
+
+SCHEMA = "price_bench"
+HISTORY_DAYS = 365
+
+LEGACY_QUERY = """
+    SELECT recorded_at, price FROM price_history
+    WHERE product_id = $2 AND city_id = $1 AND recorded_at >= CURRENT_TIMESTAMP - make_interval(days => $3)
+    ORDER BY recorded_at
+"""
+
+
+async def fill_legacy(db: Database, rows: int, products: int):
+    """Прежний формат: точки товаров равномерно за год, цена меняется почти в каждой точке"""
+    await db.execute_with_retry("""
+        CREATE TABLE price_history (
+            id SERIAL PRIMARY KEY,
+            city_id VARCHAR(20) NOT NULL,
+            product_id VARCHAR(50) NOT NULL,
+            price FLOAT NOT NULL,
+            recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    points = rows // products
+    await db.pool.execute("""
+        INSERT INTO price_history (city_id, product_id, price, recorded_at)
+        SELECT '2214', 'p' || p, 500 + (n * 7919 + p) % 1000 + 0.5,
+               CURRENT_TIMESTAMP - make_interval(secs => $3 * 86400.0 * (n + p::float / $1) / $2)
+        FROM generate_series(0, $1 - 1) p, generate_series(0, $2 - 1) n
+    """, products, points, HISTORY_DAYS, timeout=3600)
+    await db.pool.execute("ANALYZE price_history", timeout=600)
+
+
+async def measure_queries(label: str, fetch, products: int, queries: int):
+    timings = []
+    found = 0
+    for _ in range(queries):
+        product_id = f"p{random.randrange(products)}"
+        started = time.perf_counter()
+        found += len(await fetch("2214", product_id, 90))
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    print(f"{label:<30} медиана {statistics.median(timings):8.2f} мс, "
+          f"p95 {timings[int(len(timings) * 0.95) - 1]:8.2f} мс, точек в ответе ср. {found / queries:.0f}")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--products", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--legacy-queries", type=int, default=10)
+    parser.add_argument("--retention-days", type=int, default=180)
+    args = parser.parse_args()
+
+    params = database.connection_params()
+    database.connection_params = lambda: {**params, "server_settings": {"search_path": SCHEMA}}
+    db = Database()
+    await db.connect()
+    await db.execute_with_retry(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    await db.execute_with_retry(f"CREATE SCHEMA {SCHEMA}")
+    try:
+        started = time.perf_counter()
+        await fill_legacy(db, args.rows, args.products)
+        print(f"Прежняя таблица: {args.rows} точек за {time.perf_counter() - started:.0f} с")
+
+        async def legacy_fetch(city_id, product_id, days):
+            return await db.pool.fetch(LEGACY_QUERY, city_id, product_id, days, timeout=600)
+        await measure_queries("прежняя таблица", legacy_fetch, args.products, args.legacy_queries)
+
+        started = time.perf_counter()
+        await db.create_tables()
+        count = await db.pool.fetchval("SELECT count(*) FROM price_history", timeout=600)
+        print(f"Перенос в секционированную таблицу: {count} точек за {time.perf_counter() - started:.0f} с")
+        await db.pool.execute("ANALYZE price_history", timeout=600)
+        await measure_queries("секционированная таблица", db.load_price_history, args.products, args.queries)
+
+        started = time.perf_counter()
+        rolled, dropped = await db.maintain_price_history(args.retention_days)
+        print(f"Обслуживание: {rolled} дневных агрегатов, удалено секций {len(dropped)} "
+              f"за {time.perf_counter() - started:.1f} с")
+        started = time.perf_counter()
+        rolled, dropped = await db.maintain_price_history(args.retention_days)
+        print(f"Повторное обслуживание в тот же день: {rolled} агрегатов за {time.perf_counter() - started:.3f} с")
+        await measure_queries("после удаления секций", db.load_price_history, args.products, args.queries)
+        await measure_queries("дневные агрегаты", db.load_daily_prices, args.products, args.queries)
+    finally:
+        await db.execute_with_retry(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        await db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
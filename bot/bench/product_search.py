@@ -0,0 +1,66 @@
+"""Время поиска товаров для контекста промпта: индекс BM25 против прежнего линейного поиска подстроки.
+
+Запуск: python bench/product_search.py [--sizes 1000 10000 50000] [--queries 200]
+"""
+import argparse
+import random
+import time
+
+import stubs  # noqa: F401 — добавляет src в sys.path
+from catalog import Product
+from product_index import ProductIndex
+
+SYLLABLES = ["ко", "ла", "ген", "ме", "га", "ви", "та", "мин", "каль", "ций", "маг", "ний", "шо", "кок",
+             "тейль", "про", "би", "о", "тик", "же", "ле", "зо", "цинк", "се", "лен", "нер", "ги", "я"]
+# Словарь реалистичного размера: слова каталога в основном редкие, как в настоящих описаниях
+_rnd = random.Random(42)
+WORDS = sorted({"".join(_rnd.choices(SYLLABLES, k=_rnd.randint(2, 4))) for _ in range(20000)})
+
+
+def make_catalog(size: int):
+    rnd = random.Random(size)
+    return [Product(
+        city_id="bench",
+        id=str(i),
+        name=f"{rnd.choice(WORDS).capitalize()} {rnd.choice(WORDS)} {i}",
+        short_name=" ".join(rnd.choices(WORDS, k=12)),
+        category=rnd.choice(WORDS),
+    ) for i in range(size)]
+
+
+def linear_search(products, query: str):
+    """Прежний поиск: подстрока запроса в тексте товара"""
+    query_l = query.lower()
+    return [p for p in products
+            if query_l in (p.name + ' ' + p.short_name + ' ' + p.category).lower()]
+
+
+def measure(fn, queries):
+    started = time.perf_counter()
+    for q in queries:
+        fn(q)
+    return (time.perf_counter() - started) / len(queries) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    queries = [f"Какая польза у {rnd.choice(WORDS)}а для {rnd.choice(WORDS)}?" for _ in range(args.queries)]
+    print(f"{'товаров':>8} {'построение, с':>14} {'индекс, мс':>11} {'линейно, мс':>12}")
+    for size in args.sizes:
+        catalog = make_catalog(size)
+        index = ProductIndex()
+        started = time.perf_counter()
+        index.upsert(catalog)
+        build = time.perf_counter() - started
+        indexed = measure(index.search, queries)
+        linear = measure(lambda q: linear_search(catalog, q), queries)
+        print(f"{size:>8} {build:>14.2f} {indexed:>11.3f} {linear:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
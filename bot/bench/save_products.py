@@ -0,0 +1,80 @@
+"""Скорость записи каталога в PostgreSQL: построчные INSERT против пакетного слияния через COPY.
+
+Нужна локальная БД (переменные DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD).
+Запуск: python bench/save_products.py [--products 2000]
+"""
+import argparse
+import asyncio
+import random
+import time
+
+import stubs  # noqa: F401  (путь к модулям бота)
+from catalog import Product
+from database import Database
+
+
+async def legacy_save(db: Database, products):
+    """Прежний путь: два отдельных запроса в autocommit на каждый товар"""
+    for p in products:
+        await db.execute_with_retry("""
+            INSERT INTO products (city_id, id, name, short_name, price, category)
+            VALUES ($1, $2, $3, $4, $5, $6)
+            ON CONFLICT (city_id, id) DO UPDATE SET
+                name = EXCLUDED.name,
+                short_name = EXCLUDED.short_name,
+                price = EXCLUDED.price,
+                category = EXCLUDED.category,
+                updated_at = CURRENT_TIMESTAMP
+        """, *p.as_row())
+        await db.execute_with_retry(
+            "INSERT INTO price_history (city_id, product_id, price) VALUES ($1, $2, $3)",
+            p.city_id, p.id, p.price
+        )
+
+
+def catalog(n: int, changed_share: float):
+    return [
+        Product(
+            city_id="bench",
+            id=f"bench-{i}",
+            name=f"Товар {i}",
+            short_name=f"T{i}",
+            price=1000.0 + i - (100.0 if random.random() < changed_share else 0.0),
+            category=f"cat-{i % 20}",
+        )
+        for i in range(n)
+    ]
+
+
+async def cleanup(db: Database):
+    await db.execute_with_retry("DELETE FROM price_history WHERE product_id LIKE 'bench-%'")
+    await db.execute_with_retry("DELETE FROM products WHERE id LIKE 'bench-%'")
+
+
+async def measure(label: str, fn, products):
+    started = time.perf_counter()
+    await fn(products)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<34} {len(products) / elapsed:>10.0f} строк/с  ({elapsed:.2f} с)")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--products", type=int, default=2000)
+    args = parser.parse_args()
+
+    db = await Database.get_instance()
+    await cleanup(db)
+    try:
+        await measure("построчно, первая загрузка", lambda p: legacy_save(db, p), catalog(args.products, 0))
+        await measure("построчно, 5% цен изменилось", lambda p: legacy_save(db, p), catalog(args.products, 0.05))
+        await cleanup(db)
+        await measure("пакетно, первая загрузка", db.save_products, catalog(args.products, 0))
+        await measure("пакетно, 5% цен изменилось", db.save_products, catalog(args.products, 0.05))
+    finally:
+        await cleanup(db)
+        await Database.close_instance()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,110 @@
+"""Расписание проверки цен: фиксированный CHECK_INTERVAL против адаптивного ScrapeScheduler.
+
+Месяц моделируется в виртуальном времени, без сети и БД. Цены в городе меняются короткими
+акциями (товар дешевеет на --promo-hours часов и возвращается к прежней цене): в первые дни
+месяца идёт распродажа с частыми акциями, в остальное время акции редкие. Несколько часов
+каталог недоступен. Для каждой стратегии считается, сколько было запросов к каталогу,
+сколько акций проверка застала и как быстро после начала акции она была замечена.
+
+Запуск: python bench/scrape_schedule.py [--days 30] [--promo-hours 3] [--windows "1-3 * 00:00-24:00 1800"]
+"""
+import argparse
+import random
+import statistics
+from datetime import datetime, timedelta
+
+import stubs  # noqa: F401  (путь к модулям бота)
+from scrape_schedule import ScrapeScheduler, parse_windows
+
+CITY = "2214"
+
+
+def make_promos(start: float, days: int, promo_hours: float, sale_days: int, seed: int):
+    """Акции (начало, конец): в дни распродажи — раз в 1–3 часа, потом — раз в 1–3 дня"""
+    rng = random.Random(seed)
+    promos, t, end = [], start, start + days * 86400
+    while t < end:
+        in_sale = (t - start) < sale_days * 86400
+        t += rng.uniform(3600, 3 * 3600) if in_sale else rng.uniform(86400, 3 * 86400)
+        promos.append((t, t + promo_hours * 3600))
+    return [promo for promo in promos if promo[0] < end]
+
+
+def simulate(next_check, on_result, start: float, days: int, promos, outages):
+    """Прогон стратегии: next_check(now) -> время следующей проверки, on_result(now, ok, changes)"""
+    now, end = start, start + days * 86400
+    requests = failures = 0
+    seen_state = frozenset()
+    detected = {}
+    while now < end:
+        requests += 1
+        if any(a <= now < b for a, b in outages):
+            failures += 1
+            on_result(now, False, 0)
+        else:
+            state = frozenset(i for i, (a, b) in enumerate(promos) if a <= now < b)
+            for i in state:
+                detected.setdefault(i, now - promos[i][0])
+            on_result(now, True, len(state ^ seen_state))
+            seen_state = state
+        now = max(now + 1, next_check(now))
+    return requests, failures, detected
+
+
+def report(label: str, promos, result):
+    requests, failures, detected = result
+    latencies = sorted(detected.values())
+    print(f"{label:<34} запросов {requests:5d} (ошибок {failures:3d}), акций замечено "
+          f"{len(detected):3d} из {len(promos)}"
+          + (f", через {statistics.median(latencies) / 60:5.0f} мин (медиана)" if latencies else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--sale-days", type=int, default=3)
+    parser.add_argument("--promo-hours", type=float, default=3)
+    parser.add_argument("--interval", type=float, default=18000)
+    parser.add_argument("--min-interval", type=float, default=900)
+    parser.add_argument("--max-interval", type=float, default=43200)
+    parser.add_argument("--windows", default="1-3 * 00:00-24:00 1800")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    start = datetime(2024, 7, 1).timestamp()
+    promos = make_promos(start, args.days, args.promo_hours, args.sale_days, args.seed)
+    outages = [(start + 10 * 86400 + 12 * 3600, start + 10 * 86400 + 16 * 3600)]
+
+    fixed = simulate(lambda now: now + args.interval, lambda now, ok, changes: None,
+                     start, args.days, promos, outages)
+    report(f"фиксированный интервал {args.interval / 3600:.0f} ч", promos, fixed)
+
+    for label, windows in (("адаптивный", []), ("адаптивный + окна распродажи", parse_windows(args.windows))):
+        scheduler = ScrapeScheduler([CITY], args.interval, args.min_interval, args.max_interval, windows=windows)
+        retries = []
+
+        def on_result(now, ok, changes):
+            if ok:
+                scheduler.record_success(CITY, changes, now)
+            else:
+                scheduler.record_failure(CITY, now)
+                retries.append(scheduler.cities[CITY].next_due - now)
+
+        result = simulate(lambda now: scheduler.cities[CITY].next_due, on_result, start, args.days, promos, outages)
+        report(label, promos, result)
+        print(f"{'':<34} задержки повторов после ошибок: {', '.join(f'{r:.0f}' for r in retries)} с")
+
+    # Окно открывается посреди длинного интервала: проверка подтягивается к его началу
+    windows = parse_windows("* * 09:00-10:00 600")
+    scheduler = ScrapeScheduler([CITY], args.interval, args.min_interval, args.max_interval, windows=windows, jitter=0)
+    morning = datetime(2024, 7, 2, 7, 0).timestamp()
+    scheduler.record_success(CITY, 0, morning)
+    first = datetime.fromtimestamp(scheduler.cities[CITY].next_due)
+    scheduler.record_success(CITY, 0, first.timestamp())
+    second = datetime.fromtimestamp(scheduler.cities[CITY].next_due)
+    print(f"окно 09:00-10:00 по 600 с: после проверки в 07:00 следующие в {first:%H:%M} и {second:%H:%M}")
+    assert first == datetime(2024, 7, 2, 9, 0) and second - first == timedelta(seconds=600)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""N одновременных одинаковых вопросов должны дать ровно один запрос к API.
+
+Запуск: python bench/singleflight.py [--posts 50]
+"""
+import argparse
+import asyncio
+import time
+
+from stubs import offline_db, perplexity_app, start_server
+from perplexity import PerplexityAPI
+from text_utils import normalize_query
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=50)
+    args = parser.parse_args()
+
+    offline_db()
+    app = perplexity_app(latency=0.2)
+    runner, base_url = await start_server(app)
+    api = PerplexityAPI("bench-key")
+    api.BASE_URL = f"{base_url}/chat/completions"
+    try:
+        # Формулировки отличаются регистром, пунктуацией и служебными словами, но нормализуются в один ключ
+        questions = ["Какая польза у коллагена?", "какая ПОЛЬЗА коллагена", "Какая же польза у коллагена!"]
+        started = time.perf_counter()
+        answers = await asyncio.gather(*(api.ask_async(questions[i % len(questions)]) for i in range(args.posts)))
+        elapsed = time.perf_counter() - started
+
+        assert len(set(answers)) == 1, "ответы разошлись"
+        assert app["calls"] == 1, f"ожидался 1 запрос к API, получено {app['calls']}"
+        print(f"{args.posts} вопросов за {elapsed:.3f} с, запросов к API: {app['calls']}, "
+              f"присоединились: {api.inflight.joined}")
+
+        # Вопросы об одном и том же, но разные по смыслу, не делят ни ключ, ни запрос к API
+        different = ["Как принимать коллаген?", "Когда принимать коллаген?",
+                     "С чем принимать коллаген?", "Можно ли принимать коллаген?"]
+        keys = {normalize_query(question) for question in different}
+        assert len(keys) == len(different), f"вопросы слились в один ключ: {keys}"
+        await asyncio.gather(*(api.ask_async(question) for question in different))
+        assert app["calls"] == 1 + len(different), f"ожидалось {1 + len(different)} запросов, получено {app['calls']}"
+        print(f"{len(different)} разных вопросов о коллагене: ключи {sorted(keys)}")
+    finally:
+        await api.close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,88 @@
+"""Время запуска бота с заглушками Telegram и Perplexity и медленной БД.
+
+Polling и ответ на первый вопрос не должны ждать подключения к PostgreSQL:
+скрипт завершается с ошибкой, если запуск дольше заданных порогов.
+Время отсчитывается от вызова main(); импорт aiogram (несколько секунд) в замер не входит.
+
+Запуск: python bench/startup.py [--db-delay 5] [--max-polling 1.0] [--max-first-answer 2.0]
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from stubs import channel_post, offline_db, perplexity_app, start_server, telegram_app
+
+
+class EmptyDatabase:
+    """Пустая БД: бенчмарк меряет только запуск"""
+
+    async def close(self):
+        pass
+
+    async def load_products(self):
+        return []
+
+    async def load_price_states(self):
+        return []
+
+    async def load_state(self, key):
+        return {}
+
+
+ANSWER_TAIL = "NL INTERNATIONAL"
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db-delay", type=float, default=5.0)
+    parser.add_argument("--max-polling", type=float, default=1.0)
+    parser.add_argument("--max-first-answer", type=float, default=2.0)
+    args = parser.parse_args()
+
+    perplexity_runner, perplexity_url = await start_server(perplexity_app(latency=0.2))
+    telegram = telegram_app([channel_post(1, "Какая польза у коллагена?")])
+    telegram_runner, telegram_url = await start_server(telegram)
+    os.environ.update({
+        "BOT_TOKEN": "123456:bench", "TELEGRAM_API_URL": telegram_url,
+        "PERPLEXITY_API_KEY": "bench-key", "STREAM_EDIT_INTERVAL": "0.1",
+    })
+
+    import bot
+    import database
+    import perplexity
+    offline_db()
+    perplexity.PerplexityAPI.BASE_URL = f"{perplexity_url}/chat/completions"
+
+    async def slow_connect():
+        await asyncio.sleep(args.db_delay)
+        database.Database._instance = EmptyDatabase()
+    database.Database._create_instance = slow_connect
+
+    started = time.monotonic()
+    main_task = asyncio.create_task(bot.main())
+    try:
+        await asyncio.wait_for(bot.startup.wait_first_update(), 10)
+        answered = None
+        while answered is None:
+            # Финальная правка заглушки содержит ответ целиком
+            answered = next((t - started for t, name, params in telegram["calls"]
+                             if name == "editMessageText" and ANSWER_TAIL in params.get("text", "")), None)
+            await asyncio.sleep(0.01)
+        status = bot.startup.status()
+    finally:
+        main_task.cancel()
+        await asyncio.gather(main_task, return_exceptions=True)
+        await telegram_runner.cleanup()
+        await perplexity_runner.cleanup()
+
+    print(f"polling через {status['receiving_started']:.2f} с, первый апдейт через {status['first_update']:.2f} с, "
+          f"первый ответ через {answered:.2f} с (подключение к БД: {args.db_delay:.1f} с)")
+    print(f"готовность к моменту ответа: {status['ready']}, ещё запускались: {status['pending']}")
+    assert status["receiving_started"] < args.max_polling, "polling запускается слишком долго"
+    assert answered < args.max_first_answer, "первый ответ слишком долгий"
+    assert "db" not in status["ready"], "polling ждал подключения к БД"
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
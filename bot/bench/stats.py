@@ -0,0 +1,105 @@
+"""/stats и /price: время ответа из кэша сводки против пересчёта по истории цен.
+
+Каталог и история цен генерируются в отдельной схеме stats_bench, обработчики команд
+вызываются напрямую с заглушкой сообщения. Схема удаляется после прогона.
+
+Нужна локальная БД (переменные DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD).
+Запуск: python bench/stats.py [--products 20000] [--points 100] [--calls 200]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from datetime import date, timedelta
+
+import stubs  # noqa: F401  (путь к модулям бота)
+
+SCHEMA = "stats_bench"
+
+
+class FakeMessage:
+    """Ровно то, что нужно обработчикам команд: reply() запоминает ответ"""
+
+    def __init__(self):
+        self.replies = []
+
+    async def reply(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class FakeCommand:
+    def __init__(self, args):
+        self.args = args
+
+
+async def fill(db, products: int, points: int):
+    await db.pool.execute("""
+        INSERT INTO products (city_id, id, name, short_name, price, category)
+        SELECT '2214', 'p' || p, 'Товар ' || p, 'T' || p, 1000, 'cat-' || p % 20
+        FROM generate_series(0, $1 - 1) p
+    """, products, timeout=600)
+    # Точки за 60 дней: у каждого товара цена то снижается, то растёт
+    async with db.transaction() as conn:
+        await db._create_partitions(conn, date.today() - timedelta(days=61))
+    await db.pool.execute("""
+        INSERT INTO price_history (city_id, product_id, price, recorded_at)
+        SELECT '2214', 'p' || p, 500 + (n * 7919 + p) % 1000,
+               CURRENT_TIMESTAMP - make_interval(secs => 60 * 86400.0 * (n + p::float / $1) / $2)
+        FROM generate_series(0, $1 - 1) p, generate_series(0, $2 - 1) n
+    """, products, points, timeout=3600)
+    await db.pool.execute("ANALYZE", timeout=600)
+
+
+async def timed(label: str, fn, calls: int):
+    timings = []
+    for _ in range(calls):
+        started = time.perf_counter()
+        await fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    print(f"{label:<34} медиана {statistics.median(timings):8.2f} мс, p95 {timings[int(len(timings) * 0.95) - 1]:8.2f} мс")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--products", type=int, default=20000)
+    parser.add_argument("--points", type=int, default=100)
+    parser.add_argument("--calls", type=int, default=200)
+    args = parser.parse_args()
+
+    os.environ.setdefault("BOT_TOKEN", "123456:bench")
+    import database
+    params = database.connection_params()
+    database.connection_params = lambda: {**params, "server_settings": {"search_path": SCHEMA}}
+    setup = database.Database()
+    await setup.connect()
+    await setup.execute_with_retry(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    await setup.execute_with_retry(f"CREATE SCHEMA {SCHEMA}")
+    await setup.close()
+
+    import bot
+    try:
+        db = await database.Database.get_instance()
+        started = time.perf_counter()
+        await fill(db, args.products, args.points)
+        print(f"Каталог {args.products} товаров, история {args.products * args.points} точек "
+              f"за {time.perf_counter() - started:.0f} с")
+        await bot.product_index.load_from_db()
+
+        await timed("пересчёт сводки (после скрапера)", bot.price_stats.refresh, 3)
+        message = FakeMessage()
+        await timed("/stats из кэша", lambda: bot.send_stats(message), args.calls)
+        print(message.replies[-1])
+
+        message = FakeMessage()
+        await timed("/price, первый запрос товара", lambda: bot.send_price(message, FakeCommand("Товар 123")), 1)
+        await timed("/price из кэша", lambda: bot.send_price(message, FakeCommand("Товар 123")), args.calls)
+        print(message.replies[-1])
+    finally:
+        await db.execute_with_retry(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        await database.Database.close_instance()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,42 @@
+"""Время до первого фрагмента ответа: ask_async против ask_stream.
+
+Запуск: python bench/streaming.py [--latency 2.0] [--chunk-delay 0.05]
+"""
+import argparse
+import asyncio
+import time
+
+from stubs import offline_db, perplexity_app, start_server
+from perplexity import PerplexityAPI
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=2.0)
+    parser.add_argument("--chunk-delay", type=float, default=0.05)
+    args = parser.parse_args()
+
+    offline_db()
+    runner, base_url = await start_server(perplexity_app(args.latency, args.chunk_delay))
+    api = PerplexityAPI("bench-key")
+    api.BASE_URL = f"{base_url}/chat/completions"
+    try:
+        started = time.perf_counter()
+        await api.ask_async("польза коллагена")
+        full = time.perf_counter() - started
+
+        started = time.perf_counter()
+        first = None
+        async for _ in api.ask_stream("как принимать омегу"):
+            if first is None:
+                first = time.perf_counter() - started
+        total = time.perf_counter() - started
+        print(f"без стрима: ответ через {full:.3f} с")
+        print(f"стрим: первый фрагмент через {first:.3f} с, весь ответ через {total:.3f} с")
+    finally:
+        await api.close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
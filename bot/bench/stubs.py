@@ -0,0 +1,220 @@
+"""Локальные заглушки внешних сервисов для бенчмарков"""
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+import time
+
+from aiohttp import web
+
+# Модули бота импортируются плоско (как в контейнере из /app/src)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+ANSWER = (
+    "<think>размышления модели</think>Коллаген поддерживает кожу и суставы [1]. "
+    "Подробнее у [NL INTERNATIONAL](https://nlstar.com/ref/aU37in).\n\n"
+    "[1]: https://example.com/collagen"
+)
+
+
+def offline_db():
+    """Отключает обращения кэша ответов к PostgreSQL — бенчмарки работают без БД"""
+    import answer_cache
+
+    async def no_db(method, *args, timeout=1.0):
+        return None
+    answer_cache._db_call = no_db
+
+
+QUESTION_MARK_RE = re.compile(r"#(\d+)")
+
+
+def answer_marker(number) -> str:
+    """Последние слова ответа заглушки на вопрос с меткой #number: по ним находится готовый ответ"""
+    return f"Ответ #{number}."
+
+
+def perplexity_app(latency: float = 0.05, chunk_delay: float = 0.0, error_rate: float = 0.0,
+                   rate_limited: float = 0.0, seed: int = 0) -> web.Application:
+    """Заглушка /chat/completions с фиксированной задержкой ответа; app["calls"] — число запросов.
+
+    С "stream": true ответ отдаётся SSE-чанками по слову, chunk_delay — пауза между ними.
+    error_rate — доля ответов 500, rate_limited — доля ответов 429. Если в вопросе есть метка #N,
+    ответ заканчивается словами answer_marker(N).
+    """
+    rng = random.Random(seed)
+
+    async def completions(request: web.Request) -> web.StreamResponse:
+        app = request.app
+        app["calls"] += 1
+        payload = await request.json()
+        roll = rng.random()
+        if roll < rate_limited:
+            app["rate_limited"] += 1
+            return web.json_response({"error": "rate limited"}, status=429, headers={"Retry-After": "1"})
+        if roll < rate_limited + error_rate:
+            app["errors"] += 1
+            await asyncio.sleep(latency / 10)
+            return web.json_response({"error": "internal"}, status=500)
+        mark = QUESTION_MARK_RE.search(payload["messages"][-1]["content"])
+        answer = f"{ANSWER} {answer_marker(mark[1])}" if mark else ANSWER
+        if not payload.get("stream"):
+            await asyncio.sleep(latency)
+            return web.json_response({"choices": [{"message": {"content": answer}}]})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await asyncio.sleep(latency / 10)
+        try:
+            for word in answer.split(" "):
+                chunk = {"choices": [{"delta": {"content": word + " "}}]}
+                await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+                await asyncio.sleep(chunk_delay)
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            pass  # клиент закрыл стрим (например, бот остановлен посреди ответа)
+        return response
+
+    app = web.Application()
+    app["calls"] = 0
+    app["errors"] = 0
+    app["rate_limited"] = 0
+    app.router.add_post("/chat/completions", completions)
+    return app
+
+
+async def start_server(app: web.Application) -> tuple:
+    """Запускает приложение на свободном порту, возвращает (runner, base_url)"""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def catalog_app(products: int = 100, etag: bool = True, latency: float = 0.0, error_rate: float = 0.0,
+                change_rate: float = 0.0, seed: int = 0) -> web.Application:
+    """Заглушка каталога nlstar: /ru/api/store/city/{city}/all-products/ с поддержкой ETag.
+
+    app["prices"] — цены по городам, их можно менять между запросами; app["requests"] — число запросов.
+    latency — задержка ответа, error_rate — доля ответов 503, change_rate — доля цен,
+    меняющихся перед каждым запросом.
+    """
+    rng = random.Random(seed)
+
+    async def all_products(request: web.Request) -> web.Response:
+        request.app["requests"] += 1
+        await asyncio.sleep(latency)
+        if rng.random() < error_rate:
+            return web.Response(status=503)
+        city = request.match_info["city"]
+        prices = request.app["prices"].setdefault(city, [1000.0 + i for i in range(products)])
+        for _ in range(int(len(prices) * change_rate)):
+            i = rng.randrange(len(prices))
+            prices[i] = max(100.0, prices[i] + rng.choice((-100.0, 100.0)))
+        body = json.dumps({"products": [
+            {"id": i, "name": f"Товар {i}", "short_name": f"T{i}", "price": {"current": price}, "category": f"cat-{i % 20}"}
+            for i, price in enumerate(prices)
+        ]}, ensure_ascii=False).encode()
+        tag = f'"{hash(body) & 0xffffffff:x}"'
+        if etag and request.headers.get("If-None-Match") == tag:
+            return web.Response(status=304)
+        return web.Response(body=body, content_type="application/json", headers={"ETag": tag} if etag else {})
+
+    app = web.Application()
+    app["prices"] = {}
+    app["requests"] = 0
+    app.router.add_get("/ru/api/store/city/{city}/all-products/", all_products)
+    return app
+
+
+def telegram_app(updates=(), chat_limit: int = 0, latency: float = 0.0, flood_rate: float = 0.0,
+                 seed: int = 0) -> web.Application:
+    """Заглушка Bot API: getUpdates отдаёт заданные апдейты, остальные методы отвечают успешно.
+
+    chat_limit > 0 включает флуд-контроль: больше chat_limit запросов в чат за секунду получают 429.
+    flood_rate — доля запросов в чаты, случайно получающих 429; latency — задержка каждого метода.
+    Новые апдейты добавляются через push_updates(), ожидающий getUpdates получает их сразу.
+    app["calls"] — принятые запросы (время, метод, параметры) в порядке поступления, app["flood"] — число 429.
+    Методы из app["failing"] отвечают 400 Bad Request (сбой Bot API на конкретном вызове).
+    """
+    rng = random.Random(seed)
+
+    def flood(app) -> web.Response:
+        app["flood"] += 1
+        return web.json_response({
+            "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+            "parameters": {"retry_after": 1},
+        }, status=429)
+
+    async def method(request: web.Request) -> web.Response:
+        app = request.app
+        name = request.match_info["method"]
+        params = dict(await request.post())
+        if latency and name != "getUpdates":
+            await asyncio.sleep(latency)
+        now = time.monotonic()
+        if flood_rate and "chat_id" in params and rng.random() < flood_rate:
+            return flood(app)
+        if chat_limit and "chat_id" in params:
+            recent = app["recent"].setdefault(params["chat_id"], [])
+            recent[:] = [t for t in recent if now - t < 1]
+            if len(recent) >= chat_limit:
+                return flood(app)
+            recent.append(now)
+        app["calls"].append((now, name, params))
+        if name in app["failing"]:
+            return web.json_response({"ok": False, "error_code": 400, "description": "Bad Request: bench failure"},
+                                     status=400)
+        if name == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif name == "getUpdates":
+            offset = int(params.get("offset") or 0)
+            app["updates"] = [update for update in app["updates"] if update["update_id"] >= offset]
+            if not app["updates"]:
+                app["has_updates"].clear()
+                try:
+                    await asyncio.wait_for(app["has_updates"].wait(), min(float(params.get("timeout") or 0), 0.5))
+                except asyncio.TimeoutError:
+                    pass
+            result = app["updates"][:100]
+        elif name in ("sendMessage", "editMessageText"):
+            app["message_id"] += 1
+            result = {
+                "message_id": int(params.get("message_id") or app["message_id"]),
+                "date": int(time.time()),
+                "chat": {"id": int(params["chat_id"]), "type": "channel", "title": "bench"},
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application()
+    app["updates"] = list(updates)
+    app["has_updates"] = asyncio.Event()
+    app["calls"] = []
+    app["recent"] = {}
+    app["flood"] = 0
+    app["failing"] = set()
+    app["message_id"] = 1000
+    app.router.add_post("/bot{token}/{method}", method)
+    return app
+
+
+def push_updates(app: web.Application, updates):
+    """Добавляет апдейты в очередь заглушки Bot API и будит ожидающий getUpdates"""
+    app["updates"].extend(updates)
+    app["has_updates"].set()
+
+
+def channel_post(update_id: int, text: str, chat_id: int = -1001234567890) -> dict:
+    """Апдейт с постом в канале, как его присылает Telegram"""
+    return {"update_id": update_id, "channel_post": {
+        "message_id": update_id, "date": int(time.time()), "text": text,
+        "chat": {"id": chat_id, "type": "channel", "title": "bench"},
+    }}
@@ -0,0 +1,84 @@
+"""Исходящая очередь Bot API под флуд-контролем: всплеск сообщений в несколько чатов и пачка уведомлений.
+
+Заглушка Telegram отвечает 429 на превышение лимита чата. Без очереди такие сообщения теряются,
+с TelegramSender — доходят все, а уведомления объединяются в одно сообщение.
+
+Запуск: python bench/telegram_sender.py [--chats 5] [--messages 20] [--notifications 50]
+"""
+import argparse
+import asyncio
+import time
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from stubs import start_server, telegram_app
+from telegram_utils import TelegramSender
+
+CHAT_LIMIT = 5  # сообщений в секунду на чат у заглушки
+
+
+async def burst(bot: Bot, chats: int, messages: int):
+    """Отправляет messages сообщений в каждый из chats чатов одновременно; возвращает число потерянных"""
+    async def send(chat_id, i):
+        try:
+            await bot.send_message(chat_id, f"сообщение {i}")
+            return 0
+        except Exception:
+            return 1
+    results = await asyncio.gather(*(send(chat, i) for chat in range(1, chats + 1) for i in range(messages)))
+    return sum(results)
+
+
+async def run(base_url: str, sender=None, **kwargs):
+    bot = Bot("123456:bench", session=AiohttpSession(api=TelegramAPIServer.from_base(base_url)))
+    if sender:
+        bot.session.middleware(sender)
+    try:
+        started = time.monotonic()
+        lost = await burst(bot, **kwargs)
+        return lost, time.monotonic() - started
+    finally:
+        await bot.session.close()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=5)
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--notifications", type=int, default=50)
+    args = parser.parse_args()
+    total = args.chats * args.messages
+
+    app = telegram_app(chat_limit=CHAT_LIMIT)
+    runner, base_url = await start_server(app)
+    try:
+        lost, elapsed = await run(base_url, chats=args.chats, messages=args.messages)
+        print(f"без очереди: потеряно {lost} из {total} за {elapsed:.2f} с, 429: {app['flood']}")
+
+        flood_before = app["flood"]
+        app["recent"].clear()
+        # Лимит очереди чуть ниже лимита сервера, как и в боте по умолчанию (1/с в личку, 20/мин в группу)
+        sender = TelegramSender(global_rate=30, chat_rate=CHAT_LIMIT - 1, max_retries=5, coalesce_window=0.2)
+        lost, elapsed = await run(base_url, sender, chats=args.chats, messages=args.messages)
+        stats = sender.stats()
+        print(f"с очередью: потеряно {lost} из {total} за {elapsed:.2f} с, 429: {app['flood'] - flood_before}, "
+              f"ожидание в очереди ср. {stats['avg_wait'] * 1000:.0f} мс / макс. {stats['max_wait'] * 1000:.0f} мс")
+        assert lost == 0, "очередь потеряла сообщения"
+
+        bot = Bot("123456:bench", session=AiohttpSession(api=TelegramAPIServer.from_base(base_url)))
+        bot.session.middleware(sender)
+        before = len(app["calls"])
+        sent = await asyncio.gather(*(sender.notify(bot, 42, f"📉 товар {i}", header="🔥 АКЦИЯ!\n\n")
+                                      for i in range(args.notifications)))
+        await bot.session.close()
+        messages = len(app["calls"]) - before
+        print(f"{args.notifications} уведомлений → {messages} сообщение(й), объединено: {sender.stats()['coalesced']}")
+        assert messages == 1 and all(s[0].message_id == sent[0][0].message_id for s in sent)
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
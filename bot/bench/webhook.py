@@ -0,0 +1,91 @@
+"""Режим webhook: быстрый ответ 200 Telegram, проверка секрета и плавная остановка.
+
+Бот запускается с WEBHOOK_URL против заглушек Telegram и медленного Perplexity. Скрипт проверяет, что:
+апдейт подтверждается сразу, не дожидаясь ответа модели; запрос с неверным секретом отклоняется;
+по SIGTERM начатый вопрос дорабатывается и ответ доходит до Telegram.
+
+Запуск: python bench/webhook.py [--latency 2] [--max-ack 0.2]
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import time
+
+import aiohttp
+
+from stubs import channel_post, offline_db, perplexity_app, start_server, telegram_app
+
+SECRET = "bench-secret"
+ANSWER_TAIL = "NL INTERNATIONAL"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=2.0, help="задержка ответа Perplexity, с")
+    parser.add_argument("--max-ack", type=float, default=0.2)
+    args = parser.parse_args()
+
+    perplexity_runner, perplexity_url = await start_server(perplexity_app(latency=args.latency))
+    telegram = telegram_app()
+    telegram_runner, telegram_url = await start_server(telegram)
+    port = free_port()
+    os.environ.update({
+        "BOT_TOKEN": "123456:bench", "TELEGRAM_API_URL": telegram_url, "PERPLEXITY_API_KEY": "bench-key",
+        "PERPLEXITY_STREAM": "0", "WEBHOOK_URL": "https://bot.example.com", "WEBHOOK_SECRET": SECRET,
+        "WEBHOOK_HOST": "127.0.0.1", "WEBHOOK_PORT": str(port), "DB_PORT": "1",
+    })
+
+    import bot
+    import perplexity
+    offline_db()
+    perplexity.PerplexityAPI.BASE_URL = f"{perplexity_url}/chat/completions"
+
+    main_task = asyncio.create_task(bot.main())
+    url = f"http://127.0.0.1:{port}/webhook"
+    try:
+        async with aiohttp.ClientSession() as session:
+            while not any(name == "setWebhook" for _, name, _ in telegram["calls"]):
+                await asyncio.sleep(0.05)
+
+            async with session.post(url, json=channel_post(1, "Чужой вопрос"),
+                                    headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}) as response:
+                assert response.status == 401, f"неверный секрет принят: {response.status}"
+
+            started = time.monotonic()
+            async with session.post(url, data=json.dumps(channel_post(2, "Какая польза у коллагена?")),
+                                    headers={"X-Telegram-Bot-Api-Secret-Token": SECRET,
+                                             "Content-Type": "application/json"}) as response:
+                ack = time.monotonic() - started
+                assert response.status == 200, f"апдейт не принят: {response.status}"
+
+        # Ждём, пока вопрос попадёт в работу, и останавливаем бота посреди запроса к Perplexity
+        while not bot.question_scheduler.stats()["active"]:
+            await asyncio.sleep(0.01)
+        os.kill(os.getpid(), signal.SIGTERM)
+        await asyncio.wait_for(main_task, args.latency + 10)
+        stopped = time.monotonic() - started
+    finally:
+        if not main_task.done():
+            main_task.cancel()
+        await telegram_runner.cleanup()
+        await perplexity_runner.cleanup()
+
+    answered = any(name == "sendMessage" and ANSWER_TAIL in params.get("text", "")
+                   for _, name, params in telegram["calls"])
+    print(f"подтверждение апдейта: {ack * 1000:.0f} мс (ответ модели {args.latency:.1f} с), "
+          f"остановка через {stopped:.2f} с, ответ доставлен: {answered}")
+    assert ack < args.max_ack, "webhook ждёт обработчик вместо немедленного ответа"
+    assert answered, "при остановке начатый вопрос потерян"
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,320 @@
+"""Отложенная запись в БД через журнал (write_behind) против прямой записи из прохода скрапера.
+
+Между ботом и PostgreSQL стоит TCP-прокси, который задерживает каждый пакет (--delay) и умеет
+«отключать» БД. Проверяется:
+- длительность прохода настоящего цикла цен (bot.price_scraping_loop с выбором ведущей реплики,
+  конвейером событий и фоновым обслуживанием истории) по заглушке каталога: сначала с записью
+  в БД напрямую, затем через журнал;
+- отключение БД посреди работы: проходы продолжаются, журнал копится и сбрасывается после восстановления;
+- повтор журнала после «падения» (сегменты применены, но не удалены): дубликатов истории нет,
+  более старое состояние цен не перетирает новое;
+- перевод существующей price_history на уникальный ключ с удалением дубликатов.
+
+Нужна локальная БД (переменные DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD).
+Запуск: python bench/write_behind.py [--products 5000] [--batch 500] [--delay 0.02] [--passes 3]
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from stubs import catalog_app, start_server
+import database
+from catalog import Product
+from database import Database
+from write_behind import WriteBehindJournal
+
+SCHEMA = "journal_bench"
+CITY = "2214"
+
+
+class DbProxy:
+    """TCP-прокси к PostgreSQL: задержка каждого пакета в обе стороны и «отключение» БД"""
+
+    def __init__(self, host: str, port: int, delay: float = 0.0):
+        self.upstream = (host, port)
+        self.delay = delay
+        self.online = True
+        self.port = None
+        self._writers = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def _pipe(self, reader, writer):
+        try:
+            while data := await reader.read(65536):
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle(self, reader, writer):
+        if not self.online:
+            writer.close()
+            return
+        try:
+            upstream_reader, upstream_writer = await asyncio.open_connection(*self.upstream)
+        except OSError:
+            writer.close()
+            return
+        pair = {writer, upstream_writer}
+        self._writers |= pair
+        await asyncio.gather(self._pipe(reader, upstream_writer), self._pipe(upstream_reader, writer))
+        self._writers -= pair
+
+    def down(self):
+        self.online = False
+        for writer in self._writers:
+            writer.close()
+        self._writers.clear()
+
+    def up(self):
+        self.online = True
+
+    async def close(self):
+        self.down()
+        self.server.close()
+        await self.server.wait_closed()
+
+
+def catalog(n: int, prices_shift: float, changed_every: int):
+    """Каталог города; у каждого changed_every-го товара цена сдвинута на prices_shift"""
+    return [
+        Product(CITY, f"p{i}", f"Товар {i}", f"T{i}",
+                1000.0 + i % 500 + (prices_shift if changed_every and i % changed_every == 0 else 0.0), f"cat-{i % 20}")
+        for i in range(n)
+    ]
+
+
+def batches(products, size: int):
+    return [products[start:start + size] for start in range(0, len(products), size)]
+
+
+class PassTimes:
+    """Подменяет гистограмму SCRAPE_CYCLE_SECONDS в bot: запоминает длительность каждого прохода"""
+
+    def __init__(self):
+        self.seconds = []
+
+    def observe(self, value: float):
+        self.seconds.append(value)
+
+    async def wait(self, count: int, timeout: float = 300) -> list:
+        """Ждёт count проходов и возвращает длительность последних count проходов (мс)"""
+        target = len(self.seconds) + count
+        started = time.perf_counter()
+        while len(self.seconds) < target:
+            assert time.perf_counter() - started < timeout, "цикл цен не сделал нужное число проходов"
+            await asyncio.sleep(0.05)
+        return [value * 1000 for value in self.seconds[target - count:target]]
+
+
+async def loop_passes(args, proxy: DbProxy, params: dict, db: Database):
+    """Проходы bot.price_scraping_loop при медленной БД: без журнала и с журналом write_behind (мс)"""
+    catalog_runner, catalog_url = await start_server(catalog_app(args.products, change_rate=0.05, seed=1))
+    journal_dir = tempfile.mkdtemp(prefix="journal-loop-")
+    import bot
+    import leader
+    import scraper
+    from scrape_schedule import ScrapeScheduler
+    # config уже прочитан при импорте database: синглтоны бота настраиваются на месте
+    scraper.CATALOG_URL = catalog_url + "/ru/api/store/city/{city_id}/all-products/"
+    bot.catalog_scraper = scraper.CatalogScraper([CITY], rate_per_host=100, batch_size=args.batch)
+    bot.scrape_scheduler = ScrapeScheduler([CITY], 1, 1, 1, retry_interval=1, jitter=0)
+    bot.scraping_leader = leader.LeaderElection("price_scraping", retry_interval=0.5, check_interval=1)
+    bot.write_behind.directory = journal_dir
+    bot.write_behind.flush_interval = 0.5
+    # Выделенное соединение выбора лидера задаёт свои server_settings: схема передаётся через них
+    leader.connection_params = lambda: {**params, "host": "127.0.0.1", "port": proxy.port}
+    leader.KEEPALIVE_SETTINGS = {**leader.KEEPALIVE_SETTINGS, "search_path": SCHEMA}
+    times = bot.SCRAPE_CYCLE_SECONDS = PassTimes()
+    # Пост в канал заменён подтверждением: снижения применяются к индексу, как после удачного поста
+    bot.price_events.add_sink("channel", bot.price_tracker.confirm_notified)
+    bot.price_events.add_sink("db", bot.store_price_events)
+    bot.price_events.start()
+
+    proxy.delay = args.delay
+    tasks = [asyncio.create_task(coro) for coro in (
+        bot.scraping_leader.run(), bot.price_scraping_loop(), bot.price_maintenance_loop()
+    )]
+    try:
+        # Первый проход загружает каталог целиком, дальше в каждом меняется 5% цен
+        await times.wait(1)
+        direct = await times.wait(args.passes)
+        bot.write_behind.start()
+        journal = await times.wait(args.passes)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await bot.price_events.close(10)
+        await bot.write_behind.close(60)  # остаток журнала сбрасывается в БД при закрытии
+        await bot.scraping_leader.close()
+        await catalog_runner.cleanup()
+        shutil.rmtree(journal_dir, ignore_errors=True)
+        proxy.delay = 0
+    assert not bot.write_behind.pending
+    products = await db.pool.fetchval("SELECT count(*) FROM products")
+    states = await db.pool.fetchval("SELECT count(*) FROM price_state")
+    duplicates = (await counts(db))[2]
+    assert products == states == args.products and duplicates == 0, (products, states, duplicates)
+    return direct, journal
+
+
+async def timed_pass(save, products, size: int) -> float:
+    started = time.perf_counter()
+    for batch in batches(products, size):
+        await save(batch)
+    return (time.perf_counter() - started) * 1000
+
+
+async def drained(journal: WriteBehindJournal, timeout: float = 120) -> float:
+    started = time.perf_counter()
+    while journal.pending:
+        assert time.perf_counter() - started < timeout, "журнал не сброшен"
+        await asyncio.sleep(0.05)
+    return time.perf_counter() - started
+
+
+async def counts(db: Database):
+    products = await db.pool.fetchval("SELECT count(*) FROM products")
+    history = await db.pool.fetchval("SELECT count(*) FROM price_history")
+    duplicates = await db.pool.fetchval("""
+        SELECT count(*) FROM (
+            SELECT 1 FROM price_history GROUP BY product_id, city_id, recorded_at HAVING count(*) > 1
+        ) d
+    """)
+    return products, history, duplicates
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--products", type=int, default=5000)
+    parser.add_argument("--batch", type=int, default=500)
+    parser.add_argument("--delay", type=float, default=0.02)
+    parser.add_argument("--passes", type=int, default=3, help="проходов цикла цен в каждом режиме")
+    args = parser.parse_args()
+
+    params = database.connection_params()
+    proxy = DbProxy(params["host"], params["port"])
+    await proxy.start()
+    database.connection_params = lambda: {
+        **params, "host": "127.0.0.1", "port": proxy.port, "server_settings": {"search_path": SCHEMA}
+    }
+    setup = Database()
+    await setup.connect()
+    await setup.execute_with_retry(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    await setup.execute_with_retry(f"CREATE SCHEMA {SCHEMA}")
+    await setup.close()
+
+    directory = tempfile.mkdtemp(prefix="journal-bench-")
+    db = await Database.get_instance()
+    try:
+        # --- 1. Проходы цикла цен при медленной БД ---
+        direct, journaled = await loop_passes(args, proxy, params, db)
+        print(f"Проход цикла цен по {args.products} товарам (5% цен меняются), задержка БД "
+              f"{args.delay * 1000:.0f} мс на пакет: напрямую {', '.join(f'{ms:.0f}' for ms in direct)} мс, "
+              f"через журнал {', '.join(f'{ms:.0f}' for ms in journaled)} мс")
+        assert max(journaled) < min(direct)
+        for table in ("price_events", "price_state", "price_history_daily", "price_history", "products"):
+            await db.pool.execute(f"TRUNCATE {table}")
+
+        # Исходное состояние для остальных проверок: каталог и проход с изменением каждой 20-й цены
+        first = catalog(args.products, 0, 0)
+        await db.save_products(first)
+        await db.save_products(catalog(args.products, -50, 20))
+        journal = WriteBehindJournal(directory, flush_interval=0.5, retry_max=2)
+        journal.start()
+
+        # --- 2. БД недоступна: проходы идут, журнал копится, после восстановления сбрасывается ---
+        proxy.down()
+        outage = []
+        for shift in (-100, -150, -200):
+            outage.append(await timed_pass(journal.save_products, catalog(args.products, shift, 20), args.batch))
+            await journal.save_price_states([(CITY, "p0", 1000.0 + shift, 1000.0 + shift)])
+            await asyncio.sleep(1)
+        await journal.save_state("pinned_message", {"pinned_message_id": 42})
+        try:
+            await db.save_products(first[:args.batch])
+            direct = "успешна"
+        except Exception as e:
+            direct = f"ошибка {type(e).__name__}"
+        print(f"БД недоступна: проходы через журнал {', '.join(f'{ms:.1f}' for ms in outage)} мс, "
+              f"в журнале {journal.pending / 1024:.0f} КБ, неудачных сбросов {journal.failures}; "
+              f"прямая запись — {direct}")
+        assert journal.failures and journal.pending
+        assert journal.pending_state("pinned_message") == {"pinned_message_id": 42}
+        proxy.up()
+        recovery_s = await drained(journal)
+        products, history, duplicates = await counts(db)
+        price = await db.pool.fetchval("SELECT price FROM products WHERE id = 'p0'")
+        state = await db.load_state("pinned_message")
+        print(f"БД восстановлена: журнал сброшен за {recovery_s:.1f} с, товаров {products}, точек истории {history}, "
+              f"цена p0 {price:.0f}, закреплённое сообщение {state.get('pinned_message_id')}")
+        assert history == args.products + 4 * (args.products // 20) and duplicates == 0 and price == 800
+        assert state == {"pinned_message_id": 42} and journal.pending_state("pinned_message") is None
+        await journal.close(10)
+
+        # --- 3. «Падение» после записи в БД, но до удаления сегментов: повтор журнала ---
+        journal = WriteBehindJournal(directory, flush_interval=3600)
+        journal.open()
+        await journal.save_products(catalog(args.products, -300, 20))
+        await journal.save_price_states([(CITY, "p0", 700.0, 700.0)])
+        backup = tempfile.mkdtemp(prefix="journal-backup-")
+        journal._close_active()
+        for name in os.listdir(directory):
+            if name.endswith(".jsonl"):
+                shutil.copy(os.path.join(directory, name), backup)
+        await journal.flush()
+        await journal.close(10)
+        # Пока «бот лежал», новый ведущий записал более свежий каталог и состояние p0
+        newer = datetime.now(timezone.utc) + timedelta(seconds=1)
+        await db.save_products(catalog(args.products, -350, 20), newer)
+        await db.save_price_states([(CITY, "p0", 650.0, 650.0)], [newer])
+        before = await counts(db)
+        for name in os.listdir(backup):
+            shutil.copy(os.path.join(backup, name), directory)
+        shutil.rmtree(backup)
+        journal = WriteBehindJournal(directory, flush_interval=3600)
+        journal.open()
+        replayed = journal.pending
+        await journal.flush()
+        await journal.close(10)
+        after = await counts(db)
+        state_price = await db.pool.fetchval("SELECT price FROM price_state WHERE product_id = 'p0'")
+        price = await db.pool.fetchval("SELECT price FROM products WHERE id = 'p0'")
+        print(f"Повтор {replayed / 1024:.0f} КБ журнала: товаров/точек истории/дубликатов {before} -> {after}, "
+              f"цена и состояние p0 {price:.0f}/{state_price:.0f} (новее журнала)")
+        assert before == after and price == state_price == 650
+
+        # --- 4. Существующая таблица с дубликатами переводится на уникальный ключ ---
+        await db.pool.execute("DROP INDEX price_history_point_key")
+        await db.pool.execute("CREATE INDEX price_history_product_idx ON price_history (product_id, city_id, recorded_at)")
+        await db.pool.execute("INSERT INTO price_history SELECT * FROM price_history WHERE product_id = 'p0'")
+        with_duplicates = await counts(db)
+        await db._create_price_history()
+        migrated = await counts(db)
+        unique = await db.pool.fetchval("""
+            SELECT indisunique FROM pg_index WHERE indexrelid = to_regclass('price_history_point_key')
+        """)
+        print(f"Перевод на уникальный ключ: дубликатов {with_duplicates[2]} -> {migrated[2]}, "
+              f"точек {with_duplicates[1]} -> {migrated[1]}, уникальный индекс: {unique}")
+        assert migrated == after and unique
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+        await db.execute_with_retry(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        await Database.close_instance()
+        await proxy.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
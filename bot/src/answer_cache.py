@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from database import Database
+from text_utils import normalize_query
+
+logger = logging.getLogger(__name__)
+
+
+async def _db_call(method: str, *args, timeout: float = 1.0):
+    """Вызов метода Database; медленная БД не задерживает ответ дольше timeout"""
+    async def call():
+        db = await Database.get_instance()
+        return await getattr(db, method)(*args)
+    return await asyncio.wait_for(call(), timeout)
+
+
+class AnswerCache:
+    """Кэш ответов Perplexity по нормализованному вопросу: LRU в памяти + таблица answer_cache в PostgreSQL.
+
+    После ошибки БД её уровень пропускается db_cooldown секунд: пока БД лежит,
+    промах по памяти не ждёт таймаут на каждом вопросе.
+    """
+
+    def __init__(self, max_size: int = 1000, ttl: int = 86400, db_cooldown: float = 30.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.db_cooldown = db_cooldown
+        self._db_retry_at = 0.0  # до этого момента (monotonic) БД не опрашивается
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (answer, expires_at)
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _remember(self, key: str, answer: str, expires_at: float):
+        self._items[key] = (answer, expires_at)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def _db_available(self) -> bool:
+        return time.monotonic() >= self._db_retry_at
+
+    def _db_failed(self, action: str, e: Exception):
+        self._db_retry_at = time.monotonic() + self.db_cooldown
+        logger.error(f"Ошибка {action} кэша ответов в БД: {e!r}; БД кэша пропускается {self.db_cooldown:g} с")
+
+    async def get(self, query: str) -> Optional[str]:
+        key = normalize_query(query)
+        if not key:
+            return None
+
+        item = self._items.get(key)
+        if item:
+            answer, expires_at = item
+            if expires_at > time.monotonic():
+                self._items.move_to_end(key)
+                self.hits += 1
+                return answer
+            del self._items[key]
+            self.evictions += 1
+
+        row = None
+        if self._db_available():
+            try:
+                row = await _db_call("load_cached_answer", key, self.ttl)
+            except Exception as e:
+                self._db_failed("чтения", e)
+        if row:
+            answer, age = row
+            self._remember(key, answer, time.monotonic() + self.ttl - age)
+            self.db_hits += 1
+            return answer
+
+        self.misses += 1
+        return None
+
+    async def set(self, query: str, answer: str):
+        key = normalize_query(query)
+        if not key:
+            return
+        self._remember(key, answer, time.monotonic() + self.ttl)
+        if not self._db_available():
+            return
+        try:
+            await _db_call("save_cached_answer", key, answer)
+        except Exception as e:
+            self._db_failed("записи", e)
+
+    async def invalidate(self):
+        """Сбрасывает оба уровня кэша (например, после изменения каталога).
+        Очистка БД выполняется и во время паузы после ошибки: иначе устаревшие ответы вернулись бы из БД"""
+        self._items.clear()
+        try:
+            await _db_call("clear_cached_answers", timeout=10)
+            self._db_retry_at = 0.0
+        except Exception as e:
+            self._db_failed("очистки", e)
+        logger.info("Кэш ответов сброшен")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.db_hits + self.misses
+        return {
+            "size": len(self._items),
+            "hits": self.hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits + self.db_hits) / lookups if lookups else 0.0,
+        }
@@ -1,33 +1,61 @@
 import os
 import asyncio
 import logging
-from perplexity import init_perplexity, ask_perplexity
+import re
+import signal
+import time
+from typing import Optional
+from aiohttp import web
 from aiogram import Bot, Dispatcher, Router, types
-from aiogram.filters import Command
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.filters import Command, CommandObject
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from dotenv import load_dotenv
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 
 # Исправленные импорты (убраны точки)
-from state_utils import load_state, save_state, load_pinned_message_id, save_pinned_message_id
-from scraper import fetch_products
-from perplexity import ask_perplexity, init_perplexity
-from telegram_utils import send_long_message
-from text_utils import clean_telegram_html, convert_markdown_links_to_html
+from price_tracker import PriceChanges, PriceTracker
+from price_events import ChannelSink, PriceEventPipeline, WatchlistSink, store_price_events
+from scraper import CatalogScraper
+from scrape_schedule import ScrapeScheduler, parse_windows
+from perplexity import (
+    ask_perplexity_async, ask_perplexity_stream, close_perplexity, init_perplexity,
+    invalidate_answer_cache, answer_cache_stats, perplexity_latency_stats, warm_up_perplexity
+)
+from telegram_utils import best_effort, send_long_message, StreamingMessage, telegram_sender
+from concurrency import LoopLagMonitor, QuestionScheduler, QueueFull
+from database import Database
+from product_index import product_index
+from price_stats import PriceStats
+from startup import Startup
+from leader import LeaderElection, NotLeader
+from metrics import (
+    QUESTIONS_ACTIVE, QUESTIONS_QUEUED, SCRAPE_CYCLE_SECONDS, SCRAPE_CYCLES, SCRAPE_PRODUCTS,
+    start_metrics_server, timed_handler
+)
+from config import (
+    QUESTION_CONCURRENCY, QUESTION_QUEUE_SIZE, CITY_IDS, SCRAPE_CONCURRENCY, SCRAPE_RATE_PER_HOST,
+    SCRAPE_BATCH_SIZE, PERPLEXITY_WARMUP, TELEGRAM_API_URL, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET,
+    WEBHOOK_HOST, WEBHOOK_PORT, SHUTDOWN_DRAIN_TIMEOUT, LEADER_RETRY_INTERVAL, LEADER_CHECK_INTERVAL,
+    CHECK_INTERVAL, SCRAPE_MIN_INTERVAL, SCRAPE_MAX_INTERVAL, SCRAPE_RETRY_INTERVAL, SCRAPE_JITTER, SCRAPE_WINDOWS,
+    PRICE_HISTORY_RETENTION_DAYS, PRICE_MAINTENANCE_INTERVAL, STATS_TTL, METRICS_HOST, METRICS_PORT,
+    WATCH_DEFAULT_THRESHOLD, WATCH_MAX_PER_USER
+)
+from text_utils import AnswerFormatter
+from write_behind import write_behind
 
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 CHANNEL_ID = os.getenv("CHANNEL_ID")
 PERPLEXITY_API_KEY = os.getenv("PERPLEXITY_API_KEY")
-CHECK_INTERVAL = int(os.getenv("CHECK_INTERVAL", "18000"))
-
-
+PERPLEXITY_STREAM = os.getenv("PERPLEXITY_STREAM", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "3"))
+WARMUP_QUESTION = "Какая польза у коллагена?"
+# Порог в /watch пишется со знаком %: число без него может быть частью названия («Омега 3»)
+WATCH_THRESHOLD_RE = re.compile(r"^(\d+(?:[.,]\d+)?)%$")
 
-# Инициализация Perplexity API
-if PERPLEXITY_API_KEY:
-    init_perplexity(PERPLEXITY_API_KEY)
-    answer = ask_perplexity("Какая польза у коллагена?")
-    
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -35,9 +63,26 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 router = Router()
+question_scheduler = QuestionScheduler(QUESTION_CONCURRENCY, QUESTION_QUEUE_SIZE)
+price_tracker = PriceTracker()
+catalog_scraper = CatalogScraper(CITY_IDS, SCRAPE_CONCURRENCY, SCRAPE_RATE_PER_HOST, SCRAPE_BATCH_SIZE)
+loop_lag = LoopLagMonitor()
+price_stats = PriceStats(STATS_TTL)
+scrape_scheduler = ScrapeScheduler(
+    CITY_IDS, CHECK_INTERVAL, SCRAPE_MIN_INTERVAL, SCRAPE_MAX_INTERVAL,
+    SCRAPE_RETRY_INTERVAL, parse_windows(SCRAPE_WINDOWS), SCRAPE_JITTER
+)
+price_events = PriceEventPipeline()
+price_pass_done = asyncio.Event()  # проход цен сохранён: пора обслужить историю и пересчитать сводку
+startup = Startup()
+QUESTIONS_ACTIVE.set_function(lambda: question_scheduler.stats()["active"])
+QUESTIONS_QUEUED.set_function(lambda: question_scheduler.stats()["queued"])
+# Цикл цен выполняет только одна реплика из запущенных
+scraping_leader = LeaderElection("price_scraping", LEADER_RETRY_INTERVAL, LEADER_CHECK_INTERVAL)
 
 
 @router.channel_post()
+@timed_handler("channel_post")
 async def channel_post_handler(message: types.Message):
     if not PERPLEXITY_API_KEY:
         await message.reply("Perplexity API ключ не задан.")
@@ -47,20 +92,71 @@ async def channel_post_handler(message: types.Message):
     if not user_query:
         return
 
+    mention = f'<a href="tg://user?id={message.from_user.id}">{message.from_user.full_name}</a>' if message.from_user else None
+    # В канале from_user обычно пуст — различаем авторов по подписи, иначе по чату
+    author = message.from_user.id if message.from_user else (message.author_signature or message.chat.id)
+
+    placeholder = None
     try:
-        mention = f'<a href="tg://user?id={message.from_user.id}">{message.from_user.full_name}</a>' if message.from_user else None
+        # Заглушка, место в очереди и отказ — необязательные запросы: лимит канала (20 в минуту)
+        # достаётся финальным ответам, а без заглушки ответ придёт отдельным сообщением
+        try:
+            with best_effort():
+                placeholder = await message.reply("Запрос отправлен, ожидайте ответа...")
+        except TelegramRetryAfter:
+            logger.info("Заглушка ответа пропущена: исчерпан лимит сообщений канала")
 
-        await message.reply("Запрос отправлен, ожидайте ответа...")
-        logger.info(f"Обработка запроса: {user_query[:50]}...")
-        
-        loop = asyncio.get_event_loop()
-        raw_answer = await loop.run_in_executor(None, ask_perplexity, user_query)
-        
-        cleaned_answer = clean_telegram_html(raw_answer)
-        answer_with_links = convert_markdown_links_to_html(cleaned_answer)
+        async def on_queued(position: int):
+            if placeholder is None:
+                return
+            try:
+                with best_effort():
+                    await placeholder.edit_text(f"Вы {position}-й в очереди, ожидайте ответа...")
+            except (TelegramBadRequest, TelegramRetryAfter) as e:
+                logger.warning(f"Не удалось показать позицию в очереди: {e}")
+
+        await question_scheduler.submit(
+            author, lambda: answer_question(message, placeholder, user_query, mention), on_queued=on_queued
+        )
+    except QueueFull:
+        logger.warning("Очередь вопросов переполнена")
+        try:
+            with best_effort():
+                text = "Сейчас слишком много вопросов, попробуйте повторить позже."
+                await (placeholder.edit_text(text) if placeholder else message.reply(text))
+        except (TelegramBadRequest, TelegramRetryAfter) as e:
+            logger.warning(f"Не удалось сообщить о переполненной очереди: {e}")
+    except Exception as e:
+        logger.error(f"Ошибка обработки запроса: {e}")
+        await message.reply("Произошла ошибка при обработке вашего запроса.")
 
-        reply_text = f"{mention}, {answer_with_links}" if mention else answer_with_links
- 
+@timed_handler("answer_question")
+async def answer_question(message: types.Message, placeholder: Optional[types.Message], user_query: str, mention):
+    logger.info(f"Обработка запроса: {user_query[:50]}...")
+    
+    # Разметка разбирается по мере поступления текста, каждый фрагмент — один раз
+    formatter = AnswerFormatter()
+    if PERPLEXITY_STREAM:
+        # Ответ появляется по мере генерации правками сообщения-заглушки
+        stream = StreamingMessage(
+            message.bot, message.chat.id, placeholder.message_id if placeholder else None,
+            interval=STREAM_EDIT_INTERVAL, reply_to=message.message_id
+        )
+        async for delta in ask_perplexity_stream(user_query):
+            formatter.feed(delta)
+            if stream.due():
+                await stream.update(formatter.render(), parse_mode="HTML", disable_web_page_preview=True)
+    else:
+        formatter.feed(await ask_perplexity_async(user_query))
+    
+    answer_with_links = formatter.finish()
+
+    reply_text = f"{mention}, {answer_with_links}" if mention else answer_with_links
+
+    if PERPLEXITY_STREAM:
+        if not await stream.finish(reply_text, parse_mode="HTML", disable_web_page_preview=True):
+            return
+    else:
         await send_long_message(
             bot=message.bot,
             chat_id=message.chat.id,
@@ -68,103 +164,471 @@ async def channel_post_handler(message: types.Message):
             parse_mode="HTML",  # Важно использовать HTML-парсинг
             disable_web_page_preview=True
         )
-        logger.info("Ответ успешно отправлен")
-        
+    logger.info("Ответ успешно отправлен")
+
+async def load_price_state(leader_token) -> bool:
+    """Перезагрузка состояния цен после смены ведущей реплики; False — БД недоступна, повторим позже"""
+    if scraping_leader.token == leader_token:
+        return True
+    try:
+        # Пока реплика была резервной, состояние цен менял прежний ведущий,
+        # а частоту проверок оцениваем заново по истории цен
+        await price_tracker.load()
+        await scrape_scheduler.seed()
+        return True
     except Exception as e:
-        logger.error(f"Ошибка обработки запроса: {e}")
-        await message.reply("Произошла ошибка при обработке вашего запроса.")
+        logger.error(f"Не удалось загрузить состояние цен, повтор через {LEADER_RETRY_INTERVAL:.0f} с: {e}")
+        return False
 
-async def price_scraping_loop(bot: Bot):
+async def price_scraping_loop():
     await asyncio.sleep(10)
     logger.info("Запущен цикл отслеживания цен")
+    leader_token = None
     
     while True:
+        if not scraping_leader.is_leader:
+            logger.info("Ожидаем, пока реплика станет ведущей для цикла цен")
+            await scraping_leader.wait_leadership()
+        token = scraping_leader.token
+        if not await load_price_state(leader_token):
+            await asyncio.sleep(LEADER_RETRY_INTERVAL)
+            continue
+        leader_token = token
+        due = scrape_scheduler.due()
+        if not due:
+            await scrape_scheduler.wait()
+            continue
         try:
-            products = fetch_products()
-            old_state = load_state()
-            pinned_message_id = load_pinned_message_id()
-            new_state = {}
-            price_drop_messages = []
-            price_increase_detected = False
-
-            for product in products:
-                try:
-                    product_id = str(product.get('id', ''))
-                    product_name = str(product.get('name', 'Без названия'))
-                    
-                    # Обработка цены
-                    new_price = product.get('price', 0)
-                    if isinstance(new_price, dict):
-                        new_price = new_price.get('current', 0)
-                    new_price = float(new_price)
-                    
-                    # Если товара нет в старом состоянии
-                    if product_id not in old_state:
-                        new_state[product_id] = {
-                            'price': new_price,
-                            'last_notified_price': new_price
-                        }
-                        continue
-                    
-                    # Получаем данные из старого состояния
-                    state_data = old_state.get(product_id, {})
-                    old_price = float(state_data.get('price', new_price))
-                    last_notified = float(state_data.get('last_notified_price', old_price))
-                    
-                    # Сохраняем новое состояние
-                    new_state[product_id] = {
-                        'price': new_price,
-                        'last_notified_price': last_notified
-                    }
-
-                    # Проверяем изменения цены
-                    if new_price < old_price and new_price != last_notified:
-                        msg = f"📉 Цена на '{product_name}' снизилась: {old_price} ₽ → {new_price} ₽"
-                        price_drop_messages.append(msg)
-                        new_state[product_id]['last_notified_price'] = new_price
-                    elif new_price > old_price:
-                        price_increase_detected = True
-                        new_state[product_id]['last_notified_price'] = new_price
-
-                except (KeyError, ValueError, TypeError) as e:
-                    logger.warning(f"Пропускаем товар: {e}")
-
-            if price_drop_messages:
-                full_message = "🔥 **АКЦИЯ!**\n\n" + "\n".join(price_drop_messages)
-                sent_message = await bot.send_message(CHANNEL_ID, full_message, parse_mode="Markdown")
-                await bot.pin_chat_message(CHANNEL_ID, sent_message.message_id)
-                save_pinned_message_id(sent_message.message_id)
-            elif price_increase_detected and pinned_message_id:
-                await bot.unpin_chat_message(CHANNEL_ID, pinned_message_id)
-                save_pinned_message_id(None)
-
-            save_state(new_state)
-            logger.info(f"Обработано {len(products)} товаров, изменений: {len(price_drop_messages)}")
+            loop_lag.take_max()
+            cycle_started = time.monotonic()
+            catalogs = await catalog_scraper.fetch_all(due)
+            updated = [catalog for catalog in catalogs if catalog.changed]
+            changes = PriceChanges()
+            try:
+                for catalog in updated:
+                    # Каталог разбирается потоково: пачка уходит в журнал записи и сразу сверяется с индексом цен
+                    async for batch in catalog_scraper.iter_batches(catalog):
+                        await price_tracker.process(catalog.city_id, batch, changes)
+            finally:
+                # Если проход прервался, тела остальных каталогов (временные файлы) иначе остались бы открытыми
+                for catalog in catalogs:
+                    catalog.close()
+
+            # Реплика, у которой перехватили лидерство, не должна ни рассылать изменения, ни сохранять состояние.
+            # Токен с таблицей сверяет фоновая проверка лидерства, здесь — без запроса к БД
+            scraping_leader.check()
+            # Канал, подписчики и БД получают изменения прохода через конвейер событий, каждый в своей задаче
+            await price_events.publish(changes.events)
 
+            # Снижения для канала применяются к индексу, когда ChannelSink подтвердит пост
+            await price_tracker.commit(changes)
+            for catalog in updated:
+                catalog_scraper.remember(catalog)
+            # Срок следующей проверки города зависит от того, менялись ли в нём цены
+            fetched = {catalog.city_id for catalog in catalogs}
+            for city_id in due:
+                if city_id in fetched:
+                    scrape_scheduler.record_success(
+                        city_id, sum(1 for event in changes.events if event.city_id == city_id)
+                    )
+                else:
+                    scrape_scheduler.record_failure(city_id)
+            due = []  # проход сохранён: дальнейшие ошибки не откладывают проверку городов
+            if changes.catalog_changed or any(catalog.removed_count for catalog in updated):
+                # Новые и пропавшие товары меняют контекст промпта — старые ответы больше не актуальны
+                await invalidate_answer_cache()
+            logger.info(
+                f"Обработано {sum(c.products_count for c in updated)} товаров "
+                f"({len(updated)} из {len(fetched)} проверенных городов изменились), изменений цен: {len(changes.events)} "
+                f"(снижений для канала: {len(changes.drops)}), "
+                f"записей состояния: {len(changes.rows)}, "
+                f"макс. задержка event loop: {loop_lag.take_max() * 1000:.0f} мс"
+            )
+            # Свёртка истории и сводка для /stats пересчитываются в фоне (price_maintenance_loop)
+            price_pass_done.set()
+            SCRAPE_CYCLE_SECONDS.observe(time.monotonic() - cycle_started)
+            SCRAPE_PRODUCTS.inc(sum(c.products_count for c in updated))
+            SCRAPE_CYCLES.labels("ok").inc()
+
+        except NotLeader as e:
+            SCRAPE_CYCLES.labels("not_leader").inc()
+            logger.warning(f"Цикл цен прерван, реплика больше не ведущая: {e}")
+            continue
         except Exception as e:
+            SCRAPE_CYCLES.labels("error").inc()
             logger.error(f"Ошибка в цикле отслеживания цен: {e}")
+            # Проход не завершился: города повторяются с нарастающей задержкой, а не сразу
+            for city_id in due:
+                scrape_scheduler.record_failure(city_id)
+
+        # Следующий проход начинается после окончания текущего: проходы не накладываются
+        await scrape_scheduler.wait()
 
-        await asyncio.sleep(CHECK_INTERVAL)
+async def price_maintenance_loop():
+    """Фоновое обслуживание после проходов цен и не реже раза в PRICE_MAINTENANCE_INTERVAL:
+    свёртка и удаление старых секций истории цен (на ведущей реплике) и пересчёт сводки для /stats.
+    Ошибки БД здесь не прерывают проход скрапера и не откладывают проверку городов"""
+    while True:
+        try:
+            await asyncio.wait_for(price_pass_done.wait(), PRICE_MAINTENANCE_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        price_pass_done.clear()
+        try:
+            if scraping_leader.is_leader:
+                db = await Database.get_instance()
+                rolled, dropped = await db.maintain_price_history(
+                    PRICE_HISTORY_RETENTION_DAYS, write_behind.oldest_pending()
+                )
+                if rolled or dropped:
+                    logger.info(f"История цен: {rolled} дневных агрегатов, удалены секции: {', '.join(dropped) or '-'}")
+            await price_stats.refresh()
+        except Exception as e:
+            logger.error(f"Ошибка обслуживания истории цен: {e}")
         
+def _rub(value) -> str:
+    return f"{float(value):.2f}".rstrip("0").rstrip(".") + " ₽"
+
+
+def _ago(seconds: float) -> str:
+    if seconds < 120:
+        return f"{seconds:.0f} с"
+    return f"{seconds / 60:.0f} мин"
+
+
 @router.message(Command("stats"))
+@timed_handler("stats")
 async def send_stats(message: types.Message):
     try:
-        stats = "📊 Статистика базы данных:\n"
-        stats += f"• Доступ в pgAdmin: http://localhost:6432\n"
-        stats += f"  Логин: admin@admin.com\n"
-        stats += f"  Пароль: metallica"
+        summary = await price_stats.get_summary()
+        stats = "📊 Статистика:\n"
+        if summary:
+            stats += (
+                f"• Товаров отслеживается: {summary['products']} (городов: {summary['cities']})\n"
+                f"• Изменений цен за 24 ч: {summary['changes_day']} (снижений {summary['drops_day']}), "
+                f"за 7 дней: {summary['changes_week']} (снижений {summary['drops_week']}), "
+                f"новых товаров за 7 дней: {summary['new_week']}\n"
+            )
+            if summary['top_drops']:
+                stats += "• Крупнейшие снижения за 7 дней:\n"
+                for drop in summary['top_drops']:
+                    percent = (drop['previous'] - drop['price']) / drop['previous'] * 100
+                    stats += (
+                        f"  – {drop['name']}: {_rub(drop['previous'])} → {_rub(drop['price'])} (−{percent:.0f}%)"
+                        + (f", город {drop['city_id']}" if len(CITY_IDS) > 1 else "") + "\n"
+                    )
+            stats += f"• Данные о ценах обновлены {_ago(price_stats.age())} назад\n"
+        cache = answer_cache_stats()
+        if cache:
+            stats += (
+                f"• Кэш ответов: {cache['hit_rate'] * 100:.0f}% попаданий "
+                f"({cache['hits'] + cache['db_hits']} из {cache['hits'] + cache['db_hits'] + cache['misses']}), "
+                f"{cache['evictions']} вытеснений\n"
+            )
+        latency = perplexity_latency_stats()
+        if latency and latency['answer']['count']:
+            answer = latency['answer']
+            stats += (
+                f"• Perplexity, ответ: p50 {answer['p50']:.1f} с, p90 {answer['p90']:.1f} с, "
+                f"p99 {answer['p99']:.1f} с ({answer['count']} запросов)\n"
+            )
+            first = latency['first_token']
+            if first['count']:
+                stats += f"• Perplexity, первый фрагмент: p50 {first['p50']:.1f} с, p90 {first['p90']:.1f} с\n"
+        queue = question_scheduler.stats()
+        stats += (
+            f"• Очередь вопросов: {queue['active']} в работе, {queue['queued']} ждут, "
+            f"{queue['rejected']} отклонено, ожидание ср. {queue['avg_wait']:.1f} с / макс. {queue['max_wait']:.1f} с\n"
+        )
+        sender = telegram_sender.stats()
+        stats += (
+            f"• Отправка в Telegram: {sender['sent']} запросов, {sender['waiting']} ждут, "
+            f"429: {sender['flood_waits']}, пропущено правок: {sender['skipped']}, "
+            f"объединено уведомлений: {sender['coalesced']}, "
+            f"ожидание ср. {sender['avg_wait']:.2f} с / макс. {sender['max_wait']:.1f} с\n"
+        )
+        if scraping_leader.is_leader:
+            schedule = scrape_scheduler.stats()
+            stats += (
+                f"• Проверка цен: следующая через {_ago(schedule['next_in'])}, интервал "
+                + ", ".join(
+                    (f"{city_id} — " if len(CITY_IDS) > 1 else "") + _ago(city['interval'])
+                    + (f" (ошибок подряд: {city['failures']})" if city['failures'] else "")
+                    for city_id, city in schedule['cities'].items()
+                )
+                + (f", окно акций: каждые {_ago(schedule['window'])}" if schedule['window'] else "")
+                + "\n"
+            )
+        journal = write_behind.stats()
+        if journal['bytes'] or journal['dropped']:
+            stats += (
+                f"• Журнал записи в БД: {journal['bytes'] / 1024:.0f} КБ ждут записи ({journal['segments']} сегм.)"
+                + (f", повтор через {_ago(journal['delay'])}" if journal['delay'] > write_behind.flush_interval else "")
+                + (f", пропущено записей: {journal['dropped']}" if journal['dropped'] else "")
+                + "\n"
+            )
+        ready = startup.status()
+        stats += f"• Готовность: {', '.join(ready['ready']) or '-'}"
+        if ready['pending']:
+            stats += f"; запускаются: {', '.join(ready['pending'])}"
+        if ready['failed']:
+            stats += f"; ошибки: {', '.join(ready['failed'])}"
         await message.reply(stats)
     except Exception as e:
         logger.error(f"Ошибка получения статистики: {e}")
         await message.reply("Ошибка получения статистики")
 
+def _find_product(query: str):
+    """Товар по точному id или лучший результат поиска по названию"""
+    return product_index.get(query) or next(iter(product_index.search(query, top_k=1)), None)
+
+
+def _parse_watch(args: str):
+    """'/watch коллаген 10%' -> ('коллаген', 10.0); без порога — порог по умолчанию"""
+    query, _, last = args.rpartition(" ")
+    match = WATCH_THRESHOLD_RE.match(last)
+    if query.strip() and match:
+        return query.strip(), float(match[1].replace(",", "."))
+    return args, WATCH_DEFAULT_THRESHOLD
+
+
+async def _watch_user(message: types.Message):
+    """id пользователя для подписок; подписки оформляются только в личном чате с ботом"""
+    if message.chat.type != "private" or not message.from_user:
+        await message.reply("Подписки на цены оформляются в личном чате с ботом")
+        return None
+    return message.from_user.id
+
+
+@router.message(Command("price"))
+@timed_handler("price")
+async def send_price(message: types.Message, command: CommandObject):
+    query = (command.args or "").strip()
+    if not query:
+        await message.reply("Укажите товар: /price <название или id>")
+        return
+    try:
+        product = _find_product(query)
+        if product is None:
+            await message.reply("Товар не найден")
+            return
+        rows = await price_stats.product(product.id)
+        if not rows:
+            await message.reply("Цены на товар пока неизвестны")
+            return
+        text = f"💰 {rows[0]['name']}\n"
+        for row in rows:
+            if len(rows) > 1:
+                text += f"\nГород {row['city_id']}:\n"
+            text += f"• Цена: {_rub(row['price'])}\n"
+            if row['previous'] is not None:
+                text += f"• Последнее изменение {row['changed_at']:%d.%m.%Y}: {_rub(row['previous'])} → {_rub(row['price'])}\n"
+            if row['min_price'] is not None:
+                low, high = min(row['min_price'], row['price']), max(row['max_price'], row['price'])
+                text += f"• За {price_stats.history_days} дней: от {_rub(low)} до {_rub(high)}\n"
+        await message.reply(text)
+    except Exception as e:
+        logger.error(f"Ошибка получения цены товара: {e}")
+        await message.reply("Ошибка получения цены товара")
+
+@router.message(Command("watch"))
+@timed_handler("watch")
+async def watch_product(message: types.Message, command: CommandObject):
+    user_id = await _watch_user(message)
+    if user_id is None:
+        return
+    query, threshold = _parse_watch((command.args or "").strip())
+    if not query:
+        await message.reply("Укажите товар и, если нужно, порог снижения: /watch <название или id> [10%]")
+        return
+    if not 0 <= threshold < 100:
+        await message.reply("Порог снижения — от 0 до 100%")
+        return
+    try:
+        product = _find_product(query)
+        if product is None:
+            await message.reply("Товар не найден")
+            return
+        db = await Database.get_instance()
+        if not await db.add_watch(user_id, product.id, threshold, WATCH_MAX_PER_USER):
+            await message.reply(f"В списке уже {WATCH_MAX_PER_USER} товаров — удалите лишние через /unwatch")
+            return
+        condition = f"подешевеет на {threshold:g}% и больше" if threshold else "подешевеет"
+        await message.reply(f"🔔 Сообщу, когда «{product.name}» {condition}")
+    except Exception as e:
+        logger.error(f"Ошибка подписки на цену: {e}")
+        await message.reply("Ошибка подписки на цену")
+
+@router.message(Command("unwatch"))
+@timed_handler("unwatch")
+async def unwatch_product(message: types.Message, command: CommandObject):
+    user_id = await _watch_user(message)
+    if user_id is None:
+        return
+    query = (command.args or "").strip()
+    if not query:
+        await message.reply("Укажите товар: /unwatch <название или id>")
+        return
+    try:
+        product = _find_product(query)
+        db = await Database.get_instance()
+        if product is None or not await db.remove_watch(user_id, product.id):
+            await message.reply("Этого товара нет в вашем списке (/watchlist)")
+            return
+        await message.reply(f"Подписка на «{product.name}» отменена")
+    except Exception as e:
+        logger.error(f"Ошибка отмены подписки: {e}")
+        await message.reply("Ошибка отмены подписки")
+
+@router.message(Command("watchlist"))
+@timed_handler("watchlist")
+async def send_watchlist(message: types.Message):
+    user_id = await _watch_user(message)
+    if user_id is None:
+        return
+    try:
+        db = await Database.get_instance()
+        watches = await db.load_watches(user_id)
+        if not watches:
+            await message.reply("Список пуст. Добавьте товар: /watch <название или id> [10%]")
+            return
+        text = "🔔 Ваши подписки на снижение цен:\n"
+        for watch in watches:
+            price = f", сейчас {_rub(watch['price'])}" if watch['price'] is not None else ""
+            threshold = f"от {float(watch['threshold']):g}%" if watch['threshold'] else "любое снижение"
+            text += f"• {watch['name'] or watch['product_id']}{price} ({threshold})\n"
+        await send_long_message(message.bot, message.chat.id, text)
+    except Exception as e:
+        logger.error(f"Ошибка получения списка подписок: {e}")
+        await message.reply("Ошибка получения списка подписок")
+
+def create_bot() -> Bot:
+    if TELEGRAM_API_URL:
+        # Локальный Bot API сервер (или заглушка в бенчмарках)
+        bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+    else:
+        bot = Bot(token=BOT_TOKEN)
+    # Все исходящие запросы проходят через лимиты Telegram и повторы после 429
+    bot.session.middleware(telegram_sender)
+    return bot
+
+def start_components():
+    """Инициализация без блокировки polling: всё поднимается параллельно в фоне"""
+    if PERPLEXITY_API_KEY:
+        init_perplexity(PERPLEXITY_API_KEY)  # HTTP-сессия создаётся лениво при первом запросе
+        if PERPLEXITY_WARMUP:
+            startup.start("perplexity_warmup", warm_up_perplexity(WARMUP_QUESTION))
+    startup.start("db", Database.get_instance())
+    startup.start("product_index", product_index.load_from_db())
+    startup.start("price_state", price_tracker.load())
+
+def start_price_events(bot: Bot):
+    """Приёмники изменений цен: пост в канал, личные уведомления подписчикам, таблица price_events"""
+    with_city = len(CITY_IDS) > 1
+    price_events.add_sink("channel", ChannelSink(
+        bot, CHANNEL_ID, scraping_leader.ensure_fence, with_city,
+        on_delivered=price_tracker.confirm_notified, on_failed=price_tracker.release_notified
+    ))
+    price_events.add_sink("watchlist", WatchlistSink(bot, with_city))
+    price_events.add_sink("db", store_price_events)
+    price_events.start()
+
+async def close_price_events():
+    """Обработчик dp.shutdown: уведомления о ценах, принятые до остановки, успевают уйти"""
+    await price_events.close(SHUTDOWN_DRAIN_TIMEOUT)
+
+async def drain_questions():
+    """Обработчик dp.shutdown (до закрытия сессии бота): принятые вопросы дорабатываются и получают ответы"""
+    stats = question_scheduler.stats()
+    if stats['active'] or stats['queued']:
+        logger.info(f"Дорабатываем вопросы перед остановкой: {stats['active']} в работе, {stats['queued']} в очереди")
+    cancelled = await question_scheduler.drain(SHUTDOWN_DRAIN_TIMEOUT)
+    if cancelled:
+        logger.warning(f"Не успели ответить на {cancelled} вопросов за {SHUTDOWN_DRAIN_TIMEOUT:.0f} с")
+
+async def set_webhook(bot: Bot, dispatcher: Dispatcher):
+    # Каждая реплика ставит один и тот же адрес — повторный вызов безопасен
+    await bot.set_webhook(
+        f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=dispatcher.resolve_used_update_types()
+    )
+    logger.info(f"Webhook установлен: {WEBHOOK_URL}{WEBHOOK_PATH}")
+
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    """Приём апдейтов через webhook: Telegram сразу получает 200, обработчики работают в фоне"""
+    if not WEBHOOK_SECRET:
+        logger.warning("WEBHOOK_SECRET не задан — запросы к webhook не проверяются")
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET or None, handle_in_background=True
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logger.info(f"Webhook-сервер слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    # Адрес сообщаем Telegram только когда сервер уже принимает запросы
+    await set_webhook(bot, dp)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+        logger.info("Получен сигнал остановки")
+    finally:
+        # Сначала закрывается приём запросов, затем dp.shutdown дорабатывает вопросы, затем закрывается сессия
+        await runner.cleanup()
+
 async def main():
-    bot = Bot(token=BOT_TOKEN)
+    startup.begin()
+    bot = create_bot()
     dp = Dispatcher()
     dp.include_router(router)
-    asyncio.create_task(price_scraping_loop(bot))
+    dp.update.outer_middleware(startup.track_updates)
+    dp.startup.register(startup.mark_receiving)
+    dp.shutdown.register(drain_questions)
+    dp.shutdown.register(close_price_events)
+    # Журнал отложенной записи поднимается первым: загрузка состояния цен сначала досохраняет его в БД
+    write_behind.start()
+    start_components()
+    start_price_events(bot)
+    metrics_runner = None
+    if METRICS_PORT:
+        try:
+            metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            logger.error(f"Не удалось запустить сервер метрик на порту {METRICS_PORT}: {e}")
+    asyncio.create_task(loop_lag.run())
+    asyncio.create_task(scraping_leader.run())
+    scraping_task = asyncio.create_task(price_scraping_loop())
+    maintenance_task = asyncio.create_task(price_maintenance_loop())
     logger.info("Бот запущен и слушает канал...")
-    await dp.start_polling(bot)
+    try:
+        if WEBHOOK_URL:
+            await run_webhook(bot, dp)
+        else:
+            try:
+                await bot.delete_webhook()  # после работы через webhook getUpdates без этого не работает
+            except Exception as e:
+                logger.warning(f"Не удалось снять webhook: {e}")
+            await dp.start_polling(bot)
+    finally:
+        # Проход цен прерывается на любом шаге: состояние цен сохраняется только целым проходом
+        scraping_task.cancel()
+        maintenance_task.cancel()
+        await asyncio.gather(scraping_task, maintenance_task, return_exceptions=True)
+        await startup.cancel()
+        await close_perplexity()
+        await catalog_scraper.close()
+        await scraping_leader.close()
+        await write_behind.close(SHUTDOWN_DRAIN_TIMEOUT)
+        await Database.close_instance()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
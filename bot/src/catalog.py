@@ -0,0 +1,102 @@
+import math
+import sys
+from array import array
+from dataclasses import dataclass
+from itertools import compress, repeat
+from operator import ne
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+NO_PRICE = math.nan
+
+
+def intern_id(value) -> str:
+    """Строка id/города/категории в одном экземпляре на процесс: индексы цен и поиска,
+    а также пачки каждого прохода ссылаются на один и тот же объект"""
+    return sys.intern(str(value))
+
+
+@dataclass(slots=True)
+class Product:
+    """Товар каталога в одном городе (нормализованная запись из ответа nlstar или из БД)"""
+    city_id: str
+    id: str
+    name: str
+    short_name: str = ""
+    price: float = 0.0
+    category: str = ""
+
+    def as_row(self) -> Tuple[str, str, str, str, float, str]:
+        """Строка для products_stage (см. Database.save_products)"""
+        return self.city_id, self.id, self.name, self.short_name, self.price, self.category
+
+    @classmethod
+    def from_row(cls, row) -> "Product":
+        """Запись из таблицы products (Database.load_products): цена и город там не выбираются"""
+        return cls(
+            intern_id(row.get("city_id") or ""), intern_id(row["id"]), row["name"] or "",
+            row.get("short_name") or "", float(row.get("price") or 0.0), intern_id(row.get("category") or "")
+        )
+
+
+class CityPrices:
+    """Цены одного города столбцами: id товаров и два array('d') (цена, последняя уведомлённая цена),
+    выровненные по позиции товара; positions — id -> позиция.
+
+    Последний элемент массивов — NaN-заглушка: позиция -1 (товара нет) читается как NaN,
+    поэтому старые цены пачки выбираются одним map() без проверок в Python (changed_positions).
+    """
+    __slots__ = ("ids", "positions", "prices", "notified")
+
+    def __init__(self, rows: Iterable[Tuple[str, float, float]] = ()):
+        self.ids: List[str] = []
+        self.positions: Dict[str, int] = {}
+        self.prices = array("d")
+        self.notified = array("d")
+        for product_id, price, last_notified in rows:
+            self.positions[product_id] = len(self.ids)
+            self.ids.append(product_id)
+            self.prices.append(price)
+            self.notified.append(last_notified)
+        self.prices.append(NO_PRICE)
+        self.notified.append(NO_PRICE)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, product_id: str) -> Optional[Tuple[float, float]]:
+        position = self.positions.get(product_id)
+        return None if position is None else (self.prices[position], self.notified[position])
+
+    def set(self, product_id: str, price: float, last_notified: float):
+        position = self.positions.get(product_id)
+        if position is None:
+            # Новый товар занимает место заглушки, заглушка сдвигается в конец
+            position = self.positions[product_id] = len(self.ids)
+            self.ids.append(product_id)
+            self.prices.append(NO_PRICE)
+            self.notified.append(NO_PRICE)
+        self.prices[position] = price
+        self.notified[position] = last_notified
+
+    def lookup(self, product_ids: List[str]) -> List[int]:
+        """Позиции товаров (-1 — товара нет)"""
+        return list(map(self.positions.get, product_ids, repeat(-1)))
+
+    def __iter__(self) -> Iterator[Tuple[str, float, float]]:
+        return zip(self.ids, self.prices, self.notified)
+
+    def nbytes(self) -> int:
+        """Примерный объём столбцов без самих строк id (они общие с остальным процессом)"""
+        return (sys.getsizeof(self.ids) + sys.getsizeof(self.positions)
+                + self.prices.itemsize * len(self.prices) * 2)
+
+
+def changed_positions(column: array, positions: List[int], new: Sequence[float]) -> List[int]:
+    """Номера товаров пачки, чья цена new[k] не совпадает с column[positions[k]].
+
+    Старые цены выбираются и сравниваются с новыми в одном проходе на C (map по operator.ne
+    и itertools.compress), без промежуточных массивов; Python-код потом выполняется только
+    для изменившихся товаров. Новые товары (позиция -1, NaN-заглушка) тоже попадают в список:
+    NaN не равен никакой цене.
+    """
+    return list(compress(range(len(new)), map(ne, map(column.__getitem__, positions), new)))
@@ -0,0 +1,266 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Set, TypeVar
+
+from metrics import EVENT_LOOP_LAG
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Объединяет одновременные вызовы с одинаковым ключом в один общий запрос"""
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        self.joined = 0  # сколько вызовов присоединилось к уже идущему запросу
+
+    def __len__(self):
+        return len(self._calls)
+
+    def get(self, key: Hashable) -> Optional[asyncio.Future]:
+        return self._calls.get(key)
+
+    def lead(self, key: Hashable, fut: Optional[asyncio.Future] = None) -> asyncio.Future:
+        """Регистрирует вызывающего ведущим по ключу; он обязан завершить возвращённый future"""
+        if fut is None:
+            fut = asyncio.get_running_loop().create_future()
+        self._calls[key] = fut
+        fut.add_done_callback(lambda done: self._forget(key, done))
+        return fut
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        fut = self._calls.get(key)
+        if fut is None:
+            fut = self.lead(key, asyncio.ensure_future(fn()))
+        else:
+            self.joined += 1
+        # shield: отмена одного ожидающего не должна обрывать запрос для остальных
+        return await asyncio.shield(fut)
+
+    def _forget(self, key: Hashable, fut: asyncio.Future):
+        if self._calls.get(key) is fut:
+            del self._calls[key]
+        if not fut.cancelled():
+            fut.exception()  # помечаем исключение как полученное, даже если ждать уже некому
+
+
+class TokenBucket:
+    """Ограничитель частоты: rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()  # ожидающие получают токены по очереди
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens: float = 1):
+        async with self._lock:
+            self._refill()
+            while self._tokens < tokens:
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= tokens
+
+    def try_acquire(self, tokens: float = 1, reserve: float = 0) -> bool:
+        """Берёт токен, только если он есть прямо сейчас и никто не ждёт в очереди;
+        reserve токенов при этом остаются нетронутыми (для обязательных запросов)"""
+        if self._lock.locked():
+            return False
+        self._refill()
+        if self._tokens < tokens + reserve:
+            return False
+        self._tokens -= tokens
+        return True
+
+    def pause(self, seconds: float):
+        """Следующий токен выдаётся не раньше чем через seconds (например, после ответа 429)"""
+        self._refill()
+        self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+
+class QueueFull(Exception):
+    pass
+
+
+class QuestionScheduler:
+    """Допуск вопросов к обработке: не больше max_concurrency одновременно,
+    остальные ждут в ограниченной очереди, пользователи обслуживаются по кругу
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self._active = 0
+        self._queued = 0
+        self._queues: "OrderedDict[Hashable, deque]" = OrderedDict()
+        self._tasks: Set[asyncio.Task] = set()
+        self._notices: Dict[asyncio.Future, asyncio.Task] = {}  # уведомления о месте в очереди, ещё не отправленные
+        self.closing = False  # после drain() новые вопросы не принимаются
+        # Метрики
+        self.started = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def position(self, user: Hashable) -> int:
+        """Номер в очереди для следующего вопроса пользователя при обходе по кругу"""
+        own = len(self._queues.get(user, ())) + 1
+        return own + sum(min(len(q), own) for u, q in self._queues.items() if u != user)
+
+    async def submit(self, user: Hashable, fn: Callable[[], Awaitable[T]],
+                     on_queued: Optional[Callable[[int], Awaitable[None]]] = None) -> T:
+        fut = asyncio.get_running_loop().create_future()
+        job = (fn, fut, time.monotonic())
+        if self.closing:
+            self.rejected += 1
+            raise QueueFull()
+        if self._active < self.max_concurrency and not self._queued:
+            self._start(job)
+        else:
+            if self._queued >= self.max_queue:
+                self.rejected += 1
+                raise QueueFull()
+            # Место занимается сразу после проверки, без await между ними: лимит очереди
+            # и порядок поступления соблюдаются при одновременных вопросах
+            position = self.position(user)
+            self._queues.setdefault(user, deque()).append(job)
+            self._queued += 1
+            if on_queued:
+                # Уведомление о месте в очереди отправляется в фоне; если вопрос успеет
+                # дойти до обработки раньше, оно отменяется (см. _start)
+                notice = asyncio.ensure_future(self._notify(on_queued, position))
+                self._notices[fut] = notice
+                notice.add_done_callback(lambda _: self._notices.pop(fut, None))
+            self._dispatch()
+        # Отмена ожидающего отменяет future: из очереди задача будет пропущена, запущенная — прервана
+        return await fut
+
+    @staticmethod
+    async def _notify(on_queued: Callable[[int], Awaitable[None]], position: int):
+        try:
+            await on_queued(position)
+        except Exception as e:
+            logger.warning(f"Не удалось сообщить место в очереди: {e}")
+
+    def _start(self, job):
+        fn, fut, enqueued_at = job
+        notice = self._notices.pop(fut, None)
+        if notice is not None:
+            notice.cancel()
+        wait = time.monotonic() - enqueued_at
+        self.started += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self._active += 1
+        task = asyncio.ensure_future(self._run(fn, fut))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        fut.add_done_callback(lambda done: task.cancel() if done.cancelled() else None)
+
+    async def _run(self, fn, fut: asyncio.Future):
+        try:
+            result = await fn()
+            if not fut.done():
+                fut.set_result(result)
+        except asyncio.CancelledError:
+            fut.cancel()
+        except Exception as e:
+            if not fut.done():
+                fut.set_exception(e)
+        finally:
+            self._active -= 1
+            self._dispatch()
+
+    def _dispatch(self):
+        while self._active < self.max_concurrency and self._queued:
+            user, queue = next(iter(self._queues.items()))
+            job = queue.popleft()
+            self._queued -= 1
+            del self._queues[user]
+            if queue:
+                self._queues[user] = queue  # пользователь уходит в конец круга
+            if not job[1].cancelled():
+                self._start(job)
+
+    async def drain(self, timeout: float) -> int:
+        """Плавная остановка: новые вопросы отклоняются, принятые (и очередь) дорабатываются
+        не дольше timeout секунд, оставшиеся отменяются. Возвращает число отменённых."""
+        self.closing = True
+        deadline = time.monotonic() + timeout
+        while self._tasks and time.monotonic() < deadline:
+            # Завершившаяся задача сразу запускает следующую из очереди (_dispatch), поэтому ждём по кругу
+            await asyncio.wait(set(self._tasks), timeout=deadline - time.monotonic())
+        left = self._active + self._queued
+        for queue in self._queues.values():
+            for _, fut, _ in queue:
+                fut.cancel()
+        self._queues.clear()
+        for notice in list(self._notices.values()):
+            notice.cancel()
+        self._queued = 0
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        return left
+
+    def stats(self) -> dict:
+        return {
+            "active": self._active,
+            "queued": self._queued,
+            "started": self.started,
+            "rejected": self.rejected,
+            "avg_wait": self.wait_total / self.started if self.started else 0.0,
+            "max_wait": self.wait_max,
+        }
+
+
+class LoopLagMonitor:
+    """Задержка event loop: насколько позже запланированного просыпается периодическая задача"""
+
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.last_lag = 0.0
+        self._max_lag = 0.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.last_lag = max(0.0, loop.time() - started - self.interval)
+            EVENT_LOOP_LAG.observe(self.last_lag)
+            self._max_lag = max(self._max_lag, self.last_lag)
+
+    def take_max(self) -> float:
+        """Максимальная задержка с прошлого вызова"""
+        lag, self._max_lag = self._max_lag, 0.0
+        return lag
+
+
+class LatencyWindow:
+    """Длительности последних size запросов и их процентили"""
+
+    def __init__(self, size: int = 1000):
+        self._samples: deque = deque(maxlen=size)
+        self.count = 0  # всего измерений, включая вытесненные из окна
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+        self.count += 1
+
+    def stats(self) -> dict:
+        ordered = sorted(self._samples)
+        if not ordered:
+            return {"count": 0}
+        pick = lambda q: ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+        return {"count": self.count, "p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99)}
@@ -8,3 +8,87 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 CHANNEL_ID = os.getenv("CHANNEL_ID")
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 
+# Кэш ответов Perplexity
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "86400"))
+# После ошибки БД уровень кэша в PostgreSQL пропускается столько секунд
+ANSWER_CACHE_DB_COOLDOWN = float(os.getenv("ANSWER_CACHE_DB_COOLDOWN", "30"))
+
+# Допуск вопросов к Perplexity
+QUESTION_CONCURRENCY = int(os.getenv("QUESTION_CONCURRENCY", "4"))
+QUESTION_QUEUE_SIZE = int(os.getenv("QUESTION_QUEUE_SIZE", "50"))
+PERPLEXITY_RATE_PER_MIN = float(os.getenv("PERPLEXITY_RATE_PER_MIN", "50"))
+PERPLEXITY_BURST = int(os.getenv("PERPLEXITY_BURST", "5"))
+
+# Пул соединений PostgreSQL
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "30"))
+# Соединение, которое пул не выдавал дольше этого (с), перед выдачей проверяется SELECT 1
+DB_HEALTH_CHECK_IDLE = float(os.getenv("DB_HEALTH_CHECK_IDLE", "30"))
+
+# Города каталога и параметры загрузки
+CITY_IDS = [c.strip() for c in os.getenv("CITY_IDS", "2214").split(",") if c.strip()]
+SCRAPE_CONCURRENCY = int(os.getenv("SCRAPE_CONCURRENCY", "4"))
+SCRAPE_RATE_PER_HOST = float(os.getenv("SCRAPE_RATE_PER_HOST", "2"))
+SCRAPE_BATCH_SIZE = int(os.getenv("SCRAPE_BATCH_SIZE", "1000"))
+
+# Расписание проверки цен: CHECK_INTERVAL — начальный интервал, дальше он подстраивается под частоту
+# изменений в пределах [SCRAPE_MIN_INTERVAL, SCRAPE_MAX_INTERVAL]; после ошибки загрузки повтор
+# через SCRAPE_RETRY_INTERVAL с удвоением. SCRAPE_WINDOWS — окна учащённой проверки по местному
+# времени контейнера: "дни_месяца дни_недели ЧЧ:ММ-ЧЧ:ММ интервал; ...", например
+# "1 * 00:00-03:00 600; * mon-fri 09:00-10:00 1800" (начало месяца и утро будней)
+CHECK_INTERVAL = int(os.getenv("CHECK_INTERVAL", "18000"))
+SCRAPE_MIN_INTERVAL = float(os.getenv("SCRAPE_MIN_INTERVAL", "900"))
+SCRAPE_MAX_INTERVAL = float(os.getenv("SCRAPE_MAX_INTERVAL", "43200"))
+SCRAPE_RETRY_INTERVAL = float(os.getenv("SCRAPE_RETRY_INTERVAL", "60"))
+SCRAPE_JITTER = float(os.getenv("SCRAPE_JITTER", "0.1"))
+SCRAPE_WINDOWS = os.getenv("SCRAPE_WINDOWS", "")
+
+# Запуск: прогрев Perplexity в фоне и адрес Bot API (пусто — api.telegram.org)
+PERPLEXITY_WARMUP = os.getenv("PERPLEXITY_WARMUP", "0") == "1"
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+
+# Webhook: при заданном WEBHOOK_URL (публичный адрес за балансировщиком) вместо polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Сколько секунд при остановке дорабатываются уже принятые вопросы
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "30"))
+
+# Выбор ведущей реплики для цикла цен (advisory lock PostgreSQL)
+LEADER_RETRY_INTERVAL = float(os.getenv("LEADER_RETRY_INTERVAL", "5"))
+LEADER_CHECK_INTERVAL = float(os.getenv("LEADER_CHECK_INTERVAL", "5"))
+
+# Исходящие запросы к Bot API: лимиты Telegram и объединение уведомлений
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))  # запросов в секунду на бота
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))  # в секунду в личный чат
+TELEGRAM_GROUP_RATE_PER_MIN = float(os.getenv("TELEGRAM_GROUP_RATE_PER_MIN", "20"))  # в минуту в группу/канал
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "5"))
+TELEGRAM_COALESCE_WINDOW = float(os.getenv("TELEGRAM_COALESCE_WINDOW", "1"))
+
+# История цен: сырые точки хранятся столько дней, дальше — только дневные агрегаты
+PRICE_HISTORY_RETENTION_DAYS = int(os.getenv("PRICE_HISTORY_RETENTION_DAYS", "180"))
+# Обслуживание истории и пересчёт сводки идут в фоне после каждого прохода и не реже раза в столько секунд
+PRICE_MAINTENANCE_INTERVAL = float(os.getenv("PRICE_MAINTENANCE_INTERVAL", "3600"))
+# Как часто пересчитывается сводка цен для /stats, если цикл цен идёт на другой реплике
+STATS_TTL = float(os.getenv("STATS_TTL", "300"))
+
+# Метрики Prometheus: /metrics на локальном порту (0 — не запускать)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "8000"))
+
+# Подписки на снижение цен (/watch): порог по умолчанию в процентах и лимит на пользователя
+WATCH_DEFAULT_THRESHOLD = float(os.getenv("WATCH_DEFAULT_THRESHOLD", "0"))
+WATCH_MAX_PER_USER = int(os.getenv("WATCH_MAX_PER_USER", "50"))
+
+# Отложенная запись в БД (write_behind): товары, состояние цен и bot_state сначала попадают
+# в локальный журнал и сбрасываются в PostgreSQL пачками в фоне. Каталог журнала должен
+# переживать перезапуск контейнера (том), иначе несброшенные записи теряются
+JOURNAL_DIR = os.getenv("JOURNAL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "journal"))
+JOURNAL_FLUSH_INTERVAL = float(os.getenv("JOURNAL_FLUSH_INTERVAL", "2"))
+JOURNAL_RETRY_MAX = float(os.getenv("JOURNAL_RETRY_MAX", "60"))  # предельная пауза между попытками при недоступной БД
+JOURNAL_MAX_BYTES = int(os.getenv("JOURNAL_MAX_BYTES", str(512 * 1024 * 1024)))  # сверх этого пишем в БД напрямую
+JOURNAL_FSYNC = os.getenv("JOURNAL_FSYNC", "1") == "1"
@@ -1,176 +1,845 @@
-import psycopg2
+import asyncpg
+import asyncio
 import os
 import logging
-import time
 import json
+import re
+import time
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from catalog import Product
+from config import DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_COMMAND_TIMEOUT, DB_HEALTH_CHECK_IDLE
+from metrics import DB_RETRIES, observe_db_query
 
 logger = logging.getLogger(__name__)
 
+# Город, с которым бот работал до поддержки нескольких городов: им помечаются старые записи
+LEGACY_CITY_ID = "2214"
+
+# Ошибки, после которых запрос можно повторить на другом соединении из пула
+RETRYABLE_ERRORS = (asyncpg.PostgresConnectionError, asyncpg.InterfaceError, ConnectionError, OSError)
+
+# price_history секционирована по месяцам: секция price_history_pГГГГММ
+PARTITION_NAME_RE = re.compile(r"^price_history_p(\d{4})(\d{2})$")
+PARTITIONS_AHEAD = 2  # сколько будущих месяцев создаётся заранее
+HEALTH_CHECK_TIMEOUT = 5
+MAINTENANCE_TIMEOUT = 3600  # перенос и первая свёртка большой истории идут дольше DB_COMMAND_TIMEOUT
+ROLLUP_STATE_KEY = "price_history_rollup"  # в bot_state: до какого дня история свёрнута в дневные агрегаты
+
+
+class SaveResult(NamedTuple):
+    saved: int  # сколько товаров записано
+    changed: int  # сколько записей добавлено в price_history
+    errors: List[Tuple[str, str]]  # (id товара, текст ошибки)
+
+
+def _affected_rows(status: str) -> int:
+    """Число строк из статуса команды вида 'INSERT 0 42'"""
+    try:
+        return int(status.rsplit(" ", 1)[-1])
+    except (ValueError, AttributeError):
+        return 0
+
+
+def _next_month(day: date) -> date:
+    return (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+def connection_params() -> dict:
+    """Параметры подключения к PostgreSQL из окружения (общие для пула и выделенных соединений)"""
+    return {
+        "host": os.getenv("DB_HOST", "localhost"),
+        "port": int(os.getenv("DB_PORT", "5432")),
+        "database": os.getenv("DB_NAME", "nlstore"),
+        "user": os.getenv("DB_USER", "mawr"),
+        "password": os.getenv("DB_PASSWORD", "metallica"),
+    }
+
+
 class Database:
+    """Единый асинхронный слой доступа к PostgreSQL поверх пула соединений asyncpg.
+
+    asyncpg подготавливает и кэширует выражения на каждом соединении,
+    поэтому горячие запросы разбираются сервером один раз.
+    """
     _instance = None
-    
+    _connecting: Optional[asyncio.Task] = None
+
     @classmethod
-    def get_instance(cls):
+    async def get_instance(cls):
+        """Общий экземпляр. Подключение идёт одной фоновой задачей: вызывающие ждут её,
+        и отмена ожидающего (например, по таймауту) не прерывает подключение для остальных"""
         if cls._instance is None:
-            cls._instance = cls()
+            if cls._connecting is None:
+                cls._connecting = asyncio.create_task(cls._create_instance())
+            task = cls._connecting
+            try:
+                await asyncio.shield(task)
+            except Exception:
+                if cls._connecting is task:
+                    cls._connecting = None  # следующий вызов попробует подключиться заново
+                raise
         return cls._instance
-    
+
+    @classmethod
+    async def _create_instance(cls):
+        db = cls()
+        await db.connect()
+        try:
+            await db.create_tables()
+        except BaseException:
+            await db.close()
+            raise
+        cls._instance = db
+
+    @classmethod
+    async def close_instance(cls):
+        if cls._connecting is not None and not cls._connecting.done():
+            cls._connecting.cancel()
+        cls._connecting = None
+        if cls._instance is not None:
+            await cls._instance.close()
+            cls._instance = None
+
     def __init__(self):
-        self.conn = None
-        self.connect()
-        self.create_tables()
-    
-    def connect(self, retries=10, delay=2):
-        """Подключение к базе данных с улучшенной логикой повторных попыток"""
+        self.pool: Optional[asyncpg.Pool] = None
+        self._last_used: Dict[int, float] = {}  # pid серверного процесса соединения -> когда выдано пулом
+
+    async def connect(self, retries=10, delay=2):
+        """Создание пула соединений с повторными попытками"""
+        params = connection_params()
+        host, port = params["host"], params["port"]
         for i in range(retries):
             try:
-                self.conn = psycopg2.connect(
-                    host=os.getenv("DB_HOST", "localhost"),
-                    port=os.getenv("DB_PORT", "5432"),
-                    dbname=os.getenv("DB_NAME", "nlstore"),
-                    user=os.getenv("DB_USER", "mawr"),
-                    password=os.getenv("DB_PASSWORD", "metallica"),
-                    connect_timeout=10
+                self.pool = await asyncpg.create_pool(
+                    **params,
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    timeout=10,  # таймаут установки соединения
+                    command_timeout=DB_COMMAND_TIMEOUT,
+                    max_inactive_connection_lifetime=300,
+                    init=self._init_connection,
+                    setup=self._check_connection
                 )
-                self.conn.autocommit = True
-                logger.info(f"Успешное подключение к PostgreSQL на {os.getenv('DB_HOST', 'localhost')}:{os.getenv('DB_PORT', '5432')}")
+                logger.info(f"Успешное подключение к PostgreSQL на {host}:{port}")
                 return
-            except psycopg2.OperationalError as e:
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError) as e:
                 logger.warning(f"Ошибка подключения к БД (попытка {i+1}/{retries}): {e}")
                 if i < retries - 1:
-                    time.sleep(delay)
+                    await asyncio.sleep(delay)
                 else:
                     logger.error("Не удалось подключиться к PostgreSQL после всех попыток")
                     raise
-            except Exception as e:
-                logger.error(f"Неожиданная ошибка подключения к БД: {e}")
-                raise
-    
-    def reconnect(self):
-        """Переподключение к базе данных"""
-        if self.conn:
-            try:
-                self.conn.close()
-            except:
-                pass
-        self.connect()
-    
-    def execute_with_retry(self, query, params=None, retries=3):
-        """Выполнение запроса с повторными попытками при потере соединения"""
+
+    async def close(self):
+        if self.pool:
+            await self.pool.close()
+            self.pool = None
+
+    async def health_check(self, conn=None) -> bool:
+        try:
+            return await (conn or self.pool).fetchval("SELECT 1", timeout=HEALTH_CHECK_TIMEOUT) == 1
+        except Exception as e:
+            logger.warning(f"БД не отвечает: {e}")
+            return False
+
+    async def _init_connection(self, conn):
+        pid = conn.get_server_pid()
+        self._last_used[pid] = time.monotonic()
+        conn.add_termination_listener(lambda _: self._last_used.pop(pid, None))
+
+    async def _check_connection(self, conn):
+        """setup-хук пула: соединение, которое не выдавалось дольше DB_HEALTH_CHECK_IDLE, проверяется перед выдачей.
+        Непрошедшее проверку пул закрывает, а execute_with_retry повторяет запрос на новом соединении"""
+        pid = conn.get_server_pid()
+        now = time.monotonic()
+        idle = now - self._last_used.get(pid, now)
+        self._last_used[pid] = now
+        if idle > DB_HEALTH_CHECK_IDLE and not await self.health_check(conn):
+            raise ConnectionError(f"соединение с БД (pid {pid}) не прошло проверку")
+
+    async def execute_with_retry(self, query, *args, retries=3):
+        """Выполнение запроса с повторными попытками при потере соединения; возвращает строки результата"""
         for i in range(retries):
+            started = time.monotonic()
             try:
-                with self.conn.cursor() as cursor:
-                    cursor.execute(query, params)
-                    return cursor.fetchall() if cursor.description else None
-            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
-                logger.warning(f"Потеря соединения с БД, попытка переподключения ({i+1}/{retries}): {e}")
+                rows = await self.pool.fetch(query, *args)
+                observe_db_query(query, time.monotonic() - started)
+                return rows
+            except RETRYABLE_ERRORS as e:
+                observe_db_query(query, time.monotonic() - started)
+                logger.warning(f"Потеря соединения с БД, повтор на другом соединении ({i+1}/{retries}): {e}")
                 if i < retries - 1:
-                    try:
-                        self.reconnect()
-                    except Exception as reconnect_error:
-                        logger.error(f"Ошибка переподключения: {reconnect_error}")
-                        time.sleep(2)
+                    DB_RETRIES.inc()
+                    await asyncio.sleep(0.5 * (i + 1))
                 else:
                     logger.error("Не удалось восстановить соединение с БД")
                     raise
-    
-    def create_tables(self):
-        if not self.conn:
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Соединение из пула внутри одной транзакции"""
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                yield conn
+
+    async def create_tables(self):
+        if not self.pool:
             logger.error("Нет подключения к БД для создания таблиц")
             return
-            
+
         try:
-            self.execute_with_retry("""
+            await self.execute_with_retry("""
                 CREATE TABLE IF NOT EXISTS products (
-                    id VARCHAR(50) PRIMARY KEY,
+                    city_id VARCHAR(20) NOT NULL,
+                    id VARCHAR(50) NOT NULL,
                     name TEXT NOT NULL,
                     short_name TEXT,
                     price FLOAT NOT NULL,
                     category TEXT,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (city_id, id)
                 )
             """)
-            
-            self.execute_with_retry("""
-                CREATE TABLE IF NOT EXISTS price_history (
-                    id SERIAL PRIMARY KEY,
+
+            await self.execute_with_retry("""
+                CREATE TABLE IF NOT EXISTS bot_state (
+                    key VARCHAR(50) PRIMARY KEY,
+                    value JSONB NOT NULL
+                )
+            """)
+
+            await self.execute_with_retry("""
+                CREATE TABLE IF NOT EXISTS price_state (
+                    city_id VARCHAR(20) NOT NULL,
                     product_id VARCHAR(50) NOT NULL,
                     price FLOAT NOT NULL,
-                    recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    last_notified_price FLOAT NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (city_id, product_id)
                 )
             """)
-            
-            self.execute_with_retry("""
-                CREATE TABLE IF NOT EXISTS bot_state (
-                    key VARCHAR(50) PRIMARY KEY,
-                    value JSONB NOT NULL
+
+            await self.execute_with_retry("""
+                CREATE TABLE IF NOT EXISTS answer_cache (
+                    key TEXT PRIMARY KEY,
+                    answer TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+
+            # Токен ограждения лидера: растёт при каждой смене ведущей реплики (см. leader.py)
+            await self.execute_with_retry("""
+                CREATE TABLE IF NOT EXISTS leader_lease (
+                    name VARCHAR(50) PRIMARY KEY,
+                    token BIGINT NOT NULL,
+                    holder TEXT NOT NULL,
+                    acquired_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+
+            # Дневные агрегаты истории цен: хранятся дольше сырых точек из price_history
+            await self.execute_with_retry("""
+                CREATE TABLE IF NOT EXISTS price_history_daily (
+                    city_id VARCHAR(20) NOT NULL,
+                    product_id VARCHAR(50) NOT NULL,
+                    day DATE NOT NULL,
+                    min_price NUMERIC(12, 2) NOT NULL,
+                    max_price NUMERIC(12, 2) NOT NULL,
+                    close_price NUMERIC(12, 2) NOT NULL,
+                    PRIMARY KEY (city_id, product_id, day)
+                )
+            """)
+
+            # События изменения цен (приёмник конвейера price_events), хранятся как сырые точки истории
+            await self.execute_with_retry("""
+                CREATE TABLE IF NOT EXISTS price_events (
+                    id BIGSERIAL PRIMARY KEY,
+                    city_id VARCHAR(20) NOT NULL,
+                    product_id VARCHAR(50) NOT NULL,
+                    old_price NUMERIC(12, 2) NOT NULL,
+                    new_price NUMERIC(12, 2) NOT NULL,
+                    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            await self.execute_with_retry(
+                "CREATE INDEX IF NOT EXISTS price_events_created_idx ON price_events (created_at)"
+            )
+
+            # Подписки пользователей на снижение цен (/watch); индекс по товару — для поиска
+            # подписчиков изменившихся товаров без чтения всей таблицы
+            await self.execute_with_retry("""
+                CREATE TABLE IF NOT EXISTS price_watch (
+                    user_id BIGINT NOT NULL,
+                    product_id VARCHAR(50) NOT NULL,
+                    threshold NUMERIC(5, 2) NOT NULL DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (user_id, product_id)
                 )
             """)
-            
+            await self.execute_with_retry(
+                "CREATE INDEX IF NOT EXISTS price_watch_product_idx ON price_watch (product_id) INCLUDE (user_id, threshold)"
+            )
+
+            await self._migrate_city_keys()
+            await self._create_price_history()
+
             logger.info("Таблицы в БД созданы или уже существуют")
         except Exception as e:
             logger.error(f"Ошибка создания таблиц: {e}")
-    
-    def save_products(self, products):
-        if not self.conn or not products:
-            return 0
-            
+
+    async def _migrate_city_keys(self):
+        """Добавляет city_id в таблицы, созданные до поддержки нескольких городов"""
+        for table, key in (("products", "city_id, id"), ("price_history", None), ("price_state", "city_id, product_id")):
+            await self.execute_with_retry(f"""
+                ALTER TABLE IF EXISTS {table} ADD COLUMN IF NOT EXISTS city_id VARCHAR(20) NOT NULL DEFAULT '{LEGACY_CITY_ID}'
+            """)
+            await self.execute_with_retry(f"ALTER TABLE IF EXISTS {table} ALTER COLUMN city_id DROP DEFAULT")
+            if key is None:
+                continue
+            await self.execute_with_retry(f"""
+                DO $$
+                BEGIN
+                    IF (SELECT array_length(conkey, 1) FROM pg_constraint WHERE conrelid = '{table}'::regclass AND contype = 'p') = 1 THEN
+                        ALTER TABLE {table} DROP CONSTRAINT {table}_pkey;
+                        ALTER TABLE {table} ADD PRIMARY KEY ({key});
+                    END IF;
+                END $$
+            """)
+
+    async def _create_price_history(self):
+        """Создаёт секционированную по месяцам price_history, секции на ближайшие месяцы и секцию
+        DEFAULT для точек вне них (например, recorded_at из журнала при сбитых часах): такая точка
+        не должна откатывать всю транзакцию _merge_products.
+
+        Таблица прежнего формата (SERIAL id, FLOAT цены, запись на каждый проход скрапера)
+        переносится в той же транзакции: цены округляются до копеек, подряд идущие
+        одинаковые цены товара схлопываются в одну точку.
+        """
+        async with self.transaction() as conn:
+            # Реплики стартуют одновременно: схему меняет одна, остальные ждут
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext('price_history'))")
+            kind = await conn.fetchval("SELECT relkind::text FROM pg_class WHERE oid = to_regclass('price_history')")
+            legacy = kind is not None and kind != "p"
+            if legacy:
+                await conn.execute("ALTER TABLE price_history RENAME TO price_history_legacy")
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS price_history (
+                    city_id VARCHAR(20) NOT NULL,
+                    product_id VARCHAR(50) NOT NULL,
+                    price NUMERIC(12, 2) NOT NULL,
+                    recorded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                ) PARTITION BY RANGE (recorded_at)
+            """)
+            await conn.execute("CREATE TABLE IF NOT EXISTS price_history_default PARTITION OF price_history DEFAULT")
+            if await conn.fetchval("SELECT to_regclass('price_history_point_key') IS NULL"):
+                # Точка истории уникальна по (товар, город, время): повтор записи из журнала
+                # (write_behind) не добавляет дубликатов. Ключ секционированной таблицы обязан
+                # включать recorded_at; неуникальный индекс с теми же колонками больше не нужен
+                await conn.execute("""
+                    DELETE FROM price_history a USING price_history b
+                    WHERE a.product_id = b.product_id AND a.city_id = b.city_id AND a.recorded_at = b.recorded_at
+                      AND a.tableoid = b.tableoid AND a.ctid > b.ctid
+                """, timeout=MAINTENANCE_TIMEOUT)
+                await conn.execute("""
+                    CREATE UNIQUE INDEX price_history_point_key
+                    ON price_history (product_id, city_id, recorded_at)
+                """, timeout=MAINTENANCE_TIMEOUT)
+                await conn.execute("DROP INDEX IF EXISTS price_history_product_idx")
+            since = await conn.fetchval("SELECT CURRENT_DATE")
+            if legacy:
+                oldest = await conn.fetchval("SELECT min(recorded_at)::date FROM price_history_legacy")
+                since = min(since, oldest or since)
+            await self._create_partitions(conn, since)
+            if legacy:
+                status = await conn.execute("""
+                    INSERT INTO price_history (city_id, product_id, price, recorded_at)
+                    SELECT city_id, product_id, price, recorded_at
+                    FROM (
+                        SELECT city_id, product_id, round(price::numeric, 2) AS price,
+                               COALESCE(recorded_at, CURRENT_TIMESTAMP) AS recorded_at,
+                               lag(round(price::numeric, 2)) OVER (
+                                   PARTITION BY city_id, product_id ORDER BY recorded_at, id
+                               ) AS previous
+                        FROM price_history_legacy
+                    ) points
+                    WHERE previous IS DISTINCT FROM price
+                    ON CONFLICT DO NOTHING
+                """, timeout=MAINTENANCE_TIMEOUT)
+                await conn.execute("DROP TABLE price_history_legacy")
+                logger.info(f"price_history перенесена в секционированную таблицу: {_affected_rows(status)} точек")
+
+    async def _create_partitions(self, conn, since: date):
+        """Месячные секции price_history с месяца since по PARTITIONS_AHEAD месяцев вперёд.
+
+        Точки месяца, попавшие в секцию DEFAULT до создания его секции, переносятся в новую
+        секцию: иначе PostgreSQL не дал бы её создать
+        """
+        today = await conn.fetchval("SELECT CURRENT_DATE")
+        until = today
+        for _ in range(PARTITIONS_AHEAD + 1):
+            until = _next_month(until)
+        month = since.replace(day=1)
+        while month < until:
+            following = _next_month(month)
+            name = f"price_history_p{month:%Y%m}"
+            if await conn.fetchval("SELECT to_regclass($1) IS NULL", name):
+                await conn.execute(f"CREATE TABLE {name} (LIKE price_history INCLUDING DEFAULTS)")
+                status = await conn.execute(f"""
+                    WITH moved AS (
+                        DELETE FROM price_history_default
+                        WHERE recorded_at >= $1::date AND recorded_at < $2::date
+                        RETURNING city_id, product_id, price, recorded_at
+                    )
+                    INSERT INTO {name} (city_id, product_id, price, recorded_at)
+                    SELECT city_id, product_id, price, recorded_at FROM moved
+                """, month, following)
+                await conn.execute(f"""
+                    ALTER TABLE price_history ATTACH PARTITION {name}
+                    FOR VALUES FROM ('{month.isoformat()}') TO ('{following.isoformat()}')
+                """)
+                if _affected_rows(status):
+                    logger.info(f"В секцию {name} перенесено из price_history_default: {_affected_rows(status)} точек")
+            month = following
+
+    async def maintain_price_history(self, retention_days: int,
+                                     pending_since: Optional[datetime] = None) -> Tuple[int, List[str]]:
+        """Обслуживание истории цен (выполняет ведущая реплика после прохода скрапера).
+
+        Создаёт секции на будущие месяцы, сворачивает завершённые дни в price_history_daily
+        (min/max/цена закрытия) и удаляет месячные секции старше retention_days целиком,
+        без DELETE по строкам (кроме редких точек в секции DEFAULT). Секция удаляется,
+        только если её дни уже свёрнуты.
+        Дни начиная с pending_since (самая старая запись, ещё не сброшенная из журнала write_behind)
+        не сворачиваются, пока их точки не дойдут до таблицы.
+        Возвращает (число дневных агрегатов, имена удалённых секций).
+        """
+        async with self.transaction() as conn:
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext('price_history'))")
+            today = await conn.fetchval("SELECT CURRENT_DATE")
+            await self._create_partitions(conn, today)
+            rollup_until = today if pending_since is None else await conn.fetchval(
+                "SELECT LEAST(CURRENT_DATE, $1::timestamptz::date)", pending_since
+            )
+
+        rolled, rolled_until = await self._rollup_price_history(rollup_until)
+        cutoff = min(rolled_until, today - timedelta(days=retention_days))
+        partitions = await self.execute_with_retry("""
+            SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'price_history'::regclass
+        """)
+        dropped = []
+        for (name,) in partitions:
+            match = PARTITION_NAME_RE.match(name)
+            if match and _next_month(date(int(match[1]), int(match[2]), 1)) <= cutoff:
+                await self.execute_with_retry(f"DROP TABLE IF EXISTS {name}")
+                dropped.append(name)
+        await self.execute_with_retry("DELETE FROM price_history_default WHERE recorded_at < $1::date", cutoff)
+        await self.execute_with_retry(
+            "DELETE FROM price_events WHERE created_at < $1", today - timedelta(days=retention_days)
+        )
+        return rolled, sorted(dropped)
+
+    async def _rollup_price_history(self, today: date) -> Tuple[int, date]:
+        """Сворачивает дни до сегодняшнего, ещё не попавшие в price_history_daily.
+
+        В истории хранятся только изменения, поэтому агрегат есть лишь у дней с изменениями;
+        в остальные дни цена равна цене закрытия предыдущего агрегата.
+        """
+        state = await self.load_state(ROLLUP_STATE_KEY)
+        since = date.fromisoformat(state["until"]) if state.get("until") else date.min
+        if since >= today:
+            return 0, since
+        status = await self.pool.execute("""
+            INSERT INTO price_history_daily (city_id, product_id, day, min_price, max_price, close_price)
+            SELECT city_id, product_id, recorded_at::date, min(price), max(price),
+                   (array_agg(price ORDER BY recorded_at DESC))[1]
+            FROM price_history
+            WHERE recorded_at >= $1::date AND recorded_at < $2::date
+            GROUP BY city_id, product_id, recorded_at::date
+            ON CONFLICT (city_id, product_id, day) DO UPDATE SET
+                min_price = EXCLUDED.min_price,
+                max_price = EXCLUDED.max_price,
+                close_price = EXCLUDED.close_price
+        """, since, today, timeout=MAINTENANCE_TIMEOUT)
+        await self.save_state(ROLLUP_STATE_KEY, {"until": today.isoformat()})
+        return _affected_rows(status), today
+
+    async def load_price_history(self, city_id, product_id, days):
+        """Точки изменения цены товара за последние days дней: [(время, цена)] по возрастанию времени"""
+        if not self.pool:
+            return []
+
+        rows = await self.execute_with_retry("""
+            SELECT recorded_at, price FROM price_history
+            WHERE product_id = $2 AND city_id = $1
+              AND recorded_at >= CURRENT_TIMESTAMP - make_interval(days => $3)
+            ORDER BY recorded_at
+        """, city_id, product_id, int(days))
+        return [(row[0], float(row[1])) for row in rows]
+
+    async def load_daily_prices(self, city_id, product_id, days):
+        """Дневные агрегаты товара за последние days дней: [(день, min, max, close)]"""
+        if not self.pool:
+            return []
+
+        rows = await self.execute_with_retry("""
+            SELECT day, min_price, max_price, close_price FROM price_history_daily
+            WHERE city_id = $1 AND product_id = $2 AND day >= CURRENT_DATE - $3::int
+            ORDER BY day
+        """, city_id, product_id, int(days))
+        return [(row[0], float(row[1]), float(row[2]), float(row[3])) for row in rows]
+
+    async def load_city_activity(self, days):
+        """Число часов с изменениями цен за days дней по городам; первая цена нового товара не считается"""
+        rows = await self.execute_with_retry("""
+            SELECT h.city_id, count(DISTINCT date_trunc('hour', h.recorded_at))
+            FROM price_history h
+            WHERE h.recorded_at > CURRENT_TIMESTAMP - make_interval(days => $1)
+              AND EXISTS (
+                  SELECT 1 FROM price_history p
+                  WHERE p.product_id = h.product_id AND p.city_id = h.city_id AND p.recorded_at < h.recorded_at
+              )
+            GROUP BY h.city_id
+        """, int(days))
+        return {city_id: hours for city_id, hours in rows}
+
+    async def load_price_summary(self, top: int = 5):
+        """Сводка для /stats: товары в каталоге, изменения цен за сутки и неделю, крупнейшие снижения.
+
+        Предыдущая цена каждой точки за неделю берётся по индексу (product_id, city_id, recorded_at),
+        поэтому запрос читает только недельные секции истории.
+        """
+        if not self.pool:
+            return {}
+
+        catalog = await self.execute_with_retry(
+            "SELECT count(*) AS products, count(DISTINCT city_id) AS cities FROM products"
+        )
+        changes = await self.execute_with_retry("""
+            WITH points AS MATERIALIZED (
+                SELECT h.city_id, h.product_id, h.price, h.recorded_at,
+                       (SELECT prev.price FROM price_history prev
+                        WHERE prev.product_id = h.product_id AND prev.city_id = h.city_id
+                          AND prev.recorded_at < h.recorded_at
+                        ORDER BY prev.recorded_at DESC LIMIT 1) AS previous
+                FROM price_history h
+                WHERE h.recorded_at >= CURRENT_TIMESTAMP - INTERVAL '7 days'
+            )
+            SELECT
+                count(*) FILTER (WHERE previous IS NOT NULL
+                                 AND recorded_at >= CURRENT_TIMESTAMP - INTERVAL '1 day') AS changes_day,
+                count(*) FILTER (WHERE previous > price
+                                 AND recorded_at >= CURRENT_TIMESTAMP - INTERVAL '1 day') AS drops_day,
+                count(*) FILTER (WHERE previous IS NOT NULL) AS changes_week,
+                count(*) FILTER (WHERE previous > price) AS drops_week,
+                count(*) FILTER (WHERE previous IS NULL) AS new_week,
+                (SELECT json_agg(d) FROM (
+                    SELECT pt.city_id, pt.product_id, p.name, pt.previous, pt.price
+                    FROM points pt
+                    JOIN products p ON p.city_id = pt.city_id AND p.id = pt.product_id
+                    WHERE pt.previous > pt.price
+                    ORDER BY (pt.previous - pt.price) / pt.previous DESC
+                    LIMIT $1
+                ) d) AS top_drops
+            FROM points
+        """, top)
+        summary = {**dict(catalog[0]), **dict(changes[0])}
+        summary["top_drops"] = json.loads(summary["top_drops"] or "[]")
+        return summary
+
+    async def load_product_prices(self, product_id, days):
+        """Цены товара по городам для /price: текущая, последнее изменение, min/max за days дней"""
+        if not self.pool:
+            return []
+
+        rows = await self.execute_with_retry("""
+            SELECT p.city_id, p.name, p.price, p.updated_at,
+                   last.changed_at, last.previous, bounds.min_price, bounds.max_price
+            FROM products p
+            LEFT JOIN LATERAL (
+                SELECT max(recorded_at) AS changed_at, (array_agg(price ORDER BY recorded_at DESC))[2] AS previous
+                FROM (
+                    SELECT price, recorded_at FROM price_history
+                    WHERE product_id = p.id AND city_id = p.city_id
+                    ORDER BY recorded_at DESC LIMIT 2
+                ) recent
+            ) last ON true
+            LEFT JOIN LATERAL (
+                SELECT min(price) AS min_price, max(price) AS max_price FROM price_history
+                WHERE product_id = p.id AND city_id = p.city_id
+                  AND recorded_at >= CURRENT_TIMESTAMP - make_interval(days => $2)
+            ) bounds ON true
+            WHERE p.id = $1
+            ORDER BY p.city_id
+        """, product_id, int(days))
+        return [dict(row) for row in rows]
+
+    async def _merge_products(self, rows, recorded_at: datetime):
+        """Загружает пачку во временную таблицу через COPY и сливает её с products одной транзакцией.
+
+        В price_history попадают только новые товары и товары с изменившейся ценой, с отметкой
+        recorded_at (время прохода скрапера). Слияние можно повторить: точка с тем же временем
+        не дублируется, а товар, обновлённый позже recorded_at, не откатывается.
+        Возвращает число записей истории цен.
+        """
+        async with self.transaction() as conn:
+            await conn.execute("""
+                CREATE TEMP TABLE products_stage (
+                    city_id VARCHAR(20) NOT NULL,
+                    id VARCHAR(50) NOT NULL,
+                    name TEXT NOT NULL,
+                    short_name TEXT,
+                    price FLOAT NOT NULL,
+                    category TEXT,
+                    PRIMARY KEY (city_id, id)
+                ) ON COMMIT DROP
+            """)
+            await conn.copy_records_to_table(
+                "products_stage",
+                records=rows,
+                columns=("city_id", "id", "name", "short_name", "price", "category")
+            )
+            status = await conn.execute("""
+                INSERT INTO price_history (city_id, product_id, price, recorded_at)
+                SELECT s.city_id, s.id, s.price, $1::timestamptz::timestamp
+                FROM products_stage s
+                LEFT JOIN products p ON p.city_id = s.city_id AND p.id = s.id
+                WHERE p.id IS NULL OR p.price <> s.price
+                ON CONFLICT DO NOTHING
+            """, recorded_at)
+            await conn.execute("""
+                INSERT INTO products (city_id, id, name, short_name, price, category, updated_at)
+                SELECT city_id, id, name, short_name, price, category, $1::timestamptz::timestamp FROM products_stage
+                ON CONFLICT (city_id, id) DO UPDATE SET
+                    name = EXCLUDED.name,
+                    short_name = EXCLUDED.short_name,
+                    price = EXCLUDED.price,
+                    category = EXCLUDED.category,
+                    updated_at = EXCLUDED.updated_at
+                WHERE (products.name, products.short_name, products.price, products.category)
+                    IS DISTINCT FROM (EXCLUDED.name, EXCLUDED.short_name, EXCLUDED.price, EXCLUDED.category)
+                    AND (products.updated_at IS NULL OR products.updated_at <= EXCLUDED.updated_at)
+            """, recorded_at)
+        return _affected_rows(status)
+
+    async def save_products(self, products: List[Product], recorded_at: Optional[datetime] = None) -> SaveResult:
+        """Пакетная запись товаров. Строки с ошибками данных пропускаются (SaveResult.errors);
+        если БД недоступна, исключение пробрасывается — пачку повторяет вызывающий (write_behind)"""
+        if not self.pool or not products:
+            return SaveResult(0, 0, [])
+
+        # Записи уже нормализованы (scraper.normalize_product); дубликаты (город, id) схлопываются (последний побеждает)
+        rows = list({(product.city_id, product.id): product.as_row() for product in products}.values())
+        recorded_at = recorded_at or datetime.now(timezone.utc)
+        errors = []
+        for i in range(2):
+            try:
+                changed = await self._merge_products(rows, recorded_at)
+                return SaveResult(len(rows), changed, errors)
+            except RETRYABLE_ERRORS as e:
+                logger.warning(f"Потеря соединения с БД при сохранении товаров ({i+1}/2): {e}")
+                if i == 1:
+                    raise
+            except Exception as e:
+                logger.error(f"Ошибка пакетного сохранения товаров, сохраняем по одному: {e}")
+                break
+
+        # Пачка не прошла целиком — сохраняем по одному, чтобы найти проблемные строки
         saved_count = 0
-        try:
-            for product in products:
-                try:
-                    # Проверяем и преобразуем данные
-                    product_id = str(product.get('id', ''))
-                    name = str(product.get('name', ''))
-                    short_name = str(product.get('short_name', ''))
-                    price = float(product.get('price', 0))
-                    category = str(product.get('category', ''))
-                    
-                    self.execute_with_retry("""
-                        INSERT INTO products (id, name, short_name, price, category)
-                        VALUES (%s, %s, %s, %s, %s)
-                        ON CONFLICT (id) DO UPDATE SET
-                            name = EXCLUDED.name,
-                            short_name = EXCLUDED.short_name,
-                            price = EXCLUDED.price,
-                            category = EXCLUDED.category,
-                            updated_at = CURRENT_TIMESTAMP
-                    """, (product_id, name, short_name, price, category))
-                    
-                    self.execute_with_retry("""
-                        INSERT INTO price_history (product_id, price)
-                        VALUES (%s, %s)
-                    """, (product_id, price))
-                    
-                    saved_count += 1
-                except Exception as e:
-                    logger.error(f"Ошибка сохранения продукта {product.get('id')}: {e}")
-        except Exception as e:
-            logger.error(f"Общая ошибка при сохранении товаров: {e}")
-        
-        return saved_count
-    
-    def save_state(self, key, state):
-        if not self.conn:
+        changed = 0
+        for row in rows:
+            try:
+                changed += await self._merge_products([row], recorded_at)
+                saved_count += 1
+            except RETRYABLE_ERRORS:
+                raise
+            except Exception as e:
+                errors.append((row[1], str(e)))
+                logger.error(f"Ошибка сохранения продукта {row[1]} (город {row[0]}): {e}")
+        return SaveResult(saved_count, changed, errors)
+
+    async def load_products(self):
+        """Товары каталога без повторов по городам (для индекса базы знаний); city_ids — города товара"""
+        if not self.pool:
+            return []
+
+        rows = await self.execute_with_retry("""
+            SELECT DISTINCT ON (id) id, name, short_name, category,
+                array_agg(city_id) OVER (PARTITION BY id) AS city_ids
+            FROM products
+            ORDER BY id, updated_at DESC
+        """)
+        return [dict(row) for row in rows]
+
+    async def save_state(self, key, state):
+        if not self.pool:
             return
-            
+
         try:
-            self.execute_with_retry("""
+            await self.execute_with_retry("""
                 INSERT INTO bot_state (key, value)
-                VALUES (%s, %s)
+                VALUES ($1, $2::jsonb)
                 ON CONFLICT (key) DO UPDATE SET
                     value = EXCLUDED.value
-            """, (key, json.dumps(state)))
+            """, key, json.dumps(state))
         except Exception as e:
             logger.error(f"Ошибка сохранения состояния: {e}")
-    
-    def load_state(self, key):
-        if not self.conn:
+
+    async def save_states(self, states: Dict[str, object]):
+        """Upsert нескольких ключей bot_state одним запросом; ошибки не перехватываются (повторяет write_behind)"""
+        if not self.pool or not states:
+            return
+
+        await self.execute_with_retry("""
+            INSERT INTO bot_state (key, value)
+            SELECT key, value::jsonb FROM unnest($1::varchar[], $2::text[]) AS s(key, value)
+            ON CONFLICT (key) DO UPDATE SET
+                value = EXCLUDED.value
+        """, list(states), [json.dumps(value) for value in states.values()])
+
+    async def load_state(self, key):
+        if not self.pool:
             return {}
-            
+
         try:
-            result = self.execute_with_retry("SELECT value FROM bot_state WHERE key = %s", (key,))
+            result = await self.execute_with_retry("SELECT value FROM bot_state WHERE key = $1", key)
             return json.loads(result[0][0]) if result else {}
         except Exception as e:
             logger.error(f"Ошибка загрузки состояния: {e}")
             return {}
+
+    async def load_price_states(self):
+        if not self.pool:
+            return []
+
+        rows = await self.execute_with_retry(
+            "SELECT city_id, product_id, price, last_notified_price FROM price_state"
+        )
+        return [tuple(row) for row in rows]
+
+    async def save_price_states(self, rows, updated_at: Optional[Sequence[datetime]] = None):
+        """Upsert только переданных записей (city_id, product_id, price, last_notified_price) одним запросом.
+
+        updated_at — время каждой записи (по умолчанию сейчас); запись старше уже сохранённой
+        не применяется, поэтому повтор журнала write_behind не откатывает более новое состояние.
+        """
+        if not self.pool or not rows:
+            return
+
+        cities, ids, prices, notified = zip(*rows)
+        if updated_at is None:
+            updated_at = [datetime.now(timezone.utc)] * len(rows)
+        await self.execute_with_retry("""
+            INSERT INTO price_state (city_id, product_id, price, last_notified_price, updated_at)
+            SELECT city_id, product_id, price, last_notified_price, updated_at::timestamp
+            FROM unnest($1::varchar[], $2::varchar[], $3::float8[], $4::float8[], $5::timestamptz[])
+                AS s(city_id, product_id, price, last_notified_price, updated_at)
+            ON CONFLICT (city_id, product_id) DO UPDATE SET
+                price = EXCLUDED.price,
+                last_notified_price = EXCLUDED.last_notified_price,
+                updated_at = EXCLUDED.updated_at
+            WHERE price_state.updated_at IS NULL OR price_state.updated_at <= EXCLUDED.updated_at
+        """, list(cities), list(ids), [float(p) for p in prices], [float(p) for p in notified], list(updated_at))
+
+    async def save_price_events(self, events):
+        """Записывает события изменения цен (price_events.PriceChange) одним запросом"""
+        if not self.pool or not events:
+            return
+
+        await self.execute_with_retry("""
+            INSERT INTO price_events (city_id, product_id, old_price, new_price)
+            SELECT * FROM unnest($1::varchar[], $2::varchar[], $3::float8[], $4::float8[])
+        """, [e.city_id for e in events], [e.product_id for e in events],
+            [float(e.old_price) for e in events], [float(e.new_price) for e in events])
+
+    async def add_watch(self, user_id, product_id, threshold, limit) -> bool:
+        """Подписка (или новый порог для существующей); False, если у пользователя уже limit подписок"""
+        async with self.transaction() as conn:
+            # Одновременные /watch одного пользователя не должны обойти лимит
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext('price_watch'), $1::int)", user_id % 2**31)
+            count = await conn.fetchval("""
+                SELECT count(*) FROM price_watch WHERE user_id = $1 AND product_id <> $2
+            """, user_id, product_id)
+            if count >= limit:
+                return False
+            await conn.execute("""
+                INSERT INTO price_watch (user_id, product_id, threshold)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (user_id, product_id) DO UPDATE SET threshold = EXCLUDED.threshold
+            """, user_id, product_id, threshold)
+        return True
+
+    async def remove_watch(self, user_id, product_id) -> bool:
+        rows = await self.execute_with_retry(
+            "DELETE FROM price_watch WHERE user_id = $1 AND product_id = $2 RETURNING product_id", user_id, product_id
+        )
+        return bool(rows)
+
+    async def remove_user_watches(self, user_id) -> int:
+        rows = await self.execute_with_retry("DELETE FROM price_watch WHERE user_id = $1 RETURNING product_id", user_id)
+        return len(rows)
+
+    async def load_watches(self, user_id):
+        """Подписки пользователя с названием и ценой товара (минимальной по городам)"""
+        rows = await self.execute_with_retry("""
+            SELECT w.product_id, w.threshold, p.name, p.price
+            FROM price_watch w
+            CROSS JOIN LATERAL (
+                SELECT (array_agg(name ORDER BY updated_at DESC))[1] AS name, min(price) AS price
+                FROM products WHERE id = w.product_id
+            ) p
+            WHERE w.user_id = $1
+            ORDER BY w.created_at
+        """, user_id)
+        return [dict(row) for row in rows]
+
+    async def load_watchers(self, product_ids):
+        """Подписчики товаров {id товара: [(id пользователя, порог %)]} по индексу price_watch_product_idx"""
+        if not self.pool or not product_ids:
+            return {}
+
+        rows = await self.execute_with_retry("""
+            SELECT product_id, user_id, threshold FROM price_watch WHERE product_id = ANY($1::varchar[])
+        """, list(product_ids))
+        watchers = {}
+        for product_id, user_id, threshold in rows:
+            watchers.setdefault(product_id, []).append((user_id, float(threshold)))
+        return watchers
+
+    async def load_cached_answer(self, key, ttl):
+        """Возвращает (ответ, возраст в секундах) или None, если записи нет или она устарела"""
+        if not self.pool:
+            return None
+
+        result = await self.execute_with_retry("""
+            SELECT answer, EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - created_at)
+            FROM answer_cache
+            WHERE key = $1 AND created_at > CURRENT_TIMESTAMP - make_interval(secs => $2)
+        """, key, float(ttl))
+        return (result[0][0], float(result[0][1])) if result else None
+
+    async def save_cached_answer(self, key, answer):
+        if not self.pool:
+            return
+
+        await self.execute_with_retry("""
+            INSERT INTO answer_cache (key, answer)
+            VALUES ($1, $2)
+            ON CONFLICT (key) DO UPDATE SET
+                answer = EXCLUDED.answer,
+                created_at = CURRENT_TIMESTAMP
+        """, key, answer)
+
+    async def clear_cached_answers(self):
+        if not self.pool:
+            return
+
+        await self.execute_with_retry("DELETE FROM answer_cache")
+
+    async def load_leader_token(self, name):
+        """Текущий токен ограждения для роли name (None, если лидера ещё не было)"""
+        rows = await self.execute_with_retry("SELECT token FROM leader_lease WHERE name = $1", name)
+        return rows[0][0] if rows else None
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import os
+import socket
+from typing import Optional
+
+import asyncpg
+
+from database import Database, connection_params
+
+logger = logging.getLogger(__name__)
+
+LOCK_NAMESPACE = 7401  # первый ключ advisory lock: отделяет блокировки бота от чужих в той же БД
+
+# Сервер замечает оборванное соединение упавшей реплики за ~idle + interval * count секунд и снимает блокировку
+KEEPALIVE_SETTINGS = {"tcp_keepalives_idle": "10", "tcp_keepalives_interval": "5", "tcp_keepalives_count": "3"}
+
+
+class NotLeader(Exception):
+    """Реплика больше не ведущая: побочные эффекты (закрепы, запись состояния) выполнять нельзя"""
+
+
+class LeaderElection:
+    """Выбор ведущей реплики через advisory lock PostgreSQL.
+
+    Блокировка сессионная, поэтому держится на выделенном соединении, а не на соединении из пула
+    (пул при возврате соединения снимает все advisory lock). Когда ведущая реплика падает,
+    сервер закрывает её сессию, блокировка освобождается и её забирает одна из ждущих реплик.
+
+    При каждом захвате токен ограждения в leader_lease увеличивается. Перед закреплением поста
+    ведущий сверяет свой токен с таблицей (ensure_fence), так что реплика, которая потеряла
+    блокировку, но ещё не заметила этого, не закрепит и не открепит сообщение. Фоновая проверка
+    сверяет токен раз в check_interval, и check() отвечает без запроса к БД.
+    """
+
+    def __init__(self, name: str, retry_interval: float = 5, check_interval: float = 5):
+        self.name = name
+        self.retry_interval = retry_interval  # как часто резервная реплика пытается стать ведущей
+        self.check_interval = check_interval  # как часто ведущая проверяет своё соединение
+        self.holder = f"{socket.gethostname()}:{os.getpid()}"
+        self.token: Optional[int] = None
+        self._conn: Optional[asyncpg.Connection] = None
+        self._leader = asyncio.Event()
+
+    @property
+    def is_leader(self) -> bool:
+        return self._leader.is_set()
+
+    async def wait_leadership(self):
+        await self._leader.wait()
+
+    async def run(self):
+        """Фоновая задача: пытается захватить блокировку, удерживает её и следит за соединением"""
+        while True:
+            try:
+                await Database.get_instance()  # таблица leader_lease создаётся вместе с остальными
+                if self._conn is None or self._conn.is_closed():
+                    self._conn = await asyncpg.connect(**connection_params(), server_settings=KEEPALIVE_SETTINGS)
+                if not self.is_leader:
+                    await self._try_acquire()
+                else:
+                    current = await self._conn.fetchval(
+                        "SELECT token FROM leader_lease WHERE name = $1", self.name, timeout=self.check_interval
+                    )
+                    if current != self.token:
+                        logger.warning(f"Токен {self.token} устарел, у ведущей реплики {current}")
+                        self._step_down()
+                        await self._close_connection()
+            except Exception as e:
+                logger.warning(f"Соединение выбора лидера {self.name} потеряно: {e}")
+                self._step_down()
+                await self._close_connection()
+            await asyncio.sleep(self.check_interval if self.is_leader else self.retry_interval)
+
+    async def _try_acquire(self):
+        acquired = await self._conn.fetchval(
+            "SELECT pg_try_advisory_lock($1, hashtext($2))", LOCK_NAMESPACE, self.name
+        )
+        if not acquired:
+            return
+        self.token = await self._conn.fetchval("""
+            INSERT INTO leader_lease (name, token, holder, acquired_at)
+            VALUES ($1, 1, $2, CURRENT_TIMESTAMP)
+            ON CONFLICT (name) DO UPDATE SET
+                token = leader_lease.token + 1,
+                holder = EXCLUDED.holder,
+                acquired_at = EXCLUDED.acquired_at
+            RETURNING token
+        """, self.name, self.holder)
+        self._leader.set()
+        logger.info(f"Реплика {self.holder} стала ведущей для {self.name} (токен {self.token})")
+
+    def _step_down(self):
+        if self.is_leader:
+            logger.warning(f"Реплика {self.holder} больше не ведущая для {self.name}")
+        self._leader.clear()
+        self.token = None
+
+    def check(self):
+        """Бросает NotLeader, если реплика уже знает, что не ведущая (по последней фоновой проверке)"""
+        if not self.is_leader or self.token is None:
+            raise NotLeader(f"реплика {self.holder} не ведущая для {self.name}")
+
+    async def ensure_fence(self):
+        """Бросает NotLeader, если с момента захвата ведущей стала другая реплика"""
+        token = self.token
+        if not self.is_leader or token is None:
+            raise NotLeader(f"реплика {self.holder} не ведущая для {self.name}")
+        db = await Database.get_instance()
+        current = await db.load_leader_token(self.name)
+        if current != token:
+            self._step_down()
+            await self._close_connection()  # отпускаем блокировку, если она ещё числится за нами
+            raise NotLeader(f"токен {token} устарел, у ведущей реплики {current}")
+
+    async def _close_connection(self):
+        if self._conn is not None:
+            try:
+                await self._conn.close(timeout=5)
+            except Exception:
+                self._conn.terminate()
+            self._conn = None
+
+    async def close(self):
+        """Освобождает блокировку при остановке, чтобы другая реплика подхватила работу сразу"""
+        self._step_down()
+        await self._close_connection()
@@ -0,0 +1,111 @@
+import functools
+import logging
+import time
+from typing import Awaitable, Callable, Dict, TypeVar
+
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Метрики создаются один раз при импорте; дочерние серии с постоянными метками
+# привязываются заранее, чтобы на горячем пути не искать их по меткам
+
+PERPLEXITY_SECONDS = Histogram(
+    "bot_perplexity_seconds", "Время ответа Perplexity (успешные запросы)", ["stage"],
+    buckets=(0.25, 0.5, 1, 2, 3, 5, 8, 12, 20, 30, 40)
+)
+PERPLEXITY_ANSWER = PERPLEXITY_SECONDS.labels("answer")
+PERPLEXITY_FIRST_TOKEN = PERPLEXITY_SECONDS.labels("first_token")
+PERPLEXITY_REQUESTS = Counter("bot_perplexity_requests_total", "Вопросы к Perplexity по исходу", ["result"])
+PERPLEXITY_RETRIES = Counter("bot_perplexity_retries_total", "Повторы запросов к Perplexity (tenacity)", ["call"])
+
+SCRAPE_CYCLE_SECONDS = Histogram(
+    "bot_scrape_cycle_seconds", "Длительность прохода цикла цен",
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1200)
+)
+SCRAPE_CYCLES = Counter("bot_scrape_cycles_total", "Проходы цикла цен по исходу", ["result"])
+SCRAPE_PRODUCTS = Counter("bot_scrape_products_total", "Товары, разобранные из изменившихся каталогов")
+SCRAPE_INTERVAL = Gauge("bot_scrape_interval_seconds", "Текущий адаптивный интервал проверки каталога", ["city"])
+
+PRICE_EVENT_BATCHES = Counter(
+    "bot_price_event_batches_total", "Пачки событий изменения цен, обработанные приёмниками", ["sink", "result"]
+)
+PRICE_ALERTS = Counter("bot_price_alerts_total", "Личные уведомления подписчикам о снижении цен")
+
+DB_QUERY_SECONDS = Histogram(
+    "bot_db_query_seconds", "Время запросов execute_with_retry по типу команды", ["operation"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+DB_RETRIES = Counter("bot_db_retries_total", "Повторы запросов после потери соединения с БД")
+JOURNAL_BYTES = Gauge("bot_journal_bytes", "Объём журнала отложенной записи, ещё не сброшенного в БД")
+JOURNAL_FLUSHES = Counter("bot_journal_flushes_total", "Сбросы журнала отложенной записи в БД по исходу", ["result"])
+JOURNAL_RECORDS = Counter("bot_journal_records_total", "Записи журнала отложенной записи", ["result"])
+
+EVENT_LOOP_LAG = Histogram(
+    "bot_event_loop_lag_seconds", "Задержка пробуждения периодической задачи event loop",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+)
+
+HANDLER_SECONDS = Histogram(
+    "bot_handler_seconds", "Время обработчиков апдейтов", ["handler"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения, вышедшие из обработчиков", ["handler"])
+
+QUESTIONS_ACTIVE = Gauge("bot_questions_active", "Вопросы в работе")
+QUESTIONS_QUEUED = Gauge("bot_questions_queued", "Вопросы в очереди")
+
+_db_operations: Dict[str, Histogram] = {}
+
+
+def observe_db_query(query: str, seconds: float):
+    """Время запроса с меткой по первому слову SQL (SELECT, INSERT, ...): число серий ограничено"""
+    operation = query.lstrip().split(None, 1)[0].upper() if query.strip() else "EMPTY"
+    child = _db_operations.get(operation)
+    if child is None:
+        child = _db_operations[operation] = DB_QUERY_SECONDS.labels(operation)
+    child.observe(seconds)
+
+
+def count_retry(call: str) -> Callable:
+    """Колбэк before_sleep для tenacity: считает повторы вызова call"""
+    counter = PERPLEXITY_RETRIES.labels(call)
+    return lambda retry_state: counter.inc()
+
+
+def timed_handler(name: str):
+    """Декоратор асинхронного обработчика: время выполнения и число исключений"""
+    def decorator(fn: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+        seconds = HANDLER_SECONDS.labels(name)
+        errors = HANDLER_ERRORS.labels(name)
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                seconds.observe(time.monotonic() - started)
+        return wrapper
+    return decorator
+
+
+async def _metrics(request: web.Request) -> web.Response:
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """HTTP /metrics для Prometheus в том же event loop; остановка — runner.cleanup()"""
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики Prometheus доступны на http://{host}:{port}/metrics")
+    return runner
@@ -1,56 +1,84 @@
+import asyncio
+import json
+import time
 import requests
+import aiohttp
 import logging
-from typing import List, Dict, Optional
-from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
+from typing import AsyncIterator, Dict, Optional
+from answer_cache import AnswerCache
+from concurrency import LatencyWindow, SingleFlight, TokenBucket
+from metrics import (
+    PERPLEXITY_ANSWER, PERPLEXITY_FIRST_TOKEN, PERPLEXITY_REQUESTS, count_retry
+)
+from config import (
+    ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_DB_COOLDOWN, PERPLEXITY_RATE_PER_MIN, PERPLEXITY_BURST
+)
+from text_utils import normalize_query
+from product_index import product_index
+from tenacity import (
+    retry, stop_after_attempt, wait_fixed, wait_exponential, wait_random,
+    retry_if_exception, retry_if_exception_type
+)
 
 # --- Настройка логирования ---
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-# --- Демонстрационная "БД" продуктов (можно заменить на реальную) ---
-class ProductDatabase:
-    def __init__(self):
-        self.products = []
-    
-    def sync_demo_products(self):
-        demo_products = [
-            {
-                "id": 1,
-                "name": "Коллаген Ультра",
-                "description": "Гидролизованный коллаген с витамином C",
-                "benefits": "Улучшает состояние кожи, волос и ногтей, поддерживает здоровье суставов",
-                "ingredients": "Коллаген гидролизованный (10 г), витамин C (80 мг)",
-                "usage": "Принимать по 1 саше в день, растворив в воде"
-            },
-            # Можно добавить еще продукты
-        ]
-        self.products = demo_products
-    
-    def search_products(self, query: str) -> List[Dict]:
-        found = []
-        query_l = query.lower()
-        for prod in self.products:
-            text = (prod['name'] + ' ' + prod['description'] + ' ' + prod['benefits']).lower()
-            if query_l in text:
-                found.append(prod)
-        return found
+def _is_retryable_async(exc: BaseException) -> bool:
+    """Повторяем таймауты, обрывы соединения, 429 и 5xx"""
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status == 429 or exc.status >= 500
+    return isinstance(exc, (asyncio.TimeoutError, aiohttp.ClientConnectionError))
 
 
 # --- Главный класc для общения с Perplexity API ---
 class PerplexityAPI:
     BASE_URL = "https://api.perplexity.ai/chat/completions"
+    REQUEST_TIMEOUT = 12  # таймаут одной попытки, сек
+    DEADLINE = 40  # общий дедлайн на вопрос с учётом повторов, сек
 
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, pool_size: int = 100):
         self.api_key = api_key
-        self.db = ProductDatabase()
-        self.db.sync_demo_products()
+        self.pool_size = pool_size
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.cache = AnswerCache(max_size=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL, db_cooldown=ANSWER_CACHE_DB_COOLDOWN)
+        self.inflight = SingleFlight()
+        # Квота API: каждая HTTP-попытка (включая повторы) расходует токен
+        self.rate_limiter = TokenBucket(PERPLEXITY_RATE_PER_MIN / 60, PERPLEXITY_BURST)
+        self.products = product_index
+        # Время до готового ответа и (для стрима) до первого фрагмента, только успешные запросы
+        self.latency = LatencyWindow()
+        self.first_token = LatencyWindow()
+
+    def _headers(self) -> Dict[str, str]:
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Общая сессия с keep-alive пулом соединений (создаётся лениво внутри event loop)"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers=self._headers(),
+                timeout=aiohttp.ClientTimeout(total=self.REQUEST_TIMEOUT)
+            )
+        return self._session
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
 
     # Делаем retry: 3 попытки, пауза 3 сек, только если timeout!
     @retry(
         stop=stop_after_attempt(3),
         wait=wait_fixed(3),
-        retry=retry_if_exception_type(requests.exceptions.Timeout)
+        retry=retry_if_exception_type(requests.exceptions.Timeout),
+        before_sleep=count_retry("sync")
     )
     def _ask(self, payload, headers):
         response = requests.post(
@@ -62,49 +90,105 @@ class PerplexityAPI:
         response.raise_for_status()
         return response.json()
 
+    # Асинхронный вариант: экспоненциальная пауза с джиттером, повтор на таймауты, обрывы, 429 и 5xx
+    @retry(
+        stop=stop_after_attempt(3),
+        wait=wait_exponential(multiplier=1, max=6) + wait_random(0, 1),
+        retry=retry_if_exception(_is_retryable_async),
+        before_sleep=count_retry("async"),
+        reraise=True
+    )
+    async def _ask_async(self, payload):
+        await self.rate_limiter.acquire()
+        async with self._get_session().post(self.BASE_URL, json=payload) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    # Повторять можно только установку соединения: после первых байтов стрим уже ушёл пользователю
+    @retry(
+        stop=stop_after_attempt(3),
+        wait=wait_exponential(multiplier=1, max=6) + wait_random(0, 1),
+        retry=retry_if_exception(_is_retryable_async),
+        before_sleep=count_retry("stream"),
+        reraise=True
+    )
+    async def _open_stream(self, payload) -> aiohttp.ClientResponse:
+        await self.rate_limiter.acquire()
+        response = await self._get_session().post(
+            self.BASE_URL,
+            json={**payload, "stream": True},
+            # total=None: длинный ответ может идти дольше REQUEST_TIMEOUT, ограничиваем паузы между чанками
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.REQUEST_TIMEOUT, sock_read=self.REQUEST_TIMEOUT)
+        )
+        try:
+            response.raise_for_status()
+        except aiohttp.ClientResponseError:
+            response.release()
+            raise
+        return response
+
+    async def _stream_completion(self, payload) -> AsyncIterator[str]:
+        """Читает SSE-ответ и отдаёт приращения текста (choices[0].delta.content)"""
+        deadline = asyncio.get_running_loop().time() + self.DEADLINE
+        response = await self._open_stream(payload)
+        try:
+            async for raw_line in response.content:
+                if asyncio.get_running_loop().time() > deadline:
+                    raise asyncio.TimeoutError()
+                line = raw_line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or [{}]
+                delta = (choices[0].get("delta") or {}).get("content")
+                if delta:
+                    yield delta
+        finally:
+            response.release()
+
+    def _build_payload(self, query: str) -> Dict:
+        relevant = self.products.search(query)
+        product_context = ""
+        if relevant:
+            product_context = "\n\n### Информация о продуктах:\n"
+            for prod in relevant:
+                product_context += f"- {prod.name}"
+                if prod.category:
+                    product_context += f" (категория: {prod.category})"
+                product_context += "\n"
+        system_prompt = (
+            "Ты - Нутрициолог-эксперт от NL INTERNATIONAL. "
+            "Отвечай строго по теме, не давай прямых медицинских диагнозов.\n"
+            f"{product_context}"
+        )
+        user_prompt = (
+            "Инструкции:\n"
+            "- Отвечай на русском\n"
+            "- Будь точным и кратким\n"
+            "- Для источников используй сноски в формате: [1], [2] в тексте\n"
+            "- В конце сообщения добавь список источников в формате:\n"
+            "      [1]: полный_URL_источника\n"
+            "      [2]: полный_URL_источника\n"
+            "- При упоминании компании: [NL INTERNATIONAL](https://nlstar.com/ref/aU37in)\n"
+            f'Вопрос: "{query}"'
+        )
+        payload = {
+            "model": "sonar-pro",
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            "max_tokens": 1000,
+            "temperature": 0.3,
+        }
+        return payload
+
     def ask(self, query: str) -> str:
         try:
-            relevant = self.db.search_products(query)
-            product_context = ""
-            if relevant:
-                product_context = "\n\n### Информация о продуктах:\n"
-                for prod in relevant:
-                    product_context += (
-                        f"- {prod['name']}: {prod['description']}\n"
-                        f"  Польза: {prod['benefits']}\n"
-                    )
-            system_prompt = (
-                "Ты - Нутрициолог-эксперт от NL INTERNATIONAL. "
-                "Отвечай строго по теме, не давай прямых медицинских диагнозов.\n"
-                f"{product_context}"
-            )
-            # В методе ask класса PerplexityAPI
-            user_prompt = (
-                "Инструкции:\n"
-                "- Отвечай на русском\n"
-                "- Будь точным и кратким\n"
-                "- Для источников используй сноски в формате: [1], [2] в тексте\n"
-                "- В конце сообщения добавь список источников в формате:\n"
-                "      [1]: полный_URL_источника\n"
-                "      [2]: полный_URL_источника\n"
-                "- При упоминании компании: [NL INTERNATIONAL](https://nlstar.com/ref/aU37in)\n"
-                f'Вопрос: "{query}"'
-            )
-            payload = {
-                "model": "sonar-pro",
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                "max_tokens": 1000,
-                "temperature": 0.3,
-            }
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
-            }
             # Используем защищённый вызов с повтором
-            resp_json = self._ask(payload, headers)
+            resp_json = self._ask(self._build_payload(query), self._headers())
             return resp_json["choices"][0]["message"]["content"]
         except requests.exceptions.Timeout:
             logger.error("Timeout при обращении к Perplexity API.")
@@ -113,6 +197,83 @@ class PerplexityAPI:
             logger.error(f"Ошибка при генерации ответа: {e}")
             return "Произошла ошибка при получении консультации. Попробуйте позже."
 
+    async def ask_async(self, query: str) -> str:
+        cached = await self.cache.get(query)
+        if cached is not None:
+            return cached
+        # Одинаковые вопросы, пришедшие одновременно, ждут один общий запрос к API
+        key = normalize_query(query) or query
+        return await self.inflight.do(key, lambda: self._fetch_answer(query))
+
+    async def _fetch_answer(self, query: str) -> str:
+        started = time.monotonic()
+        try:
+            async with asyncio.timeout(self.DEADLINE):
+                resp_json = await self._ask_async(self._build_payload(query))
+            answer = resp_json["choices"][0]["message"]["content"]
+            elapsed = time.monotonic() - started
+            self.latency.observe(elapsed)
+            PERPLEXITY_ANSWER.observe(elapsed)
+            PERPLEXITY_REQUESTS.labels("ok").inc()
+            # В кэш попадают только успешные ответы, сообщения об ошибках не кэшируются
+            await self.cache.set(query, answer)
+            return answer
+        except asyncio.TimeoutError:
+            PERPLEXITY_REQUESTS.labels("timeout").inc()
+            logger.error("Timeout при обращении к Perplexity API.")
+            return "Сервер перегружен, не удалось получить ответ за разумное время. Попробуйте повторить позже."
+        except Exception as e:
+            PERPLEXITY_REQUESTS.labels("error").inc()
+            logger.error(f"Ошибка при генерации ответа: {e}")
+            return "Произошла ошибка при получении консультации. Попробуйте позже."
+
+    async def ask_stream(self, query: str) -> AsyncIterator[str]:
+        """Потоковый ответ: отдаёт фрагменты текста по мере генерации"""
+        cached = await self.cache.get(query)
+        if cached is not None:
+            yield cached
+            return
+        key = normalize_query(query) or query
+        if self.inflight.get(key) is not None:
+            # Такой же вопрос уже генерируется — ждём целиком готовый ответ
+            yield await self.ask_async(query)
+            return
+
+        done = self.inflight.lead(key)
+        parts = []
+        started = time.monotonic()
+        try:
+            async for delta in self._stream_completion(self._build_payload(query)):
+                if not parts:
+                    first_token = time.monotonic() - started
+                    self.first_token.observe(first_token)
+                    PERPLEXITY_FIRST_TOKEN.observe(first_token)
+                parts.append(delta)
+                yield delta
+            elapsed = time.monotonic() - started
+            self.latency.observe(elapsed)
+            PERPLEXITY_ANSWER.observe(elapsed)
+            PERPLEXITY_REQUESTS.labels("ok").inc()
+            answer = "".join(parts)
+            await self.cache.set(query, answer)
+            done.set_result(answer)
+        except asyncio.TimeoutError:
+            PERPLEXITY_REQUESTS.labels("timeout").inc()
+            logger.error("Timeout при обращении к Perplexity API.")
+            error = "Сервер перегружен, не удалось получить ответ за разумное время. Попробуйте повторить позже."
+            done.set_result(error)
+            yield f"\n\n{error}" if parts else error
+        except Exception as e:
+            PERPLEXITY_REQUESTS.labels("error").inc()
+            logger.error(f"Ошибка при генерации ответа: {e}")
+            error = "Произошла ошибка при получении консультации. Попробуйте позже."
+            done.set_result(error)
+            yield f"\n\n{error}" if parts else error
+        finally:
+            if not done.done():
+                # Потребитель бросил стрим (отмена обработчика) — ждущие получат ошибку
+                done.set_exception(ConnectionError("Потоковый запрос к Perplexity прерван"))
+
 # --- Синглтон для общего доступа ----
 perplexity_api: Optional[PerplexityAPI] = None
 
@@ -126,6 +287,39 @@ def ask_perplexity(query: str) -> str:
         return "Perplexity API не инициализирован. Вызовите init_perplexity(api_key)."
     return perplexity_api.ask(query)
 
+async def ask_perplexity_async(query: str) -> str:
+    if not perplexity_api:
+        return "Perplexity API не инициализирован. Вызовите init_perplexity(api_key)."
+    return await perplexity_api.ask_async(query)
+
+async def ask_perplexity_stream(query: str) -> AsyncIterator[str]:
+    if not perplexity_api:
+        yield "Perplexity API не инициализирован. Вызовите init_perplexity(api_key)."
+        return
+    async for delta in perplexity_api.ask_stream(query):
+        yield delta
+
+async def warm_up_perplexity(query: str):
+    """Фоновый прогрев: открывает keep-alive соединение и кладёт ответ на частый вопрос в кэш"""
+    if perplexity_api:
+        await perplexity_api.ask_async(query)
+
+async def invalidate_answer_cache():
+    if perplexity_api:
+        await perplexity_api.cache.invalidate()
+
+def answer_cache_stats() -> Dict:
+    return perplexity_api.cache.stats() if perplexity_api else {}
+
+def perplexity_latency_stats() -> Dict:
+    if not perplexity_api:
+        return {}
+    return {"answer": perplexity_api.latency.stats(), "first_token": perplexity_api.first_token.stats()}
+
+async def close_perplexity():
+    if perplexity_api:
+        await perplexity_api.close()
+
 # --- Пример использования (для теста запусти этот файл напрямую) ---
 if __name__ == "__main__":
     import os
@@ -0,0 +1,204 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError
+
+from database import Database
+from metrics import PRICE_ALERTS, PRICE_EVENT_BATCHES
+from state_utils import load_pinned_message_id, save_pinned_message_id
+from telegram_utils import send_long_message, telegram_sender
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PriceChange:
+    """Изменение цены известного товара в одном городе за проход цикла цен"""
+    city_id: str
+    product_id: str
+    name: str
+    old_price: float
+    new_price: float
+    notify: bool = False  # снижение, о котором ещё не сообщали в канал
+
+    @property
+    def drop_percent(self) -> float:
+        """На сколько процентов снизилась цена (отрицательное значение — рост)"""
+        return (self.old_price - self.new_price) / self.old_price * 100 if self.old_price else 0.0
+
+    def describe(self, with_city: bool = False) -> str:
+        return (
+            f"📉 Цена на '{self.name}' снизилась: {self.old_price} ₽ → {self.new_price} ₽"
+            + (f" (город {self.city_id})" if with_city else "")
+        )
+
+
+Sink = Callable[[List[PriceChange]], Awaitable[None]]
+
+
+class PriceEventPipeline:
+    """Конвейер событий изменения цен: цикл цен публикует изменения прохода одной пачкой,
+    а каждый приёмник (канал, подписчики, БД) разбирает свою очередь в отдельной задаче.
+
+    Медленная рассылка подписчикам не задерживает ни пост в канале, ни следующий проход.
+    Очереди ограничены: отставший приёмник притормаживает publish(), а не копит пачки в памяти.
+    """
+
+    def __init__(self, max_pending: int = 10):
+        self.max_pending = max_pending
+        self._sinks: Dict[str, Tuple[Sink, asyncio.Queue]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    def add_sink(self, name: str, sink: Sink):
+        self._sinks[name] = (sink, asyncio.Queue(self.max_pending))
+
+    def start(self):
+        for name, (sink, queue) in self._sinks.items():
+            task = asyncio.create_task(self._run(name, sink, queue))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def publish(self, events: List[PriceChange]):
+        """Передаёт изменения прохода всем приёмникам; пустые проходы не публикуются"""
+        if not events:
+            return
+        for sink, queue in self._sinks.values():
+            await queue.put(events)
+
+    async def _run(self, name: str, sink: Sink, queue: asyncio.Queue):
+        result = {key: PRICE_EVENT_BATCHES.labels(name, key) for key in ("ok", "error")}
+        while True:
+            events = await queue.get()
+            try:
+                await sink(events)
+                result["ok"].inc()
+            except Exception as e:
+                result["error"].inc()
+                logger.error(f"Ошибка приёмника событий цен {name} ({len(events)} изменений): {e}")
+            finally:
+                queue.task_done()
+
+    async def close(self, timeout: float):
+        """Дожидается разбора очередей не дольше timeout секунд и останавливает приёмники"""
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(queue.join() for _, queue in self._sinks.values())), timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"Не все события цен обработаны за {timeout:.0f} с: {self.stats()}")
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, int]:
+        """Пачек в очереди каждого приёмника"""
+        return {name: queue.qsize() for name, (_, queue) in self._sinks.items()}
+
+
+class ChannelSink:
+    """Пост о снижениях цен в канал с закреплением; при одном только росте цен открепляет пост.
+
+    О результате поста сообщает трекеру цен: on_delivered — пост отправлен и закреплён,
+    on_failed — не дошёл, и снижения нужно обнаружить заново в следующем проходе.
+    """
+
+    def __init__(self, bot: Bot, channel_id, fence: Callable[[], Awaitable], with_city: bool = False,
+                 on_delivered: Optional[Callable[[List[PriceChange]], Awaitable[None]]] = None,
+                 on_failed: Optional[Callable[[List[PriceChange]], None]] = None):
+        self.bot = bot
+        self.channel_id = channel_id
+        self.fence = fence
+        self.with_city = with_city
+        self.on_delivered = on_delivered
+        self.on_failed = on_failed
+
+    async def __call__(self, events: List[PriceChange]):
+        drops = [event for event in events if event.notify]
+        increased = any(event.new_price > event.old_price for event in events)
+        if not drops and not increased:
+            return
+        if drops:
+            try:
+                await self._post(drops)
+            except Exception:
+                if self.on_failed:
+                    self.on_failed(drops)
+                raise
+            if self.on_delivered:
+                await self.on_delivered(drops)
+        else:
+            await self.fence()
+            pinned_message_id = await load_pinned_message_id()
+            if pinned_message_id:
+                await self.bot.unpin_chat_message(self.channel_id, pinned_message_id)
+                await save_pinned_message_id(None)
+
+    async def _post(self, drops: List[PriceChange]):
+        # Реплика, у которой перехватили лидерство, не должна ни закреплять, ни сохранять закреплённое
+        await self.fence()
+        # Все строки уходят одним сообщением (длинный список — несколькими), закрепляется первое
+        sent = await asyncio.gather(*(
+            telegram_sender.notify(
+                self.bot, self.channel_id, event.describe(self.with_city),
+                header="🔥 **АКЦИЯ!**\n\n", parse_mode="Markdown"
+            )
+            for event in drops
+        ))
+        sent_message = sent[0][0]
+        await self.bot.pin_chat_message(self.channel_id, sent_message.message_id)
+        await save_pinned_message_id(sent_message.message_id)
+
+
+class WatchlistSink:
+    """Личные уведомления подписчикам (/watch), если цена упала не меньше их порога.
+
+    Подписчики ищутся только для подешевевших товаров прохода (индекс price_watch по товару),
+    так что стоимость прохода зависит от числа изменений, а не от числа подписок.
+    """
+
+    def __init__(self, bot: Bot, with_city: bool = False):
+        self.bot = bot
+        self.with_city = with_city
+
+    async def __call__(self, events: List[PriceChange]):
+        drops: Dict[str, List[PriceChange]] = {}
+        for event in events:
+            if event.new_price < event.old_price:
+                drops.setdefault(event.product_id, []).append(event)
+        if not drops:
+            return
+
+        db = await Database.get_instance()
+        alerts: Dict[int, List[str]] = {}
+        for product_id, watchers in (await db.load_watchers(drops)).items():
+            for event in drops[product_id]:
+                line = f"{event.describe(self.with_city)} (−{event.drop_percent:.0f}%)"
+                for user_id, threshold in watchers:
+                    if event.drop_percent >= threshold:
+                        alerts.setdefault(user_id, []).append(line)
+        if not alerts:
+            return
+        sent = await asyncio.gather(*(self._alert(db, user_id, lines) for user_id, lines in alerts.items()))
+        logger.info(f"Уведомления о снижении цен: отправлено {sum(sent)} из {len(alerts)} подписчикам")
+
+    async def _alert(self, db: Database, user_id: int, lines: List[str]) -> bool:
+        try:
+            await send_long_message(self.bot, user_id, "🔔 Подешевели товары из вашего списка:\n\n" + "\n".join(lines))
+            PRICE_ALERTS.inc()
+            return True
+        except TelegramForbiddenError:
+            # Пользователь заблокировал бота — подписки больше не нужны
+            removed = await db.remove_user_watches(user_id)
+            logger.info(f"Пользователь {user_id} заблокировал бота, удалено подписок: {removed}")
+        except Exception as e:
+            logger.warning(f"Не удалось отправить уведомление пользователю {user_id}: {e}")
+        return False
+
+
+async def store_price_events(events: List[PriceChange]):
+    """Приёмник для БД: изменения цен в таблицу price_events"""
+    db = await Database.get_instance()
+    await db.save_price_events(events)
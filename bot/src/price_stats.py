@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+
+from concurrency import SingleFlight
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+
+class PriceStats:
+    """Агрегаты по каталогу и истории цен для /stats и /price в памяти процесса.
+
+    Сводка считается после каждого прохода скрапера и не реже раза в ttl секунд
+    (цены могла обновить другая реплика). Команды отвечают из памяти: устаревшая сводка
+    отдаётся сразу, а пересчёт идёт в фоне. Цены отдельных товаров для /price
+    кэшируются на тот же ttl и сбрасываются при обновлении сводки.
+    """
+
+    def __init__(self, ttl: float = 300, history_days: int = 90, max_products: int = 256):
+        self.ttl = ttl
+        self.history_days = history_days
+        self.max_products = max_products
+        self.summary: Optional[Dict] = None
+        self.refreshed_at: Optional[float] = None
+        self._products: "OrderedDict[str, tuple]" = OrderedDict()  # id -> (цены по городам, время загрузки)
+        self._inflight = SingleFlight()
+        self._tasks: Set[asyncio.Task] = set()
+
+    def age(self) -> Optional[float]:
+        """Сколько секунд назад пересчитана сводка"""
+        return time.monotonic() - self.refreshed_at if self.refreshed_at is not None else None
+
+    def _stale(self) -> bool:
+        return self.refreshed_at is None or self.age() > self.ttl
+
+    async def refresh(self) -> Dict:
+        """Пересчитывает сводку; одновременные вызовы ждут один запрос"""
+        return await self._inflight.do("summary", self._load_summary)
+
+    async def _load_summary(self) -> Dict:
+        db = await Database.get_instance()
+        started = time.monotonic()
+        summary = await db.load_price_summary()
+        self.summary = summary
+        self.refreshed_at = time.monotonic()
+        self._products.clear()
+        logger.info(f"Сводка цен пересчитана за {(self.refreshed_at - started) * 1000:.0f} мс")
+        return summary
+
+    def _refresh_in_background(self):
+        if self._inflight.get("summary") is not None:
+            return
+        task = asyncio.create_task(self._refresh_logged())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _refresh_logged(self):
+        try:
+            await self.refresh()
+        except Exception as e:
+            logger.error(f"Ошибка пересчёта сводки цен: {e}")
+
+    async def get_summary(self) -> Optional[Dict]:
+        """Сводка из памяти; при первом вызове ждёт расчёта, устаревшую обновляет в фоне"""
+        if self.summary is None:
+            await self.refresh()
+        elif self._stale():
+            self._refresh_in_background()
+        return self.summary
+
+    async def product(self, product_id: str) -> List[Dict]:
+        """Цены товара по городам (см. Database.load_product_prices)"""
+        item = self._products.get(product_id)
+        if item is not None and time.monotonic() - item[1] <= self.ttl:
+            self._products.move_to_end(product_id)
+            return item[0]
+        db = await Database.get_instance()
+        rows = await db.load_product_prices(product_id, self.history_days)
+        self._products[product_id] = (rows, time.monotonic())
+        self._products.move_to_end(product_id)
+        while len(self._products) > self.max_products:
+            self._products.popitem(last=False)
+        return rows
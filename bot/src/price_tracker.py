@@ -0,0 +1,176 @@
+import logging
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+from catalog import CityPrices, Product, changed_positions, intern_id
+from database import Database, LEGACY_CITY_ID
+from price_events import PriceChange
+from state_utils import load_state
+from write_behind import write_behind
+
+logger = logging.getLogger(__name__)
+
+ProductKey = Tuple[str, str]  # (город, id товара)
+
+
+@dataclass
+class PriceChanges:
+    events: List[PriceChange] = field(default_factory=list)  # все изменения цен известных товаров за цикл
+    increase_detected: bool = False
+    new_products: int = 0
+    catalog_changed: bool = False  # появились новые товары в уже известном каталоге
+    rows: Dict[ProductKey, Tuple[float, float]] = field(default_factory=dict)  # изменившиеся записи для БД
+
+    @property
+    def drops(self) -> List[PriceChange]:
+        """Снижения, о которых ещё не сообщали в канал"""
+        return [event for event in self.events if event.notify]
+
+
+class PriceTracker:
+    """Индекс цен в памяти по городам (catalog.CityPrices: id товаров и столбцы array('d') цены
+    и последней уведомлённой цены), синхронизированный с таблицей price_state.
+
+    В БД пишутся только изменившиеся записи: цикл без изменений не делает ни одной записи.
+    Снижения для канала применяются только после того, как пост о них дошёл (confirm_notified):
+    если пост или закрепление не удались (release_notified), следующий проход обнаружит их заново.
+    """
+
+    def __init__(self):
+        self._cities: Dict[str, CityPrices] = {}
+        self._dirty: Dict[ProductKey, Tuple[float, float]] = {}  # записи, которые не удалось сохранить
+        self._unconfirmed: Dict[ProductKey, Tuple[float, float]] = {}  # снижения, пост о которых ещё не подтверждён
+        self._loaded = False
+
+    def __len__(self):
+        return sum(len(city) for city in self._cities.values())
+
+    async def load(self):
+        # Состояние, ещё лежащее в журнале отложенной записи, сначала доходит до таблицы
+        await write_behind.flush()
+        db = await Database.get_instance()
+        rows = await db.load_price_states()
+        if not rows:
+            rows = await self._migrate_legacy_state(db)
+        by_city: Dict[str, list] = defaultdict(list)
+        for city_id, product_id, price, last_notified in rows:
+            by_city[intern_id(city_id)].append((intern_id(product_id), price, last_notified))
+        self._cities = {city_id: CityPrices(items) for city_id, items in by_city.items()}
+        self._dirty.clear()  # при перезагрузке несохранённые записи устарели: таблица уже актуальнее
+        self._unconfirmed.clear()
+        self._loaded = True
+        logger.info(f"Загружено состояние цен для {len(self)} товаров")
+
+    @staticmethod
+    async def _migrate_legacy_state(db: Database) -> list:
+        """Переносит старый JSON-снимок price_state из bot_state в отдельную таблицу"""
+        legacy = await load_state()
+        rows = []
+        for product_id, data in legacy.items():
+            try:
+                price = float(data.get('price', 0))
+                rows.append((LEGACY_CITY_ID, product_id, price, float(data.get('last_notified_price', price))))
+            except (TypeError, ValueError, AttributeError) as e:
+                logger.warning(f"Пропускаем запись состояния {product_id}: {e}")
+        if rows:
+            await db.save_price_states(rows)
+            logger.info(f"Перенесено {len(rows)} записей состояния цен из bot_state")
+        return rows
+
+    async def process(self, city_id: str, products: List[Product], changes: PriceChanges) -> PriceChanges:
+        """Сравнивает очередную пачку товаров города с индексом и дописывает результат в changes.
+
+        Индекс меняется только в commit(), поэтому пачки можно подавать по мере разбора каталога.
+        Цены пачки сравниваются со столбцом цен города за один проход (changed_positions),
+        в Python разбираются только новые товары и товары с изменившейся ценой.
+        """
+        if not self._loaded:
+            await self.load()
+
+        known_before = len(self) > 0
+        city = self._cities.get(city_id)
+        if city is None:
+            city = self._cities[city_id] = CityPrices()
+        positions = city.lookup([product.id for product in products])
+        prices = [product.price for product in products]
+
+        fresh = 0
+        for k in changed_positions(city.prices, positions, prices):
+            product, new_price, position = products[k], prices[k], positions[k]
+            if position < 0:
+                fresh += 1
+                changes.rows[(city_id, product.id)] = (new_price, new_price)
+                continue
+            unconfirmed = self._unconfirmed.get((city_id, product.id))
+            if unconfirmed is not None and unconfirmed[0] == new_price:
+                continue  # о снижении уже отправляется пост, ждём подтверждения от канала
+            old_price, last_notified = city.prices[position], city.notified[position]
+            notify = new_price < old_price and new_price != last_notified
+            changes.events.append(PriceChange(city_id, product.id, product.name, old_price, new_price, notify))
+            if new_price > old_price:
+                changes.increase_detected = True
+            if notify or new_price > old_price:
+                last_notified = new_price
+            changes.rows[(city_id, product.id)] = (new_price, last_notified)
+        changes.new_products += fresh
+
+        if fresh and known_before:
+            changes.catalog_changed = True
+        return changes
+
+    async def commit(self, changes: PriceChanges):
+        """Применяет изменения к индексу и передаёт их на запись через журнал write_behind;
+        если не удалось ни дописать журнал, ни записать в БД, записи досохраняются в следующем цикле.
+
+        Снижения для канала откладываются до confirm_notified()/release_notified()."""
+        notified = {(event.city_id, event.product_id) for event in changes.drops}
+        rows = {}
+        for key, row in changes.rows.items():
+            if key in notified:
+                self._unconfirmed[key] = row
+            else:
+                self._unconfirmed.pop(key, None)
+                rows[key] = row
+        await self._apply(rows)
+
+    async def confirm_notified(self, drops: List[PriceChange]):
+        """Пост о снижениях дошёл до канала: их записи применяются и сохраняются"""
+        rows = {}
+        for event in drops:
+            key = (event.city_id, event.product_id)
+            row = self._unconfirmed.get(key)
+            # Если за это время цена успела измениться ещё раз, запись уже заменена более новой
+            if row is not None and row[0] == event.new_price:
+                rows[key] = self._unconfirmed.pop(key)
+        await self._apply(rows)
+
+    def release_notified(self, drops: List[PriceChange]):
+        """Пост о снижениях не дошёл: индекс не меняется, и следующий проход обнаружит их заново"""
+        released = 0
+        for event in drops:
+            key = (event.city_id, event.product_id)
+            row = self._unconfirmed.get(key)
+            if row is not None and row[0] == event.new_price:
+                del self._unconfirmed[key]
+                released += 1
+        if released:
+            logger.warning(f"Снижения цен не доставлены в канал ({released}), будут отправлены в следующем проходе")
+
+    async def _apply(self, rows: Dict[ProductKey, Tuple[float, float]]):
+        for (city_id, product_id), (price, last_notified) in rows.items():
+            city = self._cities.get(city_id)
+            if city is None:
+                city = self._cities[city_id] = CityPrices()
+            city.set(product_id, price, last_notified)
+        self._dirty.update(rows)
+        if not self._dirty:
+            return
+        try:
+            await write_behind.save_price_states(
+                [(city_id, product_id, price, last_notified)
+                 for (city_id, product_id), (price, last_notified) in self._dirty.items()]
+            )
+            self._dirty.clear()
+        except Exception as e:
+            logger.error(f"Ошибка сохранения состояния цен ({len(self._dirty)} записей): {e}")
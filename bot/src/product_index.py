@@ -0,0 +1,190 @@
+import asyncio
+import heapq
+import logging
+import math
+from collections import Counter, OrderedDict, defaultdict
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set
+
+from catalog import Product
+from database import Database
+from text_utils import tokenize
+
+logger = logging.getLogger(__name__)
+
+INDEXED_FIELDS = ("name", "short_name", "category")
+
+
+def _trigrams(term: str) -> Set[str]:
+    padded = f"  {term} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class ProductIndex:
+    """Инвертированный индекс товаров для контекста промпта: основы слов -> товары, ранжирование BM25.
+
+    Индекс обновляется инкрементально (upsert изменившихся товаров), поиск не зависит
+    линейно от размера каталога. Незнакомые слова из вопроса (опечатки, другая форма)
+    сопоставляются со словарём по триграммам. Товар один на все города; после полного прохода
+    каталога города (retain) товар, пропавший из всех городов, удаляется из индекса.
+    """
+    K1 = 1.5
+    B = 0.75
+    LOAD_CHUNK = 500
+    SIMILARITY = 0.5  # порог Жаккара по триграммам для незнакомых слов
+    EXPAND_CACHE_SIZE = 4096
+
+    def __init__(self):
+        self._docs: Dict[str, Product] = {}  # id -> товар
+        self._texts: Dict[str, str] = {}  # id -> проиндексированный текст (чтобы пропускать неизменившиеся)
+        self._lengths: Dict[str, int] = {}
+        self._total_length = 0
+        self._postings: Dict[str, Dict[str, int]] = defaultdict(dict)  # основа -> {id: частота}
+        self._by_trigram: Dict[str, Set[str]] = defaultdict(set)  # триграмма -> основы словаря
+        self._grams: Dict[str, FrozenSet[str]] = {}  # основа -> её триграммы
+        # Похожие основы для незнакомых слов; сбрасывается, когда меняется словарь
+        self._expanded: "OrderedDict[str, List[str]]" = OrderedDict()
+        self._cities: Dict[str, Set[str]] = defaultdict(set)  # id -> города, в каталогах которых есть товар
+        self._city_ids: Dict[str, Set[str]] = defaultdict(set)  # город -> id его товаров
+        self._synced: Set[str] = set()  # города, каталог которых уже прошёл полностью (retain)
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._docs)
+
+    async def load_from_db(self):
+        """Строит индекс по таблице products. Строки из неё не удаляются, поэтому для городов,
+        которые скрапер уже прошёл полностью, таблица не источник: товары и города берутся из прохода"""
+        db = await Database.get_instance()
+        rows = await db.load_products()
+        for start in range(0, len(rows), self.LOAD_CHUNK):
+            products = []
+            for row in rows[start:start + self.LOAD_CHUNK]:
+                product_id = row["id"]
+                cities = [city_id for city_id in row["city_ids"] if city_id not in self._synced]
+                if not cities and product_id not in self._docs:
+                    continue  # товара уже нет в каталогах пройденных городов
+                for city_id in cities:
+                    self._track(product_id, city_id)
+                if product_id not in self._docs:  # версия из прохода скрапера свежее таблицы
+                    products.append(Product.from_row(row))
+            self.upsert(products)
+            await asyncio.sleep(0)  # не держим цикл событий на большом каталоге
+        self.loaded = True
+        logger.info(f"Индекс товаров построен: {len(self._docs)} товаров, {len(self._postings)} основ")
+
+    def upsert(self, products: Iterable[Product]) -> int:
+        """Добавляет или обновляет товары; возвращает число реально изменившихся документов"""
+        updated = 0
+        for product in products:
+            product_id = product.id
+            if product.city_id:
+                self._track(product_id, product.city_id)
+            text = " ".join(getattr(product, f) for f in INDEXED_FIELDS)
+            if self._texts.get(product_id) == text:
+                self._docs[product_id] = product
+                continue
+            self._unindex(product_id)
+            terms = Counter(tokenize(text))
+            for term, freq in terms.items():
+                if not self._postings.get(term):
+                    self._expanded.clear()
+                    grams = self._grams[term] = frozenset(_trigrams(term))
+                    for gram in grams:
+                        self._by_trigram[gram].add(term)
+                self._postings[term][product_id] = freq
+            self._docs[product_id] = product
+            self._texts[product_id] = text
+            self._lengths[product_id] = sum(terms.values())
+            self._total_length += self._lengths[product_id]
+            updated += 1
+        return updated
+
+    def remove(self, product_id: str):
+        self._unindex(product_id)
+        for city_id in self._cities.pop(product_id, ()):
+            self._city_ids[city_id].discard(product_id)
+
+    def _unindex(self, product_id: str):
+        if product_id not in self._docs:
+            return
+        for term in set(tokenize(self._texts[product_id])):
+            postings = self._postings.get(term)
+            if postings is None:
+                continue
+            postings.pop(product_id, None)
+            if not postings:
+                self._expanded.clear()
+                del self._postings[term]
+                for gram in self._grams.pop(term):
+                    self._by_trigram[gram].discard(term)
+        self._total_length -= self._lengths.pop(product_id)
+        del self._docs[product_id]
+        del self._texts[product_id]
+
+    def retain(self, city_id: str, product_ids: Set[str]) -> int:
+        """Вызывается после полного прохода каталога города: товары города, которых не было в проходе,
+        отвязываются от него, а пропавшие из всех городов удаляются. Возвращает число удалённых"""
+        self._synced.add(city_id)
+        removed = 0
+        for product_id in self._city_ids[city_id] - product_ids:
+            self._city_ids[city_id].discard(product_id)
+            cities = self._cities[product_id]
+            cities.discard(city_id)
+            if not cities:
+                self.remove(product_id)
+                removed += 1
+        return removed
+
+    def _track(self, product_id: str, city_id: str):
+        self._cities[product_id].add(city_id)
+        self._city_ids[city_id].add(product_id)
+
+    def get(self, product_id: str) -> Optional[Product]:
+        return self._docs.get(product_id)
+
+    def _expand(self, term: str) -> List[str]:
+        """Сам термин, если он есть в словаре, иначе похожие основы по триграммам (Жаккар >= SIMILARITY)"""
+        if term in self._postings:
+            return [term]
+        expanded = self._expanded.get(term)
+        if expanded is not None:
+            self._expanded.move_to_end(term)
+            return expanded
+        grams = _trigrams(term)
+        # Похожей основе нужно не меньше need общих триграмм, поэтому она обязательно содержит одну
+        # из len(grams) - need + 1 самых редких триграмм термина: частые триграммы не перебираются
+        need = math.ceil(len(grams) * self.SIMILARITY)
+        rare = sorted(grams, key=lambda gram: len(self._by_trigram.get(gram, ())))[:len(grams) - need + 1]
+        expanded = []
+        for candidate in set().union(*(self._by_trigram.get(gram, ()) for gram in rare)):
+            candidate_grams = self._grams[candidate]
+            count = len(candidate_grams)
+            if not need <= count <= len(grams) / self.SIMILARITY:
+                continue
+            shared = len(grams & candidate_grams)
+            if shared / (len(grams) + count - shared) >= self.SIMILARITY:
+                expanded.append(candidate)
+        self._expanded[term] = expanded
+        if len(self._expanded) > self.EXPAND_CACHE_SIZE:
+            self._expanded.popitem(last=False)
+        return expanded
+
+    def search(self, query: str, top_k: int = 3) -> List[Product]:
+        if not self._docs:
+            return []
+        n_docs = len(self._docs)
+        avg_length = self._total_length / n_docs
+        scores: Dict[str, float] = defaultdict(float)
+        for query_term in set(tokenize(query)):
+            for term in self._expand(query_term):
+                postings = self._postings[term]
+                idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                for product_id, freq in postings.items():
+                    norm = self.K1 * (1 - self.B + self.B * self._lengths[product_id] / avg_length)
+                    scores[product_id] += idf * freq * (self.K1 + 1) / (freq + norm)
+        best = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+        return [self._docs[product_id] for product_id, _ in best]
+
+
+# --- Общий индекс: наполняется из таблицы products и обновляется скрапером ---
+product_index = ProductIndex()
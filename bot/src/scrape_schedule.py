@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from typing import Dict, FrozenSet, List, Optional
+
+from database import Database
+from metrics import SCRAPE_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Города, которым срок подходит в ближайшие секунды, проверяются тем же проходом, а не отдельным
+COALESCE_SECONDS = 60
+WEEKDAYS = {"mon": 1, "tue": 2, "wed": 3, "thu": 4, "fri": 5, "sat": 6, "sun": 7}
+
+
+def _parse_field(field: str, low: int, high: int, names: Optional[Dict[str, int]] = None) -> Optional[FrozenSet[int]]:
+    """Поле в духе cron: '*', '5', '1-5', 'mon-fri', '1,15' -> множество значений (None — любое)"""
+    if field == "*":
+        return None
+    values = set()
+    for part in field.lower().split(","):
+        first, _, last = part.partition("-")
+        first, last = (names or {}).get(first, first), (names or {}).get(last or first, last or first)
+        first, last = int(first), int(last)
+        if not low <= first <= last <= high:
+            raise ValueError(f"значение вне диапазона {low}-{high}: {part}")
+        values.update(range(first, last + 1))
+    return frozenset(values)
+
+
+def _parse_time(value: str) -> int:
+    hours, minutes = value.split(":")
+    total = int(hours) * 60 + int(minutes)
+    if not (0 <= int(minutes) < 60 and 0 <= total <= 24 * 60):
+        raise ValueError(f"неверное время: {value}")
+    return total
+
+
+@dataclass(frozen=True)
+class ScrapeWindow:
+    """Окно учащённой проверки: дни месяца, дни недели (1 — понедельник), время начала и конца"""
+    month_days: Optional[FrozenSet[int]]
+    weekdays: Optional[FrozenSet[int]]
+    start: int  # минут от полуночи
+    end: int  # если не больше start — окно заканчивается на следующий день
+    interval: float
+
+    def matches(self, day: date) -> bool:
+        return ((self.month_days is None or day.day in self.month_days)
+                and (self.weekdays is None or day.isoweekday() in self.weekdays))
+
+    def bounds(self, day: date):
+        """Начало и конец окна, открытого в день day"""
+        begin = datetime.combine(day, datetime.min.time()) + timedelta(minutes=self.start)
+        end = datetime.combine(day, datetime.min.time()) + timedelta(minutes=self.end)
+        return begin, end if self.end > self.start else end + timedelta(days=1)
+
+
+def parse_windows(spec: str) -> List[ScrapeWindow]:
+    """'1 * 00:00-03:00 600; * mon-fri 09:00-10:00 1800' — окна через ';':
+    дни месяца, дни недели, ЧЧ:ММ-ЧЧ:ММ и интервал проверки в секундах"""
+    windows = []
+    for item in filter(None, (part.strip() for part in spec.split(";"))):
+        try:
+            month_days, weekdays, hours, interval = item.split()
+            start, end = hours.split("-")
+            windows.append(ScrapeWindow(
+                _parse_field(month_days, 1, 31), _parse_field(weekdays, 1, 7, WEEKDAYS),
+                _parse_time(start), _parse_time(end), float(interval)
+            ))
+        except ValueError as e:
+            raise ValueError(f"Неверное окно проверки цен '{item}': {e}") from None
+    return windows
+
+
+@dataclass
+class CitySchedule:
+    interval: float  # текущий адаптивный интервал без учёта окон
+    next_due: float = 0.0  # time.time() следующей проверки
+    failures: int = 0  # ошибок загрузки подряд
+    last_changes: int = 0
+
+
+class ScrapeScheduler:
+    """Расписание проверки каталогов по городам вместо фиксированного CHECK_INTERVAL.
+
+    Интервал города подстраивается под частоту изменений цен: проход с изменениями сокращает
+    его вдвое (идёт распродажа), проход без изменений удлиняет в 1.5 раза, в пределах
+    [min_interval, max_interval]. Начальный интервал берётся из price_history: сколько часов
+    за неделю в городе менялись цены. После ошибки загрузки город повторяется с экспоненциальной
+    задержкой от retry_interval. В окнах (parse_windows) интервал не больше заданного окном,
+    а к началу окна проверка подтягивается. Все сроки получают случайный разброс ±jitter.
+
+    Срок следующей проверки считается от конца прохода: если проход затянулся, пропущенные
+    сроки не нагоняются серией проверок подряд.
+    """
+
+    def __init__(self, city_ids: List[str], interval: float, min_interval: float, max_interval: float,
+                 retry_interval: float = 60, windows: Optional[List[ScrapeWindow]] = None, jitter: float = 0.1):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.retry_interval = retry_interval
+        self.windows = windows or []
+        self.jitter = jitter
+        self.cities: Dict[str, CitySchedule] = {city_id: CitySchedule(interval) for city_id in city_ids}
+        self.skipped = 0  # сроков, пропущенных из-за затянувшихся проходов
+
+    def _clamp(self, interval: float) -> float:
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def _jittered(self, delay: float) -> float:
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def seed(self, days: int = 7):
+        """Начальные интервалы по истории цен; все города проверяются сразу"""
+        try:
+            db = await Database.get_instance()
+            activity = await db.load_city_activity(days)
+        except Exception as e:
+            logger.error(f"Не удалось оценить частоту изменений цен, интервал {self.interval:.0f} с: {e}")
+            activity = {}
+        for city_id, city in self.cities.items():
+            hours = activity.get(city_id)
+            # Две проверки на типичный промежуток между часами с изменениями
+            city.interval = self._clamp(days * 86400 / hours / 2) if hours else self.interval
+            city.next_due = 0.0
+            city.failures = 0
+            SCRAPE_INTERVAL.labels(city_id).set(city.interval)
+        logger.info("Интервалы проверки цен: " + ", ".join(
+            f"{city_id} — {city.interval / 60:.0f} мин" for city_id, city in self.cities.items()
+        ))
+
+    def window_interval(self, now: datetime) -> Optional[float]:
+        """Интервал самого частого из открытых сейчас окон"""
+        intervals = [
+            window.interval for window in self.windows for day in (now.date() - timedelta(days=1), now.date())
+            if window.matches(day) and window.bounds(day)[0] <= now < window.bounds(day)[1]
+        ]
+        return min(intervals) if intervals else None
+
+    def _next_window_start(self, now: datetime, until: datetime) -> Optional[datetime]:
+        starts = [
+            window.bounds(now.date() + timedelta(days=offset))[0]
+            for window in self.windows for offset in range((until.date() - now.date()).days + 1)
+            if window.matches(now.date() + timedelta(days=offset))
+        ]
+        starts = [start for start in starts if now < start < until]
+        return min(starts) if starts else None
+
+    def _schedule(self, city: CitySchedule, delay: float, now: float):
+        moment = datetime.fromtimestamp(now)
+        window = self.window_interval(moment)
+        if window is not None and not city.failures:
+            delay = min(delay, window)
+        due = now + self._jittered(delay)
+        start = self._next_window_start(moment, datetime.fromtimestamp(due))
+        city.next_due = start.timestamp() if start is not None else due
+
+    def due(self, now: Optional[float] = None) -> List[str]:
+        """Города, которые пора проверить (включая те, чей срок наступит в ближайшие COALESCE_SECONDS)"""
+        now = time.time() if now is None else now
+        due = [city_id for city_id, city in self.cities.items() if city.next_due <= now + COALESCE_SECONDS]
+        for city_id in due:
+            city = self.cities[city_id]
+            if city.next_due and now - city.next_due > city.interval:
+                self.skipped += int((now - city.next_due) // city.interval)
+        return due
+
+    def record_success(self, city_id: str, changes: int, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        city = self.cities[city_id]
+        city.failures = 0
+        city.last_changes = changes
+        city.interval = self._clamp(city.interval * (0.5 if changes else 1.5))
+        SCRAPE_INTERVAL.labels(city_id).set(city.interval)
+        self._schedule(city, city.interval, now)
+
+    def record_failure(self, city_id: str, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        city = self.cities[city_id]
+        city.failures += 1
+        # Повторы не реже обычного интервала: дальше ждать нет смысла
+        self._schedule(city, min(city.interval, self.retry_interval * 2 ** (city.failures - 1)), now)
+
+    def next_delay(self, now: Optional[float] = None) -> float:
+        """Сколько секунд до ближайшей проверки"""
+        now = time.time() if now is None else now
+        return max(0.0, min(city.next_due for city in self.cities.values()) - now)
+
+    async def wait(self):
+        """Спит до ближайшей проверки; отмена задачи прерывает ожидание"""
+        await asyncio.sleep(self.next_delay())
+
+    def stats(self) -> dict:
+        now = time.time()
+        return {
+            "next_in": self.next_delay(now),
+            "window": self.window_interval(datetime.fromtimestamp(now)),
+            "skipped": self.skipped,
+            "cities": {
+                city_id: {"interval": city.interval, "next_in": max(0.0, city.next_due - now),
+                          "failures": city.failures, "last_changes": city.last_changes}
+                for city_id, city in self.cities.items()
+            },
+        }
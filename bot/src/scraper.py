@@ -1,56 +1,207 @@
-import requests
+import asyncio
+import hashlib
+import aiohttp
+import ijson
 import logging
-from database import Database
+import tempfile
+from dataclasses import dataclass
+from typing import IO, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from catalog import Product, intern_id
+from concurrency import TokenBucket
+from product_index import product_index
+from write_behind import write_behind
 
 logger = logging.getLogger(__name__)
 
-def fetch_products():
+CATALOG_URL = "https://ng.nlstar.com/ru/api/store/city/{city_id}/all-products/"
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36"
+}
+
+
+SPOOL_MEMORY_LIMIT = 1024 * 1024  # тело ответа крупнее этого уходит во временный файл
+READ_CHUNK_SIZE = 64 * 1024
+
+
+@dataclass
+class CityCatalog:
+    city_id: str
+    body: Optional[IO[bytes]] = None  # сырой ответ; разбирается потоково в iter_batches()
+    changed: bool = True  # False — каталог не менялся, нормализация и запись в БД пропущены
+    # (ETag, Last-Modified, хэш тела) этого ответа; запоминаются через remember() после обработки
+    validators: Tuple[Optional[str], Optional[str], Optional[str]] = (None, None, None)
+    products_count: int = 0
+    removed_count: int = 0  # товары, пропавшие из каталога и удалённые из индекса после полного прохода
+
+    def close(self):
+        """Освобождает тело ответа; повторный вызов безопасен"""
+        if self.body is not None:
+            self.body.close()
+
+
+def normalize_product(p: Dict, city_id: str) -> Product:
+    # Обработка цены
+    price = p.get('price', 0)
+    if isinstance(price, dict):
+        # Если цена приходит в виде словаря, берем основное значение
+        price = price.get('current', 0)
+    if isinstance(price, str):
+        price = price.replace(' ', '').replace(',', '.')
+
+    # Преобразуем в float
     try:
-        url = "https://ng.nlstar.com/ru/api/store/city/2214/all-products/"
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36"
-        }
-        logger.info(f"Запрос данных с {url}")
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        
-        data = response.json()
-        products = data.get("products", [])
-        logger.info(f"Получено {len(products)} товаров")
-        
-        # Нормализация данных
-        normalized = []
-        for p in products:
-            try:
-                # Обработка цены
-                price = p.get('price', 0)
-                if isinstance(price, dict):
-                    # Если цена приходит в виде словаря, берем основное значение
-                    price = price.get('current', 0)
-                if isinstance(price, str):
-                    price = price.replace(' ', '').replace(',', '.')
-                
-                # Преобразуем в float
+        price = float(price)
+    except (ValueError, TypeError):
+        price = 0.0
+
+    # id, город и категория повторяются в каждом проходе — хранятся в одном экземпляре
+    return Product(
+        city_id=intern_id(city_id),
+        id=intern_id(p.get('id', '')),
+        name=str(p.get('name') or p.get('short_name') or "Без названия"),
+        short_name=str(p.get('short_name', '')),
+        price=price,
+        category=intern_id(p.get('category', '')))
+
+
+def iter_normalized(body: IO[bytes], city_id: str) -> Iterator[Product]:
+    """Потоковый разбор {"products": [...]}: в памяти одновременно находится один товар"""
+    for p in ijson.items(body, "products.item", use_float=True):
+        try:
+            yield normalize_product(p, city_id)
+        except Exception as e:
+            logger.error(f"Ошибка обработки товара: {e}")
+
+
+def _batched(items: Iterator[Product], size: int) -> Iterator[List[Product]]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class CatalogScraper:
+    """Параллельная загрузка каталогов нескольких городов.
+
+    Одновременно идёт не больше concurrency запросов, к каждому хосту — не чаще rate_per_host в секунду.
+    Неизменившиеся каталоги (304 по ETag/If-Modified-Since или тот же хэш тела) не разбираются и не пишутся в БД.
+    Изменившиеся разбираются потоково и пачками уходят в журнал записи в БД (write_behind)
+    и детектор изменений цен, так что память не растёт с размером каталога.
+    """
+
+    def __init__(self, city_ids: List[str], concurrency: int = 4, rate_per_host: float = 2.0, batch_size: int = 1000):
+        self.city_ids = city_ids
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.rate_per_host = rate_per_host
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._host_limits: Dict[str, TokenBucket] = {}
+        self._validators: Dict[str, Tuple[Optional[str], Optional[str], Optional[str]]] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=300),
+                headers=HEADERS,
+                timeout=aiohttp.ClientTimeout(total=60)
+            )
+        return self._session
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _host_limit(self, url: str) -> TokenBucket:
+        host = urlparse(url).netloc
+        if host not in self._host_limits:
+            self._host_limits[host] = TokenBucket(self.rate_per_host, 1)
+        return self._host_limits[host]
+
+    async def fetch_all(self, city_ids: Optional[List[str]] = None) -> List[CityCatalog]:
+        """Каталоги городов city_ids (по умолчанию всех); города, которые не удалось загрузить, пропускаются"""
+        city_ids = self.city_ids if city_ids is None else city_ids
+        results = await asyncio.gather(*(self.fetch_city(city_id) for city_id in city_ids), return_exceptions=True)
+        catalogs = []
+        for city_id, result in zip(city_ids, results):
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка получения продуктов города {city_id}: {result}")
+            else:
+                catalogs.append(result)
+        return catalogs
+
+    async def fetch_city(self, city_id: str) -> CityCatalog:
+        url = CATALOG_URL.format(city_id=city_id)
+        etag, last_modified, body_hash = self._validators.get(city_id, (None, None, None))
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+        async with self._semaphore:
+            await self._host_limit(url).acquire()
+            logger.info(f"Запрос данных с {url}")
+            async with self._get_session().get(url, headers=headers) as response:
+                if response.status == 304:
+                    logger.info(f"Каталог города {city_id} не изменился (304)")
+                    return CityCatalog(city_id, changed=False)
+                response.raise_for_status()
+                # Тело не собирается в память целиком: копим во временный файл и считаем хэш по чанкам
+                body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_LIMIT)
+                digest = hashlib.sha256()
                 try:
-                    price = float(price)
-                except (ValueError, TypeError):
-                    price = 0.0
-                
-                normalized.append({
-                    'id': str(p.get('id', '')),
-                    'name': str(p.get('name') or p.get('short_name') or "Без названия"),
-                    'short_name': str(p.get('short_name', '')),
-                    'price': price,
-                    'category': str(p.get('category', ''))})
-            except Exception as e:
-                logger.error(f"Ошибка обработки товара: {e}")
-        
-        # Сохраняем в БД
-        db = Database.get_instance()
-        saved = db.save_products(normalized)
-        logger.info(f"Сохранено {saved} товаров в БД")
-        
-        return normalized
-    except Exception as e:
-        logger.error(f"Ошибка получения продуктов: {e}")
-        return []
\ No newline at end of file
+                    async for chunk in response.content.iter_chunked(READ_CHUNK_SIZE):
+                        digest.update(chunk)
+                        body.write(chunk)
+                except BaseException:
+                    body.close()
+                    raise
+                validators = (response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                              digest.hexdigest())
+
+        if validators[2] == body_hash:
+            logger.info(f"Каталог города {city_id} не изменился (тот же хэш)")
+            body.close()
+            self._validators[city_id] = validators
+            return CityCatalog(city_id, changed=False)
+
+        body.seek(0)
+        return CityCatalog(city_id, body, validators=validators)
+
+    async def iter_batches(self, catalog: CityCatalog) -> AsyncIterator[List[Product]]:
+        """Разбирает каталог пачками по batch_size, передаёт каждую пачку на запись в БД и отдаёт её дальше.
+
+        Пачки пишутся через журнал write_behind: проход не ждёт PostgreSQL, а при его недоступности
+        пачки дождутся записи в журнале (в том числе после перезапуска).
+        """
+        seen = set()
+        try:
+            for batch in _batched(iter_normalized(catalog.body, catalog.city_id), self.batch_size):
+                await write_behind.save_products(batch)
+                product_index.upsert(batch)
+                seen.update(product.id for product in batch)
+                catalog.products_count += len(batch)
+                yield batch
+        finally:
+            catalog.close()
+
+        # Каталог разобран целиком: товары, которых в нём больше нет, не должны попадать в промпт
+        catalog.removed_count = product_index.retain(catalog.city_id, seen)
+
+        logger.info(
+            f"Город {catalog.city_id}: получено {catalog.products_count} товаров, переданы на запись в БД, "
+            f"удалено из индекса: {catalog.removed_count}"
+        )
+
+    def remember(self, catalog: CityCatalog):
+        """Запоминает валидаторы каталога, когда его изменения полностью обработаны"""
+        if catalog.changed:
+            self._validators[catalog.city_id] = catalog.validators
@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class Startup:
+    """Фаза запуска бота: компоненты (пул БД, индекс товаров, HTTP-сессии) поднимаются
+    параллельно в фоне, а приём апдейтов стартует сразу, не дожидаясь их.
+
+    Ведёт готовность компонентов и время от старта до приёма апдейтов и до первого апдейта.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.ready: Dict[str, float] = {}  # компонент -> секунд от старта до готовности
+        self.failed: Dict[str, str] = {}  # компонент -> текст ошибки
+        self.receiving_started: Optional[float] = None
+        self.first_update: Optional[float] = None
+        self._pending: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._first_update_event = asyncio.Event()
+
+    def begin(self):
+        """Отсчёт запуска от входа в main()"""
+        self.started = time.monotonic()
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def start(self, name: str, init: Awaitable):
+        """Запускает инициализацию компонента в фоне"""
+        self._pending.add(name)
+        task = asyncio.create_task(self._run(name, init))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, name: str, init: Awaitable):
+        try:
+            await init
+            self.ready[name] = self.elapsed()
+            logger.info(f"Компонент {name} готов за {self.ready[name]:.2f} с")
+        except Exception as e:
+            self.failed[name] = str(e)
+            logger.error(f"Ошибка инициализации {name}: {e}")
+        finally:
+            self._pending.discard(name)
+        if not self._pending:
+            logger.info(
+                f"Запуск завершён за {self.elapsed():.2f} с: готово {', '.join(self.ready) or '-'}"
+                + (f", с ошибками {', '.join(self.failed)}" if self.failed else "")
+            )
+
+    async def mark_receiving(self):
+        """Обработчик dp.startup: диспетчер начинает принимать апдейты (polling или webhook)"""
+        self.receiving_started = self.elapsed()
+        logger.info(f"Приём апдейтов запущен через {self.receiving_started:.2f} с после старта")
+
+    def mark_first_update(self):
+        if self.first_update is None:
+            self.first_update = self.elapsed()
+            self._first_update_event.set()
+            logger.info(f"Первый апдейт получен через {self.first_update:.2f} с после старта")
+
+    async def wait_first_update(self):
+        await self._first_update_event.wait()
+
+    async def track_updates(self, handler: Callable[[Any, Dict], Awaitable], event: Any, data: Dict):
+        """Outer-middleware диспетчера: отмечает время первого апдейта"""
+        self.mark_first_update()
+        return await handler(event, data)
+
+    def status(self) -> Dict:
+        return {
+            "ready": dict(self.ready),
+            "failed": dict(self.failed),
+            "pending": sorted(self._pending),
+            "receiving_started": self.receiving_started,
+            "first_update": self.first_update,
+        }
+
+    async def cancel(self):
+        """Прерывает незавершённую инициализацию при остановке бота"""
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -1,35 +1,32 @@
 import logging
-from database import Database 
+from database import Database
+from write_behind import write_behind
 
 logger = logging.getLogger(__name__)
 
-def load_state():
+async def load_state():
+    """Старый JSON-снимок цен; читается только для переноса в таблицу price_state"""
     try:
-        db = Database.get_instance()
-        return db.load_state('price_state')
+        db = await Database.get_instance()
+        return await db.load_state('price_state')
     except Exception as e:
         logger.error(f"Ошибка загрузки состояния: {e}")
         return {}
 
-def save_state(state):
+async def load_pinned_message_id():
     try:
-        db = Database.get_instance()
-        db.save_state('price_state', state)
-    except Exception as e:
-        logger.error(f"Ошибка сохранения состояния: {e}")
-
-def load_pinned_message_id():
-    try:
-        db = Database.get_instance()
-        state = db.load_state('pinned_message')
+        # Значение, ещё не дошедшее из журнала отложенной записи до БД, новее табличного
+        state = write_behind.pending_state('pinned_message')
+        if state is None:
+            db = await Database.get_instance()
+            state = await db.load_state('pinned_message')
         return state.get('pinned_message_id')
     except Exception as e:
         logger.error(f"Ошибка загрузки закрепленного сообщения: {e}")
         return None
 
-def save_pinned_message_id(message_id):
+async def save_pinned_message_id(message_id):
     try:
-        db = Database.get_instance()
-        db.save_state('pinned_message', {'pinned_message_id': message_id})
+        await write_behind.save_state('pinned_message', {'pinned_message_id': message_id})
     except Exception as e:
         logger.error(f"Ошибка сохранения закрепленного сообщения: {e}")
\ No newline at end of file
@@ -1,10 +1,389 @@
+import asyncio
+import html
 import logging
+import math
+import re
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Set, Tuple
 from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.methods import Response, TelegramMethod
+from aiogram.types import Message
+
+from concurrency import TokenBucket
+from config import (
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_GROUP_RATE_PER_MIN, TELEGRAM_MAX_RETRIES,
+    TELEGRAM_COALESCE_WINDOW
+)
 
 logger = logging.getLogger(__name__)
 
+MESSAGE_LIMIT = 4096
+
+# True — запрос необязательный (промежуточная правка): не ждём лимит и не повторяем после 429
+_best_effort: ContextVar[bool] = ContextVar("telegram_best_effort", default=False)
+
+
+def split_text(text: str, limit: int = MESSAGE_LIMIT) -> list:
+    return [text[i:i+limit] for i in range(0, len(text), limit)]
+
+
+# Один проход по HTML: тег | сущность | абзац | перевод строки | пробелы | слово | одиночный < или &
+_HTML_TOKEN_RE = re.compile(r"<[^<>]*>|&#?\w+;|\n{2,}|\n|[^\S\n]+|[^<&\s]+|[<&]")
+_TAG_NAME_RE = re.compile(r"<\s*(/?)\s*([a-zA-Z][\w-]*)")
+_SENTENCE_END = ".!?…"
+# Приоритет места разреза: абзац > строка > конец предложения > пробел
+_BREAK_PARAGRAPH, _BREAK_LINE, _BREAK_SENTENCE, _BREAK_SPACE = 4, 3, 2, 1
+
+
+def utf16_len(text: str) -> int:
+    """Длина так, как её считает Telegram: в кодовых единицах UTF-16"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _close_tags(stack: tuple) -> str:
+    return "".join(f"</{name}>" for name, _ in reversed(stack))
+
+
+def split_html(text: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    """Режет HTML-текст (parse_mode="HTML") на сообщения не длиннее limit видимых символов.
+
+    Текст разбирается на токены один раз. Резать предпочитает по абзацам, затем по строкам,
+    предложениям и пробелам (не раньше середины лимита), теги и сущности не разрываются:
+    открытые на месте разреза теги закрываются и заново открываются в следующей части.
+    Длина считается как в Telegram — видимый текст после разбора сущностей в UTF-16.
+    """
+    tokens = _HTML_TOKEN_RE.findall(text)
+    chunks = []
+    stack: tuple = ()  # открытые теги: ((имя, открывающий тег), ...)
+    i = 0
+    while i < len(tokens):
+        parts = [tag for _, tag in stack]  # продолжение тегов из прошлой части
+        size = 0
+        visible = False
+        latest = {}  # приоритет -> (токенов в части, индекс продолжения, длина, теги) последнего места разреза
+        overflow = False
+        j = i
+        while j < len(tokens):
+            token = tokens[j]
+            if token[0] == "<" and len(token) > 1:
+                match = _TAG_NAME_RE.match(token)
+                if match:
+                    closing, name = match.group(1), match.group(2).lower()
+                    if not closing:
+                        stack += ((name, token),)
+                    elif any(open_name == name for open_name, _ in stack):
+                        while stack:
+                            open_name = stack[-1][0]
+                            stack = stack[:-1]
+                            if open_name == name:
+                                break
+                parts.append(token)
+                j += 1
+                continue
+
+            width = utf16_len(html.unescape(token)) if token[0] == "&" else utf16_len(token)
+            if size + width > limit:
+                overflow = True
+                break
+            if token.isspace():
+                if token.startswith("\n\n"):
+                    priority = _BREAK_PARAGRAPH
+                elif token[0] == "\n":
+                    priority = _BREAK_LINE
+                elif j and tokens[j - 1][-1] in _SENTENCE_END:
+                    priority = _BREAK_SENTENCE
+                else:
+                    priority = _BREAK_SPACE
+                if visible:
+                    latest[priority] = (len(parts), j + 1, size, stack)
+            else:
+                visible = True
+            parts.append(token)
+            size += width
+            j += 1
+
+        if not overflow:
+            if visible:
+                chunks.append("".join(parts) + _close_tags(stack))
+            break
+
+        # Лучшее место разреза из второй половины части, иначе самое дальнее из имеющихся
+        cut = next((latest[p] for p in sorted(latest, reverse=True) if latest[p][2] >= limit // 2), None)
+        if cut is None and latest:
+            cut = max(latest.values(), key=lambda c: c[2])
+        if cut is None:
+            # Пробелов нет: режем перед не влезшим токеном, а слово длиннее лимита — по символам
+            token, room, k = tokens[j], limit - size, 0
+            if not visible:
+                while k < len(token) and utf16_len(token[k]) <= room:
+                    room -= utf16_len(token[k])
+                    k += 1
+            if k:
+                parts.append(token[:k])
+                tokens[j] = token[k:]
+            cut = (len(parts), j, limit - room, stack)
+
+        count, i, _, stack = cut
+        chunks.append("".join(parts[:count]).rstrip() + _close_tags(stack))
+    return chunks
+
+
+def join_lines(header: str, lines: List[str], limit: int = MESSAGE_LIMIT) -> List[str]:
+    """Склеивает строки уведомлений в сообщения не длиннее limit, разрезая только по строкам"""
+    parts, current = [], header
+    for line in lines:
+        if len(current) + len(line) + 1 > limit and current != header:
+            parts.append(current.rstrip("\n"))
+            current = header
+        current += line + "\n"
+    parts.append(current.rstrip("\n"))
+    return [p for part in parts for p in split_text(part, limit)]
+
+
+def split_message(text: str, parse_mode=None, limit: int = MESSAGE_LIMIT) -> List[str]:
+    return split_html(text, limit) if parse_mode == "HTML" else split_text(text, limit)
+
+
 async def send_long_message(bot: Bot, chat_id: int, text: str, parse_mode=None, **kwargs):
-    limit = 4096
-    for i in range(0, len(text), limit):
-        part = text[i:i+limit]
-        await bot.send_message(chat_id, part, parse_mode=parse_mode, **kwargs)
\ No newline at end of file
+    # Частоту и повторы после 429 обеспечивает TelegramSender в сессии бота
+    for part in split_message(text, parse_mode):
+        await bot.send_message(chat_id, part, parse_mode=parse_mode, **kwargs)
+
+
+@contextmanager
+def best_effort():
+    """Запросы внутри блока не встают в очередь: при исчерпанном лимите чата или 429
+    сразу бросают TelegramRetryAfter, и вызывающий просто пропускает обновление"""
+    token = _best_effort.set(True)
+    try:
+        yield
+    finally:
+        _best_effort.reset(token)
+
+
+class TelegramSender(BaseRequestMiddleware):
+    """Исходящая очередь Bot API (middleware сессии бота): каждый запрос к чату ждёт токен
+    общего лимита бота и лимита чата (в личку — chat_rate в секунду, в группы и каналы —
+    group_rate_per_min в минуту). После 429 чат ставится на паузу на retry_after, а запрос
+    повторяется, так что всплески сглаживаются, а не теряются.
+
+    Необязательные запросы (best_effort) в группах и каналах не берут последний токен чата:
+    при 20 запросах в минуту на канал он достаётся финальным ответам, а не заглушкам и правкам.
+
+    notify() объединяет уведомления в один чат, пришедшие за coalesce_window секунд, в одно сообщение.
+    """
+    MAX_CHATS = 10000  # лимитеры давно молчавших чатов вытесняются
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, group_rate_per_min: float = 20,
+                 max_retries: int = 5, coalesce_window: float = 1.0):
+        self.global_limit = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate_per_min / 60
+        self.max_retries = max_retries
+        self.coalesce_window = coalesce_window
+        self._chat_limits: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._pending: Dict[Tuple, Tuple[List[str], asyncio.Future]] = {}
+        self._flushes: Set[asyncio.Task] = set()
+        # Метрики
+        self.waiting = 0
+        self.requests = 0
+        self.sent = 0
+        self.skipped = 0  # необязательные запросы, пропущенные из-за лимита
+        self.flood_waits = 0
+        self.coalesced = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _chat_limit(self, chat_id) -> TokenBucket:
+        key = str(chat_id)
+        bucket = self._chat_limits.get(key)
+        if bucket is None:
+            # Группы и каналы — отрицательные id или @username
+            is_group = key.startswith("@") or key.startswith("-")
+            bucket = TokenBucket(self.group_rate, 3) if is_group else TokenBucket(self.chat_rate, 1)
+            self._chat_limits[key] = bucket
+            while len(self._chat_limits) > self.MAX_CHATS:
+                self._chat_limits.popitem(last=False)
+        self._chat_limits.move_to_end(key)
+        return bucket
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod) -> Response:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            # getUpdates, getMe, setWebhook и т.п. не относятся к лимитам на сообщения
+            return await make_request(bot, method)
+
+        if _best_effort.get():
+            chat_limit = self._chat_limit(chat_id)
+            if not chat_limit.try_acquire(reserve=1 if chat_limit.capacity > 1 else 0):
+                self.skipped += 1
+                raise TelegramRetryAfter(method, "исчерпан лимит чата", math.ceil(1 / chat_limit.rate))
+            await self.global_limit.acquire()
+            return await self._send(make_request, bot, method, chat_id)
+
+        attempt = 0
+        while True:
+            enqueued = time.monotonic()
+            self.waiting += 1
+            try:
+                await self._chat_limit(chat_id).acquire()
+                await self.global_limit.acquire()
+            finally:
+                self.waiting -= 1
+            wait = time.monotonic() - enqueued
+            self.requests += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            try:
+                return await self._send(make_request, bot, method, chat_id)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                logger.warning(
+                    f"Флуд-лимит {type(method).__name__} в чате {chat_id}, повтор через {e.retry_after} с "
+                    f"(попытка {attempt}/{self.max_retries})"
+                )
+
+    async def _send(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod, chat_id):
+        try:
+            response = await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            self.flood_waits += 1
+            self._chat_limit(chat_id).pause(e.retry_after)  # остальные запросы в этот чат тоже подождут
+            raise
+        self.sent += 1
+        return response
+
+    async def notify(self, bot: Bot, chat_id, text: str, header: str = "", parse_mode=None) -> List[Message]:
+        """Отправляет строку уведомления; строки в тот же чат с тем же заголовком, пришедшие
+        за coalesce_window, уходят одним сообщением. Возвращает отправленные сообщения."""
+        key = (str(chat_id), header, parse_mode)
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = ([], asyncio.get_running_loop().create_future())
+            task = asyncio.create_task(self._flush(bot, chat_id, key))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+        else:
+            self.coalesced += 1
+        pending[0].append(text)
+        return await asyncio.shield(pending[1])
+
+    async def _flush(self, bot: Bot, chat_id, key: Tuple):
+        await asyncio.sleep(self.coalesce_window)
+        lines, done = self._pending.pop(key)
+        _, header, parse_mode = key
+        try:
+            messages = []
+            for part in join_lines(header, lines):
+                messages.append(await bot.send_message(chat_id, part, parse_mode=parse_mode))
+            done.set_result(messages)
+        except Exception as e:
+            done.set_exception(e)
+
+    def stats(self) -> dict:
+        return {
+            "waiting": self.waiting,
+            "sent": self.sent,
+            "skipped": self.skipped,
+            "flood_waits": self.flood_waits,
+            "coalesced": self.coalesced,
+            "avg_wait": self.wait_total / self.requests if self.requests else 0.0,
+            "max_wait": self.wait_max,
+        }
+
+
+# --- Общая очередь: подключается к сессии бота в bot.create_bot() ---
+telegram_sender = TelegramSender(
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_GROUP_RATE_PER_MIN, TELEGRAM_MAX_RETRIES,
+    TELEGRAM_COALESCE_WINDOW
+)
+
+
+class StreamingMessage:
+    """Показывает растущий ответ правками сообщения-заглушки.
+
+    Промежуточные правки идут не чаще interval секунд (флуд-лимиты Telegram),
+    текст длиннее лимита продолжается в новых сообщениях. Если заглушку отправить
+    не удалось (message_id=None), первое сообщение отправляется ответом на reply_to.
+    """
+    FINISH_ATTEMPTS = 3  # попыток финальной правки поверх повторов TelegramSender
+
+    def __init__(self, bot: Bot, chat_id: int, message_id: Optional[int], interval: float = 3.0,
+                 reply_to: Optional[int] = None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.interval = interval
+        self.reply_to = reply_to
+        self.message_ids = [message_id] if message_id is not None else []
+        self.shown = [None] if message_id is not None else []  # (текст, parse_mode), видимый в каждом сообщении
+        self._next_edit = 0.0
+
+    def due(self) -> bool:
+        """Пора ли следующей промежуточной правке (текст для неё можно не готовить заранее)"""
+        return time.monotonic() >= self._next_edit
+
+    async def update(self, text: str, parse_mode=None, **kwargs):
+        """Промежуточное обновление; лишние правки пропускаются"""
+        if not text.strip() or not self.due():
+            return
+        self._next_edit = time.monotonic() + self.interval
+        try:
+            with best_effort():
+                await self._render(split_message(text, parse_mode), parse_mode=parse_mode, **kwargs)
+        except TelegramRetryAfter as e:
+            self._next_edit = time.monotonic() + e.retry_after
+            logger.warning(f"Флуд-лимит при потоковом ответе, пауза {e.retry_after} с")
+        except TelegramBadRequest as e:
+            logger.warning(f"Промежуточная правка отклонена: {e}")
+
+    async def finish(self, text: str, parse_mode=None, **kwargs) -> bool:
+        """Финальный текст: повторяет правки после RetryAfter (не больше FINISH_ATTEMPTS раз)
+        и удаляет лишние сообщения. False — флуд-контроль не пропустил ответ, задача не висит на нём"""
+        parts = split_message(text, parse_mode)
+        if not parts:
+            return True
+        for attempt in range(1, self.FINISH_ATTEMPTS + 1):
+            try:
+                await self._render(parts, parse_mode=parse_mode, **kwargs)
+                break
+            except TelegramRetryAfter as e:
+                if attempt == self.FINISH_ATTEMPTS:
+                    logger.error(f"Ответ в чат {self.chat_id} не показан: флуд-лимит после {attempt} попыток")
+                    return False
+                await asyncio.sleep(e.retry_after)
+        for message_id in self.message_ids[len(parts):]:
+            try:
+                await self.bot.delete_message(self.chat_id, message_id)
+            except TelegramBadRequest as e:
+                logger.warning(f"Не удалось удалить лишнее сообщение {message_id}: {e}")
+        del self.message_ids[len(parts):]
+        del self.shown[len(parts):]
+        return True
+
+    async def _render(self, parts: list, parse_mode=None, **kwargs):
+        for i, part in enumerate(parts):
+            if i >= len(self.message_ids):
+                reply_to = None if self.message_ids else self.reply_to
+                sent = await self.bot.send_message(
+                    self.chat_id, part, parse_mode=parse_mode, reply_to_message_id=reply_to, **kwargs
+                )
+                self.message_ids.append(sent.message_id)
+                self.shown.append((part, parse_mode))
+                continue
+            if self.shown[i] == (part, parse_mode):
+                continue
+            try:
+                await self.bot.edit_message_text(
+                    part, chat_id=self.chat_id, message_id=self.message_ids[i], parse_mode=parse_mode, **kwargs
+                )
+            except TelegramBadRequest as e:
+                if "message is not modified" not in str(e):
+                    raise
+            self.shown[i] = (part, parse_mode)
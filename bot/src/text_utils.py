@@ -1,35 +1,151 @@
 import re
 import html
+from functools import lru_cache
 
-def clean_telegram_html(text: str) -> str:
-    return re.sub(r"</?think>", "", text)
-
-def convert_markdown_links_to_html(text: str) -> str:
-    # Обработка сносок вида [1], [2] с ссылками в конце
-    footnote_refs = {}
-    
-    # Шаг 1: Собираем все сноски вида [1]: URL
-    def collect_footnotes(match):
-        num = match.group(1)
-        url = match.group(2)
-        footnote_refs[num] = url
-        return ""  # Удаляем строку сноски из текста
-    
-    text = re.sub(r'^\[(\d+)\]:\s*(\S+)$', collect_footnotes, text, flags=re.MULTILINE)
-    
-    # Шаг 2: Заменяем упоминания [1] на ссылки
-    if footnote_refs:
-        def replace_footnote(match):
-            num = match.group(1)
-            url = footnote_refs.get(num)
-            if url:
-                return f'<a href="{html.escape(url, quote=True)}">[{num}]</a>'
-            return match.group(0)
-        
-        text = re.sub(r'\[(\d+)\]', replace_footnote, text)
-    
-    # Шаг 3: Обработка обычных Markdown ссылок
-    def replace_link(match):
-        return f'<a href="{html.escape(match.group(2), quote=True)}">{html.escape(match.group(1))}</a>'
-    
-    return re.sub(r'\[([^\]]+)\]\(([^)]+)\)', replace_link, text)
\ No newline at end of file
+import snowballstemmer
+
+_stemmer = snowballstemmer.stemmer("russian")
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+# Служебные слова, не влияющие на смысл вопроса
+STOPWORDS = frozenset("""
+а более бы был была были было быть в вам вас весь во вот все всего всех вы где да даже для до его ее её если есть
+еще ещё же за здесь и из или им их к как какая какие каким какой какую кем когда кто ли либо между меня мне может можно
+мой мы на над надо наш него нее неё них но ну о об однако он она они оно от очень по под при про с со так
+также такой там те тем то того тоже той только том ты у уже хотя чего чей чем что чтобы чье чья эта эти это этого
+этой этом этот я подскажите скажите пожалуйста
+""".split())
+# Вопросительные и модальные слова меняют смысл вопроса («как» / «когда» / «с чем» / «можно ли»
+# принимать): в ключе вопроса они сохраняются без стемминга, для поиска товаров остаются стоп-словами
+QUESTION_WORDS = frozenset("""
+где как какая какие каким какой какую кем когда кто ли может можно надо чего чей чем что чье чья
+""".split())
+
+
+@lru_cache(maxsize=10000)
+def _stem(word: str) -> str:
+    return _stemmer.stemWord(word)
+
+
+def tokenize(text: str) -> list:
+    """Разбивает текст на основы слов: регистр, пунктуация и стоп-слова отбрасываются"""
+    words = _WORD_RE.findall(text.casefold().replace("ё", "е"))
+    return [_stem(w) for w in words if w not in STOPWORDS]
+
+
+def normalize_query(text: str) -> str:
+    """Ключ вопроса: уникальные основы слов и вопросительные слова в алфавитном порядке"""
+    words = _WORD_RE.findall(text.casefold().replace("ё", "е"))
+    return " ".join(sorted({
+        w if w in QUESTION_WORDS else _stem(w) for w in words if w not in STOPWORDS or w in QUESTION_WORDS
+    }))
+
+# Разметка ответа Perplexity за один проход: блок размышлений | строка сноски | markdown-ссылка | ссылка на сноску
+_ANSWER_TOKEN_RE = re.compile(
+    r"(?P<think><think>)"
+    r"|^\[(?P<def_num>\d+)\]:[ \t]*(?P<def_url>\S+)[ \t]*(?:\n|\Z)"
+    r"|\[(?P<link_text>[^\[\]\n]+)\]\((?P<link_url>[^()\s]+)\)"
+    r"|\[(?P<ref_num>\d+)\]",
+    re.MULTILINE
+)
+_THINK_CLOSE = "</think>"
+# Хвосты, которые продолжение стрима может превратить в разметку: их разбор откладывается
+_PARTIAL_LINK_RE = re.compile(r"\[[^\[\]\n]*(?:\](?:\([^()\s]*)?)?\Z")
+_PARTIAL_THINK_RE = re.compile(r"<(?:t(?:h(?:i(?:n(?:k)?)?)?)?)?\Z")
+
+
+class AnswerFormatter:
+    """Превращает ответ Perplexity в HTML для Telegram за один проход по тексту.
+
+    Блоки <think>…</think> удаляются вместе с содержимым, строки сносок «[1]: URL» собираются
+    и убираются, ссылки [1] и [текст](URL) становятся <a>, остальной текст экранируется.
+    Текст можно подавать кусками по мере стрима (feed), render() отдаёт готовый HTML
+    по уже разобранной части, finish() — окончательный.
+    """
+
+    def __init__(self):
+        self._buffer = ""  # ещё не разобранный хвост (с одним уже разобранным символом перед ним)
+        self._skip = 0  # сколько символов в начале буфера уже разобрано — они нужны только для ^ в регулярке
+        self._in_think = False
+        self._segments = []  # готовые куски HTML и номера сносок (int), которые подставляются при render()
+        self._footnotes = {}
+
+    def feed(self, chunk: str):
+        self._buffer += chunk
+        self._consume(final=False)
+
+    def finish(self) -> str:
+        self._consume(final=True)
+        return self.render().strip()
+
+    def render(self) -> str:
+        footnotes = self._footnotes
+        return "".join(
+            segment if isinstance(segment, str)
+            else f'<a href="{html.escape(footnotes[segment], quote=True)}">[{segment}]</a>' if segment in footnotes
+            else f"[{segment}]"
+            for segment in self._segments
+        )
+
+    def _safe_end(self, text: str) -> int:
+        """Докуда текст можно разобрать, не зная продолжения"""
+        line_start = text.rfind("\n") + 1
+        if text.startswith("[", line_start):
+            return line_start  # строка может оказаться определением сноски — ждём её конца
+        end = len(text)
+        bracket = text.rfind("[", line_start)
+        if bracket != -1 and _PARTIAL_LINK_RE.match(text, bracket):
+            end = bracket
+        angle = text.rfind("<", line_start)
+        if angle != -1 and angle < end and _PARTIAL_THINK_RE.match(text, angle):
+            end = angle
+        return end
+
+    def _consume(self, final: bool):
+        text = self._buffer
+        pos = self._skip
+        end = len(text) if final else self._safe_end(text)
+        segments = self._segments
+        while pos < len(text):
+            if self._in_think:
+                close = text.find(_THINK_CLOSE, pos)
+                if close == -1:
+                    # Содержимое размышлений отбрасывается; оставляем только возможное начало </think>
+                    pos = len(text) if final else max(pos, len(text) - len(_THINK_CLOSE) + 1)
+                    break
+                pos = close + len(_THINK_CLOSE)
+                self._in_think = False
+                continue
+
+            for match in _ANSWER_TOKEN_RE.finditer(text, pos, end):
+                if match.start() > pos:
+                    segments.append(html.escape(text[pos:match.start()], quote=False))
+                pos = match.end()
+                if match.group("think"):
+                    self._in_think = True
+                    break
+                elif match.group("def_num"):
+                    self._footnotes[int(match.group("def_num"))] = match.group("def_url")
+                elif match.group("link_text"):
+                    segments.append(
+                        f'<a href="{html.escape(match.group("link_url"), quote=True)}">'
+                        f'{html.escape(match.group("link_text"), quote=False)}</a>'
+                    )
+                else:
+                    segments.append(int(match.group("ref_num")))
+            if not self._in_think:
+                if end > pos:
+                    segments.append(html.escape(text[pos:end], quote=False))
+                    pos = end
+                break
+        # Символ перед хвостом сохраняем, чтобы ^ не сработал посреди строки
+        keep = pos - 1 if pos and text[pos - 1] != "\n" else pos
+        self._buffer = text[keep:]
+        self._skip = pos - keep
+
+
+def format_answer(text: str) -> str:
+    """HTML для Telegram из готового ответа целиком"""
+    formatter = AnswerFormatter()
+    formatter.feed(text)
+    return formatter.finish()
@@ -0,0 +1,334 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from catalog import Product
+from config import JOURNAL_DIR, JOURNAL_FLUSH_INTERVAL, JOURNAL_RETRY_MAX, JOURNAL_MAX_BYTES, JOURNAL_FSYNC
+from database import Database, RETRYABLE_ERRORS
+from metrics import JOURNAL_BYTES, JOURNAL_FLUSHES, JOURNAL_RECORDS
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = ".jsonl"
+# Записи bot_state при старте находятся по началу строки, без разбора пачек товаров
+STATE_PREFIX = b'{"kind": "state"'
+# Ошибки, после которых запись остаётся в журнале и повторяется позже;
+# остальные означают битую запись — она пропускается, чтобы не держать очередь
+DEFER_ERRORS = RETRYABLE_ERRORS + (asyncio.TimeoutError,)
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _groups(records: List[dict]) -> Iterator[List[dict]]:
+    """Подряд идущие записи состояния цен и bot_state применяются одним запросом,
+    каждая пачка товаров — своей транзакцией, как при прямой записи"""
+    group = []
+    for record in records:
+        if group and (record["kind"] != group[0]["kind"] or record["kind"] == "products"):
+            yield group
+            group = []
+        group.append(record)
+    if group:
+        yield group
+
+
+class WriteBehindJournal:
+    """Отложенная запись в PostgreSQL через локальный журнал (append-only JSONL по сегментам).
+
+    Товары, состояние цен и bot_state дописываются в текущий сегмент, и вызывающий сразу
+    продолжает работу: задержки и недоступность БД не попадают в проход скрапера.
+    Фоновая задача раз в flush_interval закрывает сегмент, применяет его записи к БД по порядку
+    и удаляет файл; пока БД недоступна, сегменты копятся на диске, после перезапуска
+    применяются первыми. Повтор записи безопасен: товары и состояние цен пишутся upsert'ом
+    с временем из журнала (более старая запись не перетирает новую), точки price_history
+    уникальны по (товар, город, время).
+    """
+
+    def __init__(self, directory: str, flush_interval: float = 2.0, retry_max: float = 60.0,
+                 max_bytes: int = 512 * 1024 * 1024, fsync: bool = True):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.retry_max = retry_max
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.opened = False
+        self._lock_file = None
+        self._segments: List[Tuple[str, Optional[str]]] = []  # закрытые сегменты (путь, время первой записи)
+        self._applied = 0  # сколько записей первого сегмента уже в БД (после прерванного сброса)
+        self._active = None  # текущий сегмент, открывается при первой записи
+        self._active_path: Optional[str] = None
+        self._active_since: Optional[str] = None
+        self._next_number = 0
+        self._bytes = 0  # объём несброшенного журнала на диске
+        self._states: Dict[str, object] = {}  # bot_state, ещё не записанное в БД
+        self._append_lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._delay = flush_interval
+        self.flushes = self.failures = self.dropped = 0
+
+    @property
+    def pending(self) -> int:
+        return self._bytes
+
+    def open(self):
+        """Открывает каталог журнала; сегменты с прошлого запуска будут записаны в БД первыми.
+        Если каталог недоступен или занят другим процессом, запись идёт в БД напрямую"""
+        if self.opened:
+            return
+        self._segments, self._states, self._bytes, self._applied = [], {}, 0, 0
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            self._lock_file = open(os.path.join(self.directory, "lock"), "w")
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            names = sorted(
+                name for name in os.listdir(self.directory)
+                if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit()
+            )
+            for name in names:
+                path = os.path.join(self.directory, name)
+                self._segments.append((path, self._scan_segment(path)))
+                self._bytes += os.path.getsize(path)
+        except OSError as e:
+            logger.error(f"Журнал отложенной записи недоступен ({self.directory}), пишем в БД напрямую: {e}")
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+            self._segments, self._states, self._bytes = [], {}, 0
+            return
+        self._next_number = int(names[-1][:-len(SEGMENT_SUFFIX)]) + 1 if names else 0
+        self.opened = True
+        JOURNAL_BYTES.set(self._bytes)
+        if self._segments:
+            logger.info(f"В журнале отложенной записи {len(self._segments)} сегментов "
+                        f"({self._bytes / 1024:.0f} КБ) с прошлого запуска — будут записаны в БД")
+
+    def _scan_segment(self, path: str) -> Optional[str]:
+        """Время первой записи сегмента; заодно восстанавливает несброшенные значения bot_state"""
+        since = None
+        with open(path, "rb") as f:
+            for line in f:
+                if since is None or line.startswith(STATE_PREFIX):
+                    record = self._decode(line, path)
+                    if record is None:
+                        continue
+                    since = since or record["at"]
+                    if record["kind"] == "state":
+                        self._states[record["key"]] = record["value"]
+        return since
+
+    @staticmethod
+    def _decode(line: bytes, path: str) -> Optional[dict]:
+        try:
+            return json.loads(line)
+        except ValueError:
+            # Оборванная строка: процесс упал или диск переполнился посреди записи
+            logger.warning(f"Пропущена повреждённая строка журнала {path}")
+            return None
+
+    def start(self):
+        self.open()
+        if self.opened and self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def save_products(self, products: List[Product]):
+        if products:
+            await self._submit({"kind": "products", "at": _now(), "rows": [p.as_row() for p in products]})
+
+    async def save_price_states(self, rows):
+        """rows: (city_id, product_id, price, last_notified_price)"""
+        if rows:
+            await self._submit({"kind": "price_states", "at": _now(), "rows": [list(row) for row in rows]})
+
+    async def save_state(self, key: str, value):
+        if await self._submit({"kind": "state", "at": _now(), "key": key, "value": value}):
+            self._states[key] = value
+
+    def pending_state(self, key: str):
+        """Значение bot_state, ещё не дошедшее до БД (None — в таблице актуальное значение)"""
+        return self._states.get(key)
+
+    def oldest_pending(self) -> Optional[datetime]:
+        """Время самой старой записи, ещё не сброшенной в БД"""
+        for _, since in self._segments:
+            if since:
+                return datetime.fromisoformat(since)
+        return datetime.fromisoformat(self._active_since) if self._active_since else None
+
+    async def _submit(self, record: dict) -> bool:
+        """Дописывает запись в журнал (True); без журнала — не открыт, диск переполнен
+        или недоступен — сразу пишет в БД (False)"""
+        if self.opened and (self._bytes < self.max_bytes or record["kind"] == "state"):
+            line = (json.dumps(record, ensure_ascii=False) + "\n").encode()
+            try:
+                await self._append(line, record["at"])
+                JOURNAL_RECORDS.labels("written").inc()
+                return True
+            except OSError as e:
+                logger.error(f"Не удалось дописать журнал отложенной записи, пишем в БД напрямую: {e}")
+        elif self.opened:
+            logger.warning(f"Журнал отложенной записи переполнен ({self._bytes / 1024 / 1024:.0f} МБ), пишем в БД напрямую")
+        await self._apply([record])
+        return False
+
+    async def _append(self, line: bytes, at: str):
+        async with self._append_lock:
+            if self._active is None:
+                self._active_path = os.path.join(self.directory, f"{self._next_number:012d}{SEGMENT_SUFFIX}")
+                self._next_number += 1
+                self._active = open(self._active_path, "ab")
+                self._active_since = at
+            try:
+                self._active.write(line)
+                self._active.flush()
+            except OSError:
+                # Строка могла записаться частично: следующие записи пойдут в новый сегмент
+                self._close_active()
+                raise
+            self._bytes += len(line)
+            JOURNAL_BYTES.set(self._bytes)
+            if self.fsync:
+                # fsync в потоке: event loop не ждёт диск
+                await asyncio.to_thread(os.fsync, self._active.fileno())
+
+    def _close_active(self):
+        if self._active is None:
+            return
+        self._active.close()
+        self._segments.append((self._active_path, self._active_since))
+        self._active = self._active_path = self._active_since = None
+
+    def _read_segment(self, path: str) -> List[dict]:
+        records = []
+        with open(path, "rb") as f:
+            for line in f:
+                record = self._decode(line, path)
+                if record is not None:
+                    records.append(record)
+        return records
+
+    async def flush(self):
+        """Записывает в БД всё, что накопилось в журнале, по порядку записи.
+        Если БД недоступна, исключение пробрасывается, а записи остаются в журнале"""
+        if not self.opened:
+            return
+        async with self._flush_lock:
+            async with self._append_lock:
+                self._close_active()
+            applied = 0
+            while self._segments:
+                path, _ = self._segments[0]
+                records = await asyncio.to_thread(self._read_segment, path)
+                for group in _groups(records[self._applied:]):
+                    await self._apply(group)
+                    self._applied += len(group)
+                    applied += len(group)
+                size = os.path.getsize(path)
+                os.remove(path)
+                self._segments.pop(0)
+                self._applied = 0
+                self._bytes -= size
+                JOURNAL_BYTES.set(self._bytes)
+            if applied:
+                logger.debug(f"Журнал отложенной записи сброшен в БД: {applied} записей")
+
+    async def _apply(self, group: List[dict]):
+        """Применяет группу записей одного вида. Недоступность БД пробрасывается,
+        записи с ошибками данных пропускаются с ошибкой в логе"""
+        db = await Database.get_instance()
+        kind = group[0]["kind"]
+        try:
+            if kind == "products":
+                record = group[0]
+                result = await db.save_products(
+                    [Product(*row) for row in record["rows"]], datetime.fromisoformat(record["at"])
+                )
+                if result.changed or result.errors:
+                    logger.info(f"Из журнала записано {result.saved} товаров, изменений цен: {result.changed}, "
+                                f"ошибок: {len(result.errors)}")
+            elif kind == "price_states":
+                # Последняя запись по товару побеждает; у каждой строки — время её записи в журнал
+                rows = {}
+                for record in group:
+                    at = datetime.fromisoformat(record["at"])
+                    for city_id, product_id, price, last_notified in record["rows"]:
+                        rows[(city_id, product_id)] = (price, last_notified, at)
+                await db.save_price_states(
+                    [(city_id, product_id, price, last_notified)
+                     for (city_id, product_id), (price, last_notified, _) in rows.items()],
+                    [at for _, _, at in rows.values()]
+                )
+            elif kind == "state":
+                states = {record["key"]: record["value"] for record in group}
+                await db.save_states(states)
+                for key, value in states.items():
+                    if self._states.get(key) == value:
+                        del self._states[key]
+            else:
+                raise ValueError(f"неизвестный вид записи: {kind}")
+        except DEFER_ERRORS:
+            raise
+        except Exception as e:
+            self.dropped += len(group)
+            JOURNAL_RECORDS.labels("dropped").inc(len(group))
+            logger.error(f"Записи журнала пропущены ({kind}, {len(group)} шт.): {e}")
+            return
+        JOURNAL_RECORDS.labels("applied").inc(len(group))
+
+    async def run(self):
+        """Фоновый сброс журнала: раз в flush_interval, при недоступной БД — с нарастающей паузой"""
+        while True:
+            await asyncio.sleep(self._delay)
+            if not self._bytes and not self._segments:
+                continue
+            try:
+                await self.flush()
+                self.flushes += 1
+                self._delay = self.flush_interval
+                JOURNAL_FLUSHES.labels("ok").inc()
+            except Exception as e:
+                self.failures += 1
+                self._delay = min(self._delay * 2, self.retry_max)
+                JOURNAL_FLUSHES.labels("error").inc()
+                logger.warning(f"Журнал отложенной записи не сброшен в БД ({self._bytes / 1024:.0f} КБ ждут), "
+                               f"следующая попытка через {self._delay:.0f} с: {e}")
+
+    async def close(self, timeout: float):
+        """Последняя попытка сбросить журнал при остановке; что не успело, запишется после перезапуска"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if not self.opened:
+            return
+        if self._bytes:
+            try:
+                await asyncio.wait_for(self.flush(), timeout)
+            except Exception as e:
+                logger.warning(f"Журнал отложенной записи ({self._bytes / 1024:.0f} КБ) "
+                               f"будет записан в БД после перезапуска: {e}")
+        async with self._append_lock:
+            self._close_active()
+        self._lock_file.close()
+        self._lock_file = None
+        self.opened = False
+
+    def stats(self) -> dict:
+        return {
+            "bytes": self._bytes,
+            "segments": len(self._segments) + (self._active is not None),
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "dropped": self.dropped,
+            "delay": self._delay,
+        }
+
+
+# --- Общий журнал: запускается в main(), пишут скрапер, PriceTracker и state_utils ---
+write_behind = WriteBehindJournal(JOURNAL_DIR, JOURNAL_FLUSH_INTERVAL, JOURNAL_RETRY_MAX, JOURNAL_MAX_BYTES, JOURNAL_FSYNC)